@@ -0,0 +1,2590 @@
+"""Check Python ASTs against templates"""
+import ast
+import functools
+import heapq
+import operator
+import re
+import textwrap
+from contextvars import ContextVar
+from operator import attrgetter
+
+__version__ = '0.5.0'
+
+def mkarg(name):
+    # This was defined for Python 2-3 compatibility, and now left in place to
+    # avoid breaking code that uses it.
+    return ast.arg(arg=name)
+
+def must_exist(node, path):
+    """Checker function for an item or list that must exist
+    
+    This matches any value except None and the empty list.
+    
+    For instance, to match for loops with an else clause::
+    
+        ast.For(orelse=astcheck.must_exist)
+    """
+    if (node is None) or (node == []):
+        raise ASTMismatch(path, node, "non empty")
+
+def must_not_exist(node, path):
+    """Checker function for things that must not exist
+    
+    This accepts only None and the empty list.
+    
+    For instance, to check that a function has no decorators::
+    
+        ast.FunctionDef(decorator_list=astcheck.must_not_exist)
+    """
+    if (node is None) or (node == []):
+        return
+    raise ASTMismatch(path, node, "nothing")
+
+def _exists(node):
+    return not ((node is None) or (node == []))
+
+class name_or_attr(object):
+    """Checker for :class:`ast.Name` or :class:`ast.Attribute`
+    
+    These are often used in similar ways - depending on how you do imports,
+    objects will be referenced as names or as attributes of a module. By using
+    this function to build your template, you can allow either. For instance,
+    this will match both ``f()`` and ``mod.f()``::
+    
+        ast.Call(func=astcheck.name_or_attr('f'))
+
+    *name* may also be a checker like :class:`one_of` or :class:`matches_regex`,
+    to allow several names.
+    """
+    _node_types = (ast.Name, ast.Attribute)
+
+    def __init__(self, name):
+        self.name = name
+        self._name_test = self._make_name_test()
+
+    def __repr__(self):
+        return "astcheck.name_or_attr(%r)" % self.name
+
+    def __reduce__(self):
+        # The name test is a closure, which can't be pickled
+        return (name_or_attr, (self.name,))
+
+    def _add_required_names(self, names):
+        if isinstance(self.name, str):
+            names.add(self.name)
+
+    def _subtemplates(self):
+        return []
+
+    def _make_name_test(self):
+        if isinstance(self.name, _ValuePredicate):
+            return self.name._test
+        name = self.name
+        def test_name(value, path):
+            return value == name
+        return test_name
+
+    def __call__(self, node, path):
+        test = self._name_test
+        if isinstance(node, ast.Name):
+            if not test(node.id, path):
+                raise ASTPlainObjMismatch((path, 'id'), node.id, self.name)
+        elif isinstance(node, ast.Attribute):
+            if not test(node.attr, path):
+                raise ASTPlainObjMismatch((path, 'attr'), node.attr, self.name)
+        else:
+            raise ASTNodeTypeMismatch(path, node, "Name or Attribute")
+
+    def _matches(self, node, path):
+        if isinstance(node, ast.Name):
+            return self._name_test(node.id, path)
+        elif isinstance(node, ast.Attribute):
+            return self._name_test(node.attr, path)
+        return False
+
+    def _compile_test(self, suffix):
+        if isinstance(self.name, _ValuePredicate):
+            name_test = self.name._test
+            def test_name_or_attr(node, base):
+                if isinstance(node, ast.Name):
+                    return name_test(node.id, base)
+                elif isinstance(node, ast.Attribute):
+                    return name_test(node.attr, base)
+                return False
+            return test_name_or_attr
+
+        name = self.name
+        def test_name_or_attr(node, base):
+            if isinstance(node, ast.Name):
+                return node.id == name
+            elif isinstance(node, ast.Attribute):
+                return node.attr == name
+            return False
+        return test_name_or_attr
+
+class single_assign:
+    """Checker for :class:`ast.Assign` or :class:`ast.AnnAssign`
+
+    :class:`~ast.Assign` is a plain assignment. This will match only assignments
+    to a single target (``a = 1`` but not ``a = b = 1``).
+    :class:`~ast.AnnAssign` is an annotated assignment, like ``a: int = 7``.
+    *target* and *value* may be AST nodes to check, so this would match any
+    assignment to ``a``::
+
+        astcheck.single_assign(target=ast.Name(id='a'))
+
+    Annotated assignments don't necessarily have a value: ``a: int`` is parsed
+    as an :class:`~ast.AnnAssign` node. Use :func:`must_exist` to avoid matching
+    these::
+
+        astcheck.single_assign(target=ast.Name(id='a'), value=astcheck.must_exist)
+    """
+    _node_types = (ast.Assign, ast.AnnAssign)
+
+    def __init__(self, target=None, value=None):
+        self.target = target
+        self.value = value
+
+    def __repr__(self):
+        return "astcheck.single_assign(%r, %r)" % (self.target, self.value)
+
+    def _subtemplates(self):
+        return [self.target, self.value]
+
+    def _add_required_names(self, names):
+        _add_required_names(self.target, names)
+        _add_required_names(self.value, names)
+
+    def _add_required_types(self, types):
+        _add_required_types(self.target, types)
+        _add_required_types(self.value, types)
+
+    def __call__(self, node, path):
+        if isinstance(node, ast.Assign):
+            if len(node.targets) != 1:
+                raise ASTNodeListMismatch((path, 'targets'), node.targets, [self.target])
+            if self.target is not None:
+                assert_ast_like(node.targets[0], self.target, ((path, 'targets'), 0))
+            if self.value is not None:
+                assert_ast_like(node.value, self.value, (path, 'value'))
+        elif hasattr(ast, 'AnnAssign') and isinstance(node, ast.AnnAssign):
+            if self.target is not None:
+                assert_ast_like(node.target, self.target, (path, 'target'))
+            if self.value is not None:
+                assert_ast_like(node.value, self.value, (path, 'value'))
+        else:
+            raise ASTNodeTypeMismatch(path, node, "Assign or AnnAssign")
+
+    def _compile_check(self, suffix):
+        nodes_expected = [self.target]
+        target_check = ann_target_check = value_check = None
+        if self.target is not None:
+            target_check = _compile_template(self.target, suffix + ['targets', 0])
+            ann_target_check = _compile_template(self.target, suffix + ['target'])
+        if self.value is not None:
+            value_check = _compile_template(self.value, suffix + ['value'])
+
+        def check_single_assign(node, base):
+            if isinstance(node, ast.Assign):
+                if len(node.targets) != 1:
+                    raise ASTNodeListMismatch(_path_list(base) + suffix + ['targets'],
+                                              node.targets, nodes_expected)
+                if target_check is not None:
+                    target_check(node.targets[0], base)
+            elif isinstance(node, ast.AnnAssign):
+                if ann_target_check is not None:
+                    ann_target_check(node.target, base)
+            else:
+                raise ASTNodeTypeMismatch(_path_list(base) + suffix, node, "Assign or AnnAssign")
+            if value_check is not None:
+                value_check(node.value, base)
+        return check_single_assign
+
+    def _matches(self, node, path):
+        if isinstance(node, ast.Assign):
+            if len(node.targets) != 1:
+                return False
+            if (self.target is not None) and \
+                    not _is_like(node.targets[0], self.target, ((path, 'targets'), 0)):
+                return False
+        elif isinstance(node, ast.AnnAssign):
+            if (self.target is not None) and \
+                    not _is_like(node.target, self.target, (path, 'target')):
+                return False
+        else:
+            return False
+        return (self.value is None) or _is_like(node.value, self.value, (path, 'value'))
+
+    def _compile_test(self, suffix):
+        target_test = ann_target_test = value_test = None
+        if self.target is not None:
+            target_test = _compile_test(self.target, suffix + ['targets', 0])
+            ann_target_test = _compile_test(self.target, suffix + ['target'])
+        if self.value is not None:
+            value_test = _compile_test(self.value, suffix + ['value'])
+
+        def test_single_assign(node, base):
+            if isinstance(node, ast.Assign):
+                if len(node.targets) != 1:
+                    return False
+                if (target_test is not None) and not target_test(node.targets[0], base):
+                    return False
+            elif isinstance(node, ast.AnnAssign):
+                if (ann_target_test is not None) and not ann_target_test(node.target, base):
+                    return False
+            else:
+                return False
+            return (value_test is None) or value_test(node.value, base)
+        return test_single_assign
+
+class _ValuePredicate(object):
+    """Base class for helpers which test a single value, such as a name
+
+    Subclasses define a method ``_test(value, path) -> bool``. Compiled
+    templates call this directly, without the overhead of a checker function.
+    """
+    def _subtemplates(self):
+        return []
+
+    def __call__(self, value, path):
+        if not self._test(value, path):
+            raise ASTMismatch(path, value, self._describe())
+
+    def _matches(self, value, path):
+        return self._test(value, path)
+
+    def _compile_test(self, suffix):
+        return self._test
+
+    def _compile_check(self, suffix):
+        test = self._test
+        def check_predicate(value, base):
+            if not test(value, base):
+                raise ASTMismatch(_path_list(base) + suffix, value, self._describe())
+        return check_predicate
+
+class one_of(_ValuePredicate):
+    """Checker for a value in a set, such as one of several names
+
+    E.g. to match calls to ``open()`` or ``file()``::
+
+        ast.Call(func=ast.Name(id=astcheck.one_of('open', 'file')))
+    """
+    def __init__(self, *values):
+        self.values = frozenset(values)
+
+    def _test(self, value, path):
+        try:
+            return value in self.values
+        except TypeError:  # Unhashable, e.g. a list
+            return False
+
+    def __repr__(self):
+        return "astcheck.one_of(%s)" % ", ".join(sorted(repr(v) for v in self.values))
+
+    def _describe(self):
+        return "one of %s" % ", ".join(sorted(repr(v) for v in self.values))
+
+class matches_regex(_ValuePredicate):
+    """Checker for a string, such as an identifier, matching a regex
+
+    *pattern* may be a string or a compiled regular expression. The whole
+    string must match. E.g. to match test functions::
+
+        ast.FunctionDef(name=astcheck.matches_regex(r'test_\\w*'))
+    """
+    def __init__(self, pattern, flags=0):
+        self.regex = re.compile(pattern, flags)
+
+    def _test(self, value, path):
+        return isinstance(value, str) and (self.regex.fullmatch(value) is not None)
+
+    def __repr__(self):
+        return "astcheck.matches_regex(%r)" % self.regex.pattern
+
+    def _describe(self):
+        return "matching %r" % self.regex.pattern
+
+_COMPARISONS = {
+    '==': operator.eq, '!=': operator.ne,
+    '<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge,
+}
+
+class compare(_ValuePredicate):
+    """Checker comparing a value, such as a constant, with *value*
+
+    *op* is one of ``==``, ``!=``, ``<``, ``<=``, ``>`` or ``>=``. Values which
+    can't be compared don't match, and booleans only match if *value* is also
+    a boolean. E.g. to match number literals less than 7::
+
+        ast.Constant(value=astcheck.compare('<', 7))
+    """
+    def __init__(self, op, value):
+        try:
+            self._compare_op = _COMPARISONS[op]
+        except KeyError:
+            raise ValueError("Unknown comparison %r" % op)
+        self.op = op
+        self.value = value
+        self._allow_bool = isinstance(value, bool)
+
+    def _test(self, value, path):
+        if isinstance(value, bool) and not self._allow_bool:
+            return False
+        try:
+            return bool(self._compare_op(value, self.value))
+        except TypeError:
+            return False
+
+    def __repr__(self):
+        return "astcheck.compare(%r, %r)" % (self.op, self.value)
+
+    def _describe(self):
+        return "%s %r" % (self.op, self.value)
+
+class listmiddle(object):
+    # Matches lists, never a single node
+    _node_types = ()
+
+    def __init__(self, front=None, back=None):
+        super(listmiddle, self).__init__()
+        self.front = front or []
+        self.back = back or []
+
+    def __radd__(self, other):
+        if not isinstance(other, list):
+            raise TypeError("Cannot add {} and listmiddle objects".format(type(other)))
+        return listmiddle(other+self.front, self.back)
+
+    def __add__(self, other):
+        if not isinstance(other, list):
+            raise TypeError("Cannot add listmiddle and {} objects".format(type(other)))
+        return listmiddle(self.front, self.back + other)
+
+    def _subtemplates(self):
+        return self.front + self.back
+
+    def _add_required_names(self, names):
+        for template_node in self.front + self.back:
+            _add_required_names(template_node, names)
+
+    def _add_required_types(self, types):
+        for template_node in self.front + self.back:
+            _add_required_types(template_node, types)
+
+    def __call__(self, sample_list, path):
+        if not isinstance(sample_list, list):
+            raise ASTNodeTypeMismatch(path, sample_list, list)
+
+        if self.front:
+            nfront = len(self.front)
+            if len(sample_list) < nfront:
+                raise ASTNodeListMismatch((path, '<front>'), sample_list, self.front)
+            _check_node_items(path, sample_list, self.front)
+        if self.back:
+            nback = len(self.back)
+            if len(sample_list) < nback:
+                raise ASTNodeListMismatch((path, '<back>'), sample_list, self.back)
+            _check_node_items(path, sample_list, self.back, -nback)
+
+    def _find_mismatches(self, sample_list, path, found, limit):
+        if not isinstance(sample_list, list):
+            found.append(MismatchRecord(ASTNodeTypeMismatch, path, sample_list, list))
+            return
+        for part, items, start in [('<front>', self.front, 0),
+                                   ('<back>', self.back, -len(self.back))]:
+            if (not items) or _limit_reached(found, limit):
+                continue
+            if len(sample_list) < len(items):
+                found.append(MismatchRecord(ASTNodeListMismatch, (path, part),
+                                            sample_list, items))
+            else:
+                _find_item_mismatches(path, sample_list, items, found, limit, start)
+
+    def _compile_check(self, suffix):
+        front, back = self.front, self.back
+        nfront, nback = len(front), len(back)
+        front_check = _compile_node_items(front, suffix) if front else None
+        back_check = _compile_node_items(back, suffix, -nback) if back else None
+
+        def check_listmiddle(sample_list, base):
+            if not isinstance(sample_list, list):
+                raise ASTNodeTypeMismatch(_path_list(base) + suffix, sample_list, list)
+            if front_check is not None:
+                if len(sample_list) < nfront:
+                    raise ASTNodeListMismatch(_path_list(base) + suffix + ['<front>'],
+                                              sample_list, front)
+                front_check(sample_list, base)
+            if back_check is not None:
+                if len(sample_list) < nback:
+                    raise ASTNodeListMismatch(_path_list(base) + suffix + ['<back>'],
+                                              sample_list, back)
+                back_check(sample_list, base)
+        return check_listmiddle
+
+    def _matches(self, sample_list, path):
+        if not isinstance(sample_list, list):
+            return False
+        nfront, nback = len(self.front), len(self.back)
+        if nfront and not ((len(sample_list) >= nfront) and
+                _node_items_are_like(path, sample_list, self.front)):
+            return False
+        if nback and not ((len(sample_list) >= nback) and
+                _node_items_are_like(path, sample_list, self.back, -nback)):
+            return False
+        return True
+
+    def _compile_test(self, suffix):
+        nfront, nback = len(self.front), len(self.back)
+        front_test = _compile_node_items_test(self.front, suffix) if nfront else None
+        back_test = _compile_node_items_test(self.back, suffix, -nback) if nback else None
+
+        def test_listmiddle(sample_list, base):
+            if not isinstance(sample_list, list):
+                return False
+            if (front_test is not None) and not ((len(sample_list) >= nfront)
+                    and front_test(sample_list, base)):
+                return False
+            if (back_test is not None) and not ((len(sample_list) >= nback)
+                    and back_test(sample_list, base)):
+                return False
+            return True
+        return test_listmiddle
+
+class listcontains(object):
+    """Checker for a list containing a run of items anywhere in it
+
+    *items* is a list of template nodes or checker functions. By default, they
+    must match consecutive items somewhere in the sample list. E.g. to match a
+    function which opens a file and then reads from it, with any code before
+    or after::
+
+        ast.FunctionDef(body=astcheck.listcontains([
+            astcheck.single_assign(value=ast.Call(func=ast.Name(id='open'))),
+            ast.Expr(value=ast.Call(func=ast.Attribute(attr='read'))),
+        ]))
+
+    With ``gaps=True``, the items must match in order, but other items may
+    come between them.
+    """
+    # Matches lists, never a single node
+    _node_types = ()
+
+    def __init__(self, items, gaps=False):
+        self.items = list(items)
+        self.gaps = gaps
+        self._item_types = [_root_types(item) for item in self.items]
+        # Skip distances for the search, keyed by sample node type
+        self._shifts = {}
+
+    def __repr__(self):
+        return "astcheck.listcontains(%r, gaps=%r)" % (self.items, self.gaps)
+
+    def _describe(self):
+        if self.gaps:
+            return "list containing %d matching item(s) in order" % len(self.items)
+        return "list containing a run of %d matching item(s)" % len(self.items)
+
+    def _subtemplates(self):
+        return self.items
+
+    def _add_required_names(self, names):
+        for template_node in self.items:
+            _add_required_names(template_node, names)
+
+    def _add_required_types(self, types):
+        for template_node in self.items:
+            _add_required_types(template_node, types)
+
+    def _accepts(self, i, node_type):
+        """Could item i match a node of this type?"""
+        item_types = self._item_types[i]
+        return (item_types is None) or issubclass(node_type, item_types)
+
+    def _shift(self, node_type):
+        """Get (last item accepts node_type, shift) for the contiguous search
+
+        If a node of this type is under the last item, the search can move on
+        to the next position where an earlier item could accept it.
+        """
+        try:
+            return self._shifts[node_type]
+        except KeyError:
+            pass
+        last = len(self.items) - 1
+        shift = last + 1
+        for i in range(last - 1, -1, -1):
+            if self._accepts(i, node_type):
+                shift = last - i
+                break
+        res = self._shifts[node_type] = (self._accepts(last, node_type), shift)
+        return res
+
+    def _find(self, sample_list, test):
+        """Search the list, using test(i, j) to check item i at sample_list[j]"""
+        nitems = len(self.items)
+        if not nitems:
+            return True  # Any list contains an empty run
+        if self.gaps:
+            # Matching each item at the first place it fits is always best
+            # (although with captures, this binds them to the first match).
+            i = 0
+            for j, sample_node in enumerate(sample_list):
+                if i == nitems:
+                    break
+                if self._accepts(i, type(sample_node)):
+                    mark = _bindings_mark()
+                    if test(i, j):
+                        i += 1
+                    else:
+                        _bindings_rollback(mark)
+            return i == nitems
+
+        # Like the Boyer-Moore-Horspool string search: look at the node under
+        # the last item, and skip positions where its type can't match.
+        last = nitems - 1
+        start, stop = 0, len(sample_list) - last
+        while start < stop:
+            last_accepts, shift = self._shift(type(sample_list[start + last]))
+            if last_accepts:
+                mark = _bindings_mark()
+                if all(test(i, start + i) for i in range(nitems)):
+                    return True
+                _bindings_rollback(mark)
+            start += shift
+        return False
+
+    def __call__(self, sample_list, path):
+        if not isinstance(sample_list, list):
+            raise ASTNodeTypeMismatch(path, sample_list, list)
+        if not self._matches(sample_list, path):
+            raise ASTMismatch(path, sample_list, self._describe())
+
+    def _matches(self, sample_list, path):
+        if not isinstance(sample_list, list):
+            return False
+        items = self.items
+        def test(i, j):
+            return _is_like(sample_list[j], items[i], (path, j))
+        return self._find(sample_list, test)
+
+    def _compile_test(self, suffix):
+        # Items are checked with paths extended to the list item
+        item_tests = [_compile_nested_test(item, len(suffix) + 1) for item in self.items]
+        find = self._find
+
+        def test_listcontains(sample_list, base):
+            if not isinstance(sample_list, list):
+                return False
+            list_path = _extend_path(base, suffix)
+            def test(i, j):
+                return item_tests[i](sample_list[j], (list_path, j))
+            return find(sample_list, test)
+        return test_listcontains
+
+    def _compile_check(self, suffix):
+        test_listcontains = self._compile_test(suffix)
+        description = self._describe()
+
+        def check_listcontains(sample_list, base):
+            if not isinstance(sample_list, list):
+                raise ASTNodeTypeMismatch(_path_list(base) + suffix, sample_list, list)
+            if not test_listcontains(sample_list, base):
+                raise ASTMismatch(_path_list(base) + suffix, sample_list, description)
+        return check_listcontains
+
+# Combining templates
+# -------------------
+
+class any_of(object):
+    """Checker for a node matching at least one of several templates
+
+    The alternatives are tried in order. E.g. to match ``with open(...)``
+    or a call to ``open()`` assigned to a name::
+
+        astcheck.any_of(
+            ast.With(items=[ast.withitem(context_expr=ast.Call(func=ast.Name(id='open')))]),
+            astcheck.single_assign(value=ast.Call(func=ast.Name(id='open'))),
+        )
+
+    A node is only checked against the alternatives which could match its
+    type, so adding alternatives for other node types costs very little.
+    """
+    def __init__(self, *templates):
+        self.templates = templates
+        # Group the alternatives by the node types they can match, so each
+        # sample type can be dispatched to the ones which might match it.
+        self._by_root = {}
+        self._untyped = []  # Alternatives which might match any node
+        for i, template in enumerate(templates):
+            root_types = _root_types(template)
+            if root_types is None:
+                self._untyped.append(i)
+            else:
+                for cls in root_types:
+                    self._by_root.setdefault(cls, []).append(i)
+        self._dispatch = {}  # Sample type -> indices of alternatives
+
+    def __repr__(self):
+        return "astcheck.any_of(%s)" % ", ".join(repr(t) for t in self.templates)
+
+    def _describe(self):
+        return "any of %d alternatives" % len(self.templates)
+
+    @property
+    def _node_types(self):
+        if self._untyped:
+            return None
+        return tuple(self._by_root)
+
+    def _candidates(self, sample_type):
+        """Get the indices of alternatives which could match this type"""
+        try:
+            return self._dispatch[sample_type]
+        except KeyError:
+            pass
+        if issubclass(sample_type, ast.AST):
+            indices = set(self._untyped)
+            for cls in sample_type.__mro__:
+                indices.update(self._by_root.get(cls, ()))
+            indices = tuple(sorted(indices))
+        else:
+            # Lists and plain values are only checked by helpers like
+            # listmiddle, which don't match any node type.
+            indices = tuple(range(len(self.templates)))
+        self._dispatch[sample_type] = indices
+        return indices
+
+    def _subtemplates(self):
+        return list(self.templates)
+
+    def _add_required_names(self, names):
+        # Only names which every alternative requires
+        if self.templates:
+            names.update(frozenset.intersection(
+                *[required_names(t) for t in self.templates]))
+
+    def _add_required_types(self, types):
+        if self.templates:
+            types.update(frozenset.intersection(
+                *[required_node_types(t) for t in self.templates]))
+
+    def __call__(self, node, path):
+        candidates = self._candidates(type(node))
+        if len(candidates) == 1:
+            # Report why the only possible alternative didn't match
+            assert_ast_like(node, self.templates[candidates[0]], path)
+        elif not candidates:
+            raise ASTNodeTypeMismatch(path, node, self._describe())
+        elif not self._matches(node, path):
+            raise ASTMismatch(path, node, self._describe())
+
+    def _matches(self, node, path):
+        templates = self.templates
+        for i in self._candidates(type(node)):
+            mark = _bindings_mark()
+            if _is_like(node, templates[i], path):
+                return True
+            _bindings_rollback(mark)
+        return False
+
+    def _find_mismatches(self, node, path, found, limit):
+        candidates = self._candidates(type(node))
+        if len(candidates) == 1:
+            _find_mismatches(node, self.templates[candidates[0]], path, found, limit)
+        elif not candidates:
+            found.append(MismatchRecord(ASTNodeTypeMismatch, path, node, self._describe()))
+        elif not self._matches(node, path):
+            found.append(MismatchRecord(ASTMismatch, path, node, self._describe()))
+
+    def _compile_test(self, suffix):
+        tests = [_compile_test(t, suffix) for t in self.templates]
+        candidates = self._candidates
+        dispatch = {}  # Sample type -> tests to try
+
+        def test_any_of(node, base):
+            try:
+                node_tests = dispatch[type(node)]
+            except KeyError:
+                node_tests = dispatch[type(node)] = \
+                    tuple(tests[i] for i in candidates(type(node)))
+            for test in node_tests:
+                mark = _bindings_mark()
+                if test(node, base):
+                    return True
+                _bindings_rollback(mark)
+            return False
+        return test_any_of
+
+    def _compile_check(self, suffix):
+        checks = [_compile_template(t, suffix) for t in self.templates]
+        test_any_of = self._compile_test(suffix)
+        candidates = self._candidates
+        description = self._describe()
+
+        def check_any_of(node, base):
+            node_candidates = candidates(type(node))
+            if len(node_candidates) == 1:
+                checks[node_candidates[0]](node, base)
+            elif not node_candidates:
+                raise ASTNodeTypeMismatch(_path_list(base) + suffix, node, description)
+            elif not test_any_of(node, base):
+                raise ASTMismatch(_path_list(base) + suffix, node, description)
+        return check_any_of
+
+class not_(object):
+    """Checker for a node which doesn't match a template
+
+    E.g. to match calls to ``open()`` with anything but a string literal as
+    the first argument::
+
+        ast.Call(func=ast.Name(id='open'),
+                 args=astcheck.listmiddle([astcheck.not_(ast.Constant())]))
+
+    Nodes captured inside the template are never kept.
+    """
+    def __init__(self, template):
+        self.template = template
+
+    def __repr__(self):
+        return "astcheck.not_(%r)" % (self.template,)
+
+    def _describe(self):
+        return "not matching %r" % (self.template,)
+
+    def _subtemplates(self):
+        return [self.template]
+
+    def __call__(self, node, path):
+        if not self._matches(node, path):
+            raise ASTMismatch(path, node, self._describe())
+
+    def _matches(self, node, path):
+        mark = _bindings_mark()
+        try:
+            return not _is_like(node, self.template, path)
+        finally:
+            _bindings_rollback(mark)
+
+    def _compile_test(self, suffix):
+        inner_test = _compile_test(self.template, suffix)
+
+        def test_not(node, base):
+            mark = _bindings_mark()
+            try:
+                return not inner_test(node, base)
+            finally:
+                _bindings_rollback(mark)
+        return test_not
+
+    def _compile_check(self, suffix):
+        test_not = self._compile_test(suffix)
+        description = self._describe()
+
+        def check_not(node, base):
+            if not test_not(node, base):
+                raise ASTMismatch(_path_list(base) + suffix, node, description)
+        return check_not
+
+# Captures
+# --------
+# Nodes captured during one match are stored in a _Bindings dict, held in a
+# context variable. This is created when the first node is captured, and
+# discarded when the top-level matching function returns.
+
+_bindings = ContextVar('astcheck_bindings', default=None)
+
+class _Bindings(dict):
+    """Nodes captured so far in a match, by name"""
+    __slots__ = ('_keys',)
+
+    def __init__(self):
+        super().__init__()
+        self._keys = {}  # Structure keys for captured nodes, made when needed
+
+    def same_as(self, name, node):
+        captured = self[name]
+        if captured is node:
+            return True
+        key = self._keys.get(name)
+        if key is None:
+            key = self._keys[name] = _structure_key(captured)
+        return key == _structure_key(node)
+
+def _bind(name, node):
+    """Capture node as name, returning False if it conflicts with a capture"""
+    bindings = _bindings.get()
+    if bindings is None:
+        bindings = _Bindings()
+        _bindings.set(bindings)
+    elif name in bindings:
+        return bindings.same_as(name, node)
+    bindings[name] = node
+    return True
+
+def _bindings_mark():
+    bindings = _bindings.get()
+    return 0 if bindings is None else len(bindings)
+
+def _bindings_rollback(mark):
+    """Forget nodes captured since _bindings_mark(), e.g. in a failed attempt"""
+    bindings = _bindings.get()
+    if bindings is None:
+        return
+    while len(bindings) > mark:
+        name = next(reversed(bindings))
+        del bindings[name]
+        bindings._keys.pop(name, None)
+
+def _in_match_scope(func, *args):
+    """Call func(*args) with no nodes captured, and discard any it captures"""
+    outer = _bindings.get()
+    if outer is not None:
+        _bindings.set(None)
+    try:
+        return func(*args)
+    finally:
+        if _bindings.get() is not outer:
+            _bindings.set(outer)
+
+def _match_bindings(test, sample, *args):
+    """Call test(sample, *args), returning the captured nodes or None"""
+    outer = _bindings.get()
+    _bindings.set(None)
+    try:
+        if not test(sample, *args):
+            return None
+        return dict(_bindings.get() or {})
+    finally:
+        _bindings.set(outer)
+
+def _structure_key(node):
+    """Make a hashable key for a node; equal keys mean equal structure
+
+    Positions and expression contexts (Load, Store, Del) are ignored, so the
+    two ``x`` nodes in ``x = x + 1`` have the same key.
+    """
+    # The key is a flat tuple, listing nodes before their fields, so making,
+    # hashing and comparing keys doesn't recurse for deep nodes.
+    key = []
+    stack = [node]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, ast.AST):
+            fields = [getattr(item, name, None) for name in item._fields]
+            fields = [f for f in fields if not isinstance(f, ast.expr_context)]
+            key += (type(item), len(fields))
+            stack.extend(reversed(fields))
+        elif isinstance(item, list):
+            key += (list, len(item))
+            stack.extend(reversed(item))
+        else:
+            key.append(_value_key(item))
+    return tuple(key)
+
+def _value_key(value):
+    """Make a hashable key for a plain value, such as a name or a constant"""
+    if isinstance(value, (float, complex, tuple, frozenset)):
+        # Distinguish 0.0 from -0.0, and allow nan to equal itself
+        return (type(value), repr(value))
+    # Distinguish e.g. 1 from True
+    return (type(value), value)
+
+def _uses_bindings(template):
+    """Does the template contain capture or backref placeholders?"""
+    stack = [template]
+    while stack:
+        template = stack.pop()
+        if isinstance(template, (capture, backref)):
+            return True
+        elif isinstance(template, ast.AST):
+            for name, template_field in ast.iter_fields(template):
+                if isinstance(template_field, list):
+                    stack.extend(template_field)
+                else:
+                    stack.append(template_field)
+        else:
+            subtemplates = getattr(template, '_subtemplates', None)
+            if subtemplates is not None:
+                stack.extend(subtemplates())
+    return False
+
+class capture(object):
+    """Placeholder which captures the sample node at its position
+
+    If *template* is given, the node must also match that. Use
+    :func:`match_ast` or :meth:`CompiledTemplate.match` to get the captured
+    nodes in a dict, keyed by *name*. E.g. to find the object a method is
+    called on::
+
+        ast.Call(func=ast.Attribute(value=astcheck.capture('obj'), attr='read'))
+
+    If the same name is captured more than once, the nodes must have the same
+    structure, as for :class:`backref`.
+    """
+    def __init__(self, name, template=None):
+        self.name = name
+        self.template = template
+
+    def __repr__(self):
+        return "astcheck.capture(%r, %r)" % (self.name, self.template)
+
+    def _subtemplates(self):
+        return [self.template]
+
+    def _add_required_names(self, names):
+        _add_required_names(self.template, names)
+
+    def _add_required_types(self, types):
+        _add_required_types(self.template, types)
+
+    @property
+    def _node_types(self):
+        if self.template is None:
+            return None
+        return _root_types(self.template)
+
+    def __call__(self, node, path):
+        if self.template is not None:
+            assert_ast_like(node, self.template, path)
+        if not _bind(self.name, node):
+            raise ASTMismatch(path, node, "same as captured %r" % self.name)
+
+    def _matches(self, node, path):
+        if (self.template is not None) and not _is_like(node, self.template, path):
+            return False
+        return _bind(self.name, node)
+
+    def _find_mismatches(self, node, path, found, limit):
+        nfound = len(found)
+        if self.template is not None:
+            _find_mismatches(node, self.template, path, found, limit)
+        if (len(found) == nfound) and not _bind(self.name, node):
+            found.append(MismatchRecord(ASTMismatch, path, node,
+                                        "same as captured %r" % self.name))
+
+    def _compile_check(self, suffix):
+        name = self.name
+        inner_check = None
+        if self.template is not None:
+            inner_check = _compile_template(self.template, suffix)
+
+        def check_capture(node, base):
+            if inner_check is not None:
+                inner_check(node, base)
+            if not _bind(name, node):
+                raise ASTMismatch(_path_list(base) + suffix, node, "same as captured %r" % name)
+        return check_capture
+
+    def _compile_test(self, suffix):
+        name = self.name
+        inner_test = None
+        if self.template is not None:
+            inner_test = _compile_test(self.template, suffix)
+
+        def test_capture(node, base):
+            if (inner_test is not None) and not inner_test(node, base):
+                return False
+            return _bind(name, node)
+        return test_capture
+
+class backref(object):
+    """Placeholder for a node with the same structure as a captured node
+
+    The node named *name* must be captured (by :class:`capture`) earlier in
+    the match. Positions and contexts are ignored when comparing nodes, so
+    this matches ``x = x + 1``::
+
+        astcheck.single_assign(target=astcheck.capture('var'),
+                               value=ast.BinOp(left=astcheck.backref('var')))
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return "astcheck.backref(%r)" % self.name
+
+    def _subtemplates(self):
+        return []
+
+    def _matches(self, node, path):
+        bindings = _bindings.get()
+        return (bindings is not None) and (self.name in bindings) \
+            and bindings.same_as(self.name, node)
+
+    def __call__(self, node, path):
+        if not self._matches(node, path):
+            raise ASTMismatch(path, node, "same as captured %r" % self.name)
+
+    def _compile_test(self, suffix):
+        return self._matches
+
+# Paths
+# -----
+# While matching, the path to a node is built up as nested tuples of
+# (parent path, field name or index), starting from a list such as ['tree'].
+# Making a tuple at each step is much cheaper than copying the path so far,
+# and the path is only turned into a list when it's needed, e.g. to raise
+# ASTMismatch. Checker functions outside astcheck are always given a list.
+
+def _path_list(path):
+    """Turn a path built up while matching into a new list"""
+    parts = []
+    while isinstance(path, tuple):
+        path, part = path
+        parts.append(part)
+    parts.reverse()
+    return list(path) + parts
+
+_ROOT_PATH = ['tree']
+
+def _extend_path(base, suffix):
+    path = base
+    for part in suffix:
+        path = (path, part)
+    return path
+
+def _checker_path(checker, path):
+    """Get the path to pass to a checker function
+
+    astcheck's own helpers take the path as it's built up while matching, but
+    other checker functions get a list.
+    """
+    if isinstance(path, tuple) and not hasattr(checker, '_subtemplates') \
+            and (checker is not must_exist) and (checker is not must_not_exist):
+        return _path_list(path)
+    return path
+
+def format_path(path):
+    formed = path[:1]
+    for part in path[1:]:
+        if isinstance(part, int):
+            formed.append("[%d]" % part)
+        else:
+            formed.append("."+part)
+    return "".join(formed)
+
+class _NodeSummary(object):
+    """Stands in for a node in a MismatchRecord, without referring to it"""
+    __slots__ = ('type_name', 'lineno', 'col_offset')
+
+    def __init__(self, node):
+        self.type_name = type(node).__name__
+        self.lineno = getattr(node, 'lineno', None)
+        self.col_offset = getattr(node, 'col_offset', None)
+
+    def __repr__(self):
+        if self.lineno is None:
+            return "<%s node>" % self.type_name
+        return "<%s node at line %d, column %d>" % (self.type_name, self.lineno, self.col_offset)
+
+class _ListSummary(object):
+    """Stands in for a list of nodes in a MismatchRecord"""
+    __slots__ = ('length',)
+
+    def __init__(self, nodes):
+        self.length = len(nodes)
+
+    def __len__(self):
+        return self.length
+
+    def __repr__(self):
+        return "<list of %d items>" % self.length
+
+def _summarise(value):
+    if isinstance(value, ast.AST):
+        return _NodeSummary(value)
+    elif isinstance(value, list):
+        if any(isinstance(item, ast.AST) for item in value):
+            return _ListSummary(value)
+        return list(value)
+    return value
+
+def _type_name(value):
+    if isinstance(value, _NodeSummary):
+        return value.type_name
+    return type(value).__name__
+
+class ASTMismatch(AssertionError):
+    """Base exception for differing ASTs."""
+    def __init__(self, path, got, expected):
+        if isinstance(path, tuple):
+            path = _path_list(path)
+        self.path = path
+        self.expected = expected
+        self.got = got
+
+    def __str__(self):
+        return ("Mismatch at {}.\n"
+                "Found   : {}\n"
+                "Expected: {}").format(format_path(self.path), self.got, self.expected)
+
+class ASTNodeTypeMismatch(ASTMismatch):
+    """An AST node was of the wrong type."""
+    def __str__(self):
+        expected = _type_name(self.expected) if isinstance(self.expected, (ast.AST, _NodeSummary)) \
+                    else self.expected
+        return "At {}, found {} node instead of {}".format(format_path(self.path), 
+                        _type_name(self.got), expected)
+
+class ASTNodeListMismatch(ASTMismatch):
+    """A list of AST nodes had the wrong length."""
+    def __str__(self):
+        return "At {}, found {} node(s) instead of {}".format(format_path(self.path),
+                len(self.got), len(self.expected))
+
+class ASTPlainListMismatch(ASTMismatch):
+    """A list of non-AST objects did not match.
+    
+    e.g. A :class:`ast.Global` node has a ``names`` list of plain strings
+    """
+    def __str__(self):
+        return ("At {}, lists differ.\n"
+                "Found   : {}\n"
+                "Expected: {}").format(format_path(self.path), self.got, self.expected)
+
+class ASTPlainObjMismatch(ASTMismatch):
+    """A single value, such as a variable name, did not match."""
+    def __str__(self):
+        return "At {}, found {!r} instead of {!r}".format(format_path(self.path),
+                    self.got, self.expected)
+
+class MismatchRecord(object):
+    """A compact record of a mismatch, as returned by :func:`find_mismatches`
+
+    Unlike an :exc:`ASTMismatch`, this doesn't keep the sample tree alive:
+    *got* and *expected* hold summaries of nodes, with only their type and
+    position. *kind* is the :exc:`ASTMismatch` subclass which would have been
+    raised, and ``str(record)`` gives the same kind of message. *lineno* and
+    *col_offset* locate the mismatch in the sample, or are None if neither it
+    nor any node containing it has a position.
+    """
+    __slots__ = ('kind', '_path', 'got', 'expected', 'lineno', 'col_offset')
+
+    def __init__(self, kind, path, got, expected):
+        self.kind = kind
+        self._path = path  # Only turned into a list if needed
+        self.got = _summarise(got)
+        self.expected = _summarise(expected)
+        self.lineno = getattr(got, 'lineno', None)
+        self.col_offset = getattr(got, 'col_offset', None)
+
+    @classmethod
+    def from_exception(cls, exc):
+        """Make a record from an :exc:`ASTMismatch`"""
+        return cls(type(exc), exc.path, exc.got, exc.expected)
+
+    @property
+    def path(self):
+        """The path to the mismatch, as a list"""
+        if isinstance(self._path, tuple):
+            self._path = _path_list(self._path)
+        return list(self._path)
+
+    def __str__(self):
+        try:
+            return self.kind.__str__(self)
+        except Exception:
+            # e.g. a subclass which uses other attributes
+            return ASTMismatch.__str__(self)
+
+    def __repr__(self):
+        return "<MismatchRecord %s at %s>" % (self.kind.__name__, format_path(self.path))
+
+def _check_node_items(path, sample, template, start=0):
+    """Check nodes in a list from index *start*, ignoring its length
+
+    *start* may be negative to check the end of the list.
+    """
+    for i, template_node in enumerate(template, start=start):
+        if callable(template_node):
+            template_node(sample[i], _checker_path(template_node, (path, i)))
+        else:
+            assert_ast_like(sample[i], template_node, (path, i))
+
+# Kinds of check in find_mismatches' stack
+_CHECK_NODE, _CHECK_NODE_LIST, _CHECK_VALUE, _CHECK_VALUE_LIST = range(4)
+
+# Stands in for the sample in assert_ast_like's stack, where the template is
+# a mismatch to raise when it's reached
+_MISMATCH = object()
+
+# Set by the pytest plugin to time assertions while a test runs. It's called
+# as timer(func, *args) in place of func(*args); see astcheck.pytest_plugin.
+_assertion_timer = ContextVar('astcheck_assertion_timer', default=None)
+
+def assert_ast_like(sample, template, _path=None):
+    """Check that the sample AST matches the template.
+    
+    Raises a suitable subclass of :exc:`ASTMismatch` if a difference is detected.
+    
+    The ``_path`` parameter is used for recursion; you shouldn't normally pass it.
+    """
+    if _path is None:
+        timer = _assertion_timer.get()
+        if timer is not None:
+            return timer(_in_match_scope, assert_ast_like, sample, template, ['tree'])
+        return _in_match_scope(assert_ast_like, sample, template, ['tree'])
+
+    # Rather than recursing for each level of the template, keep a stack of
+    # nodes and checkers to check, so deep trees don't hit the recursion
+    # limit. Plain values are compared as soon as their node is reached, but
+    # a difference is put on the stack to raise in its turn. So checks are
+    # done in the same order as recursion would, the same mismatch is found
+    # first, and captures happen before backrefs which use them.
+    stack = [(sample, template, _path)]
+    pop, push = stack.pop, stack.append
+    AST = ast.AST
+    while stack:
+        sample, template, path = pop()
+        if callable(template):
+            # Checker function
+            template(sample, _checker_path(template, path))
+            continue
+
+        if not isinstance(sample, type(template)):
+            if sample is _MISMATCH:
+                raise template
+            raise ASTNodeTypeMismatch(path, sample, template)
+
+        # Push fields in reverse, so they're checked in order
+        for name in reversed(template._fields):
+            template_field = getattr(template, name, None)
+            # From Python 3.9, fields can't be entirely absent, as they could
+            # in earlier versions, so None means unspecified. To specify a field
+            # should be None, use must_not_exist.
+            if template_field is None:
+                continue
+            sample_field = getattr(sample, name)
+            if isinstance(template_field, list):
+                if template_field and (isinstance(template_field[0], AST)
+                                         or callable(template_field[0])):
+                    field_path = (path, name)
+                    if len(sample_field) != len(template_field):
+                        push((_MISMATCH, ASTNodeListMismatch(
+                            field_path, sample_field, template_field), None))
+                    else:
+                        for i in range(len(template_field) - 1, -1, -1):
+                            push((sample_field[i], template_field[i], (field_path, i)))
+                elif sample_field != template_field:
+                    # List of plain values, e.g. 'global' statement names
+                    push((_MISMATCH, ASTPlainListMismatch(
+                        (path, name), sample_field, template_field), None))
+            elif isinstance(template_field, AST) or callable(template_field):
+                push((sample_field, template_field, (path, name)))
+            elif sample_field != template_field:
+                # Single value, e.g. Name.id
+                push((_MISMATCH, ASTPlainObjMismatch(
+                    (path, name), sample_field, template_field), None))
+
+# Non-raising matching
+# --------------------
+# is_ast_like() is mostly called to search for matches, so most calls fail.
+# These functions mirror the checks above, but return False at the first
+# difference rather than building an exception to describe it. Only checker
+# functions without a _matches method still need to raise and catch.
+
+def _checker_passes(checker, sample, path):
+    """Run a checker function, returning False instead of raising ASTMismatch"""
+    matches = getattr(checker, '_matches', None)
+    if matches is not None:
+        return matches(sample, path)
+    elif checker is must_exist:
+        return _exists(sample)
+    elif checker is must_not_exist:
+        return not _exists(sample)
+
+    try:
+        checker(sample, _checker_path(checker, path))
+    except ASTMismatch:
+        return False
+    return True
+
+def _node_items_are_like(path, sample, template, start=0):
+    for i, template_node in enumerate(template, start=start):
+        if not _is_like(sample[i], template_node, (path, i)):
+            return False
+    return True
+
+def _is_like(sample, template, path):
+    if callable(template):
+        return _checker_passes(template, sample, path)
+    if not isinstance(sample, type(template)):
+        return False
+
+    # Like assert_ast_like, this uses a stack rather than recursion. Plain
+    # values can be compared straight away, as only checkers have side
+    # effects (capturing nodes), so only they need to be run in order.
+    stack = []
+    push = stack.append
+    AST = ast.AST
+    while True:
+        # Push fields in reverse, so checkers run in order
+        for name in reversed(template._fields):
+            template_field = getattr(template, name, None)
+            if template_field is None:
+                continue
+            elif isinstance(template_field, list):
+                sample_field = getattr(sample, name)
+                if template_field and (isinstance(template_field[0], AST)
+                                         or callable(template_field[0])):
+                    if len(sample_field) != len(template_field):
+                        return False
+                    field_path = (path, name)
+                    for i in range(len(template_field) - 1, -1, -1):
+                        push((sample_field[i], template_field[i], (field_path, i)))
+                elif sample_field != template_field:
+                    return False
+
+            elif isinstance(template_field, AST) or callable(template_field):
+                push((getattr(sample, name), template_field, (path, name)))
+
+            elif getattr(sample, name) != template_field:
+                return False
+
+        # Run checkers until the next node to look inside
+        while True:
+            if not stack:
+                return True
+            sample, template, path = stack.pop()
+            if callable(template):
+                if not _checker_passes(template, sample, path):
+                    return False
+            elif not isinstance(sample, type(template)):
+                return False
+            else:
+                break
+
+def is_ast_like(sample, template):
+    """Returns True if the sample AST matches the template."""
+    return _in_match_scope(_is_like, sample, template, ['tree'])
+
+def match_ast(sample, template):
+    """Match the sample against the template, and get any captured nodes
+
+    Returns a dict of nodes captured by :class:`capture` placeholders if the
+    sample matches, or None if it doesn't.
+    """
+    return _match_bindings(_is_like, sample, template, ['tree'])
+
+
+# Collecting all mismatches
+# -------------------------
+
+def _limit_reached(found, limit):
+    return (limit is not None) and (len(found) >= limit)
+
+def _find_mismatches(sample, template, path, found, limit):
+    """Add mismatches between sample and template to found, up to limit"""
+    # A stack of checks, as in assert_ast_like, so mismatches are found in
+    # the same order. The last item in each entry is the closest node with a
+    # position, for mismatches in values without one, like names or operators.
+    stack = [(_CHECK_NODE, sample, template, path, None)]
+    pop, push = stack.pop, stack.append
+    while stack and not _limit_reached(found, limit):
+        kind, sample, template, path, owner = pop()
+        nfound = len(found)
+
+        if kind == _CHECK_NODE:
+            find = getattr(template, '_find_mismatches', None)
+            if find is not None:
+                find(sample, path, found, limit)
+            elif callable(template):
+                # Checkers report at most one mismatch
+                try:
+                    template(sample, _checker_path(template, path))
+                except ASTMismatch as e:
+                    found.append(MismatchRecord.from_exception(e))
+            elif not isinstance(sample, type(template)):
+                # Don't look inside a node of the wrong type
+                found.append(MismatchRecord(ASTNodeTypeMismatch, path, sample, template))
+            else:
+                if hasattr(sample, 'lineno'):
+                    owner = sample
+                mark = len(stack)
+                for name, template_field in ast.iter_fields(template):
+                    if isinstance(template_field, list):
+                        if template_field and (isinstance(template_field[0], ast.AST)
+                                                 or callable(template_field[0])):
+                            kind = _CHECK_NODE_LIST
+                        else:
+                            kind = _CHECK_VALUE_LIST
+                    elif isinstance(template_field, ast.AST) or callable(template_field):
+                        kind = _CHECK_NODE
+                    elif template_field is not None:
+                        kind = _CHECK_VALUE
+                    else:
+                        continue
+                    push((kind, getattr(sample, name), template_field,
+                          (path, name), owner))
+                if len(stack) - mark > 1:
+                    stack[mark:] = reversed(stack[mark:])
+
+        elif kind == _CHECK_NODE_LIST:
+            if len(sample) != len(template):
+                # Which items should be compared is unclear, so don't
+                found.append(MismatchRecord(ASTNodeListMismatch, path, sample, template))
+            else:
+                for i in range(len(template) - 1, -1, -1):
+                    push((_CHECK_NODE, sample[i], template[i], (path, i), owner))
+
+        elif kind == _CHECK_VALUE:
+            if sample != template:
+                found.append(MismatchRecord(ASTPlainObjMismatch, path, sample, template))
+
+        elif sample != template:
+            found.append(MismatchRecord(ASTPlainListMismatch, path, sample, template))
+
+        if (owner is not None) and (len(found) > nfound):
+            for record in found[nfound:]:
+                if record.lineno is None:
+                    record.lineno = owner.lineno
+                    record.col_offset = owner.col_offset
+
+def _find_item_mismatches(path, sample, template, found, limit, start=0):
+    for i, template_node in enumerate(template, start=start):
+        _find_mismatches(sample[i], template_node, (path, i), found, limit)
+
+def find_mismatches(sample, template, limit=None):
+    """Find all the differences between the sample and the template
+
+    Returns a list of :class:`MismatchRecord` objects, in the order they're
+    found, or an empty list if the sample matches. Unlike
+    :func:`assert_ast_like`, this carries on after a mismatch, so it can
+    report every problem at once. To avoid reporting many mismatches for one
+    problem, it doesn't look inside nodes of the wrong type, or at the items
+    of a list of the wrong length. Checker functions report at most one
+    mismatch each.
+
+    If *limit* is given, it stops after finding that many mismatches.
+    """
+    found = []
+    _in_match_scope(_find_mismatches, sample, template, ['tree'], found, limit)
+    return found
+
+
+# Compiled templates
+# ------------------
+# Compiling a template walks it once and builds a tree of closures, so the
+# field lookups, type checks and decisions about how to treat each field are
+# made ahead of time. Each closure is called as check(sample, base), where
+# base is the path of the node the whole template is being checked against.
+# The closure knows its own position relative to that (its suffix), so paths
+# are only built when a mismatch is raised or a checker function is called.
+
+def _compile_template(template, suffix):
+    """Build a check function for a template node, checker or helper"""
+    compile_check = getattr(template, '_compile_check', None)
+    if compile_check is not None:
+        return compile_check(suffix)
+
+    if isinstance(template, ast.AST):
+        return _compile_node(template, suffix)
+
+    # The paths are only needed for an error
+    if template is must_exist:
+        def check_exists(sample, base):
+            if not _exists(sample):
+                raise ASTMismatch(_path_list(base) + suffix, sample, "non empty")
+        return check_exists
+    elif template is must_not_exist:
+        def check_not_exists(sample, base):
+            if _exists(sample):
+                raise ASTMismatch(_path_list(base) + suffix, sample, "nothing")
+        return check_not_exists
+
+    if callable(template):
+        def check_with_checker(sample, base):
+            template(sample, _path_list(base) + suffix)
+        return check_with_checker
+
+    # Anything else gets the same treatment as in assert_ast_like
+    def check_interpreted(sample, base):
+        assert_ast_like(sample, template, _extend_path(base, suffix))
+    return check_interpreted
+
+def _compile_node(template, suffix):
+    node_type = type(template)
+    field_checks = []
+    for name, template_field in ast.iter_fields(template):
+        check = _compile_field(template_field, suffix + [name])
+        if check is not None:
+            field_checks.append((attrgetter(name), check))
+    field_checks = tuple(field_checks)
+
+    def check_node(sample, base):
+        if not isinstance(sample, node_type):
+            raise ASTNodeTypeMismatch(_path_list(base) + suffix, sample, template)
+        for get_field, check in field_checks:
+            check(get_field(sample), base)
+    return check_node
+
+def _compile_field(template_field, suffix):
+    """Build a check function for one field of a template node
+
+    Returns None if the field is unspecified and needn't be checked.
+    """
+    if isinstance(template_field, list):
+        if template_field and (isinstance(template_field[0], ast.AST)
+                                 or callable(template_field[0])):
+            return _compile_node_list(template_field, suffix)
+
+        # List of plain values, e.g. 'global' statement names
+        def check_plain_list(sample_field, base):
+            if sample_field != template_field:
+                raise ASTPlainListMismatch(_path_list(base) + suffix,
+                                           sample_field, template_field)
+        return check_plain_list
+
+    elif isinstance(template_field, ast.AST) or callable(template_field):
+        return _compile_template(template_field, suffix)
+
+    elif template_field is not None:
+        # Single value, e.g. Name.id
+        def check_plain_obj(sample_field, base):
+            if sample_field != template_field:
+                raise ASTPlainObjMismatch(_path_list(base) + suffix, sample_field, template_field)
+        return check_plain_obj
+
+    return None
+
+# Set while compiling an instrumented template; see astcheck.instrument
+_instrumentation = ContextVar('astcheck_instrumentation', default=None)
+
+def _compile_test(template, suffix):
+    """Build a test function for a template, returning True if a sample matches"""
+    test = _build_test(template, suffix)
+    instrumentation = _instrumentation.get()
+    if instrumentation is not None:
+        test = instrumentation.wrap_test(test, template, suffix)
+    return test
+
+def _compile_nested_test(template, depth):
+    """Build a test function for a template checked with its own base path
+
+    *depth* is the number of steps from the top of the enclosing template to
+    the samples this one checks.
+    """
+    instrumentation = _instrumentation.get()
+    if instrumentation is None:
+        return _compile_test(template, [])
+    instrumentation.depth += depth
+    try:
+        return _compile_test(template, [])
+    finally:
+        instrumentation.depth -= depth
+
+def _build_test(template, suffix):
+    compile_test = getattr(template, '_compile_test', None)
+    if compile_test is not None:
+        return compile_test(suffix)
+
+    if isinstance(template, ast.AST):
+        return _compile_node_test(template, suffix)
+
+    if template is must_exist:
+        def test_exists(sample, base):
+            return _exists(sample)
+        return test_exists
+    elif template is must_not_exist:
+        def test_not_exists(sample, base):
+            return not _exists(sample)
+        return test_not_exists
+    elif callable(template):
+        def test_with_checker(sample, base):
+            return _checker_passes(template, sample, _extend_path(base, suffix))
+        return test_with_checker
+
+    def test_interpreted(sample, base):
+        return _is_like(sample, template, _extend_path(base, suffix))
+    return test_interpreted
+
+def _compile_node_test(template, suffix):
+    node_type = type(template)
+    field_tests = []
+    for name, template_field in ast.iter_fields(template):
+        test = _compile_field_test(template_field, suffix + [name])
+        if test is not None:
+            field_tests.append((attrgetter(name), test))
+    field_tests = tuple(field_tests)
+
+    def test_node(sample, base):
+        if not isinstance(sample, node_type):
+            return False
+        for get_field, test in field_tests:
+            if not test(get_field(sample), base):
+                return False
+        return True
+    return test_node
+
+def _compile_field_test(template_field, suffix):
+    if isinstance(template_field, list):
+        if template_field and (isinstance(template_field[0], ast.AST)
+                                 or callable(template_field[0])):
+            return _compile_node_list_test(template_field, suffix)
+
+    elif isinstance(template_field, ast.AST) or callable(template_field):
+        return _compile_test(template_field, suffix)
+
+    elif template_field is None:
+        return None
+
+    # Plain value or list of plain values
+    def test_plain(sample_field, base):
+        return sample_field == template_field
+    return test_plain
+
+def _compile_node_list_test(template, suffix):
+    ntemplate = len(template)
+    item_tests = tuple(_compile_test(template_node, suffix + [i])
+                       for i, template_node in enumerate(template))
+
+    def test_node_list(sample, base):
+        if len(sample) != ntemplate:
+            return False
+        for sample_node, test in zip(sample, item_tests):
+            if not test(sample_node, base):
+                return False
+        return True
+    return test_node_list
+
+def _compile_node_items_test(template, suffix, start=0):
+    item_tests = tuple((i, _compile_test(template_node, suffix + [i]))
+                       for i, template_node in enumerate(template, start=start))
+
+    def test_node_items(sample, base):
+        for i, test in item_tests:
+            if not test(sample[i], base):
+                return False
+        return True
+    return test_node_items
+
+def _compile_node_items(template, suffix, start=0):
+    """Build a check function for list items from *start*, ignoring length"""
+    item_checks = tuple((i, _compile_template(template_node, suffix + [i]))
+                        for i, template_node in enumerate(template, start=start))
+
+    def check_node_items(sample, base):
+        for i, check in item_checks:
+            check(sample[i], base)
+    return check_node_items
+
+def _compile_node_list(template, suffix):
+    """Build a check function for a list of nodes, e.g. function body"""
+    ntemplate = len(template)
+    item_checks = tuple(_compile_template(template_node, suffix + [i])
+                        for i, template_node in enumerate(template))
+
+    def check_node_list(sample, base):
+        if len(sample) != ntemplate:
+            raise ASTNodeListMismatch(_path_list(base) + suffix, sample, template)
+        for sample_node, check in zip(sample, item_checks):
+            check(sample_node, base)
+    return check_node_list
+
+_MAX_COMPILE_DEPTH = 100
+
+def _deeper_than(template, limit):
+    """Does the template have more than *limit* levels of nesting?"""
+    stack = [(template, 0)]
+    while stack:
+        template, depth = stack.pop()
+        if depth > limit:
+            return True
+        if isinstance(template, ast.AST):
+            children = [value for name, value in ast.iter_fields(template)]
+        elif isinstance(template, list):
+            children = template
+        else:
+            subtemplates = getattr(template, '_subtemplates', None)
+            children = subtemplates() if subtemplates is not None else []
+        stack.extend((child, depth + 1) for child in children
+                     if isinstance(child, (ast.AST, list)) or hasattr(child, '_subtemplates'))
+    return False
+
+class CompiledTemplate(object):
+    """A template prepared for checking many samples
+
+    Create these with :func:`compile`. A compiled template can also be used as
+    a checker function inside another template.
+    """
+    def __init__(self, template):
+        self.template = template
+        if _deeper_than(template, _MAX_COMPILE_DEPTH):
+            # Compiled checks call each other for each level of the template,
+            # so very deep templates use the interpreted functions instead.
+            def check(sample, base):
+                assert_ast_like(sample, template, base)
+            def test(sample, base):
+                return _is_like(sample, template, base)
+            self._check, self._test = check, test
+        else:
+            self._check = _compile_template(template, [])
+            self._test = _compile_test(template, [])
+        self._required_types = required_node_types(template)
+        self._uses_bindings = _uses_bindings(template)
+
+    def __repr__(self):
+        return "astcheck.compile(%r)" % (self.template,)
+
+    def __reduce__(self):
+        # The compiled closures can't be pickled, e.g. to send to worker
+        # processes, so compile the template again when unpickling.
+        return (CompiledTemplate, (self.template,))
+
+    def _top_test(self, sample, base):
+        """Test a sample, with its own set of captures if needed"""
+        if self._uses_bindings:
+            return _in_match_scope(self._test, sample, base)
+        return self._test(sample, base)
+
+    @property
+    def _node_types(self):
+        return _root_types(self.template)
+
+    def _subtemplates(self):
+        return [self.template]
+
+    def _add_required_names(self, names):
+        _add_required_names(self.template, names)
+
+    def _add_required_types(self, types):
+        _add_required_types(self.template, types)
+
+    def __call__(self, node, path):
+        self._check(node, path)
+
+    def _matches(self, node, path):
+        return self._test(node, path)
+
+    def assert_ast_like(self, sample):
+        """Check that the sample AST matches the template.
+
+        Raises the same :exc:`ASTMismatch` subclasses as :func:`assert_ast_like`.
+        """
+        timer = _assertion_timer.get()
+        if timer is not None:
+            return timer(self._assert_ast_like, sample)
+        self._assert_ast_like(sample)
+
+    def _assert_ast_like(self, sample):
+        if self._uses_bindings:
+            _in_match_scope(self._check, sample, ['tree'])
+        else:
+            self._check(sample, ['tree'])
+
+    def is_ast_like(self, sample):
+        """Returns True if the sample AST matches the template."""
+        return self._top_test(sample, _ROOT_PATH)
+
+    def match(self, sample):
+        """Returns a dict of captured nodes if the sample matches, or None
+
+        See :func:`match_ast`.
+        """
+        return _match_bindings(self._test, sample, _ROOT_PATH)
+
+    def find_mismatches(self, sample, limit=None):
+        """Returns a list of all the mismatches, as for :func:`find_mismatches`"""
+        return find_mismatches(sample, self.template, limit)
+
+def compile(template):
+    """Prepare a template to check against many samples.
+
+    Returns a :class:`CompiledTemplate`, whose methods behave like
+    :func:`assert_ast_like` and :func:`is_ast_like`, but don't need to work
+    out how to check each part of the template every time they are called.
+    The template should not be modified after it is compiled.
+    """
+    return CompiledTemplate(template)
+
+
+# Pattern templates
+# -----------------
+
+# '__x' captures as 'x', but dunder names like '__init__' are left alone
+_CAPTURE_NAME = re.compile(r'__([^\W_]\w*)\Z')
+
+def _wildcard_name(node):
+    """Get the identifier if a pattern node is only a name, else None"""
+    if isinstance(node, ast.Expr):
+        node = node.value
+    elif isinstance(node, ast.keyword) and node.arg is None:
+        node = node.value  # **name
+    if isinstance(node, ast.Name):
+        return node.id
+    elif isinstance(node, ast.arg):
+        return node.arg
+    return None
+
+def _wildcard_template(name, in_list):
+    """Get the template for a wildcard name, or node itself if it's not one"""
+    if name == '__':
+        # In a list, it must stand for one item
+        return ast.AST() if in_list else None
+    elif name == '___':
+        raise ValueError("___ can only stand for part of a list")
+    m = _CAPTURE_NAME.match(name)
+    if m and not name.endswith('__'):
+        return capture(m.group(1))
+    return _NOT_WILDCARD
+
+_NOT_WILDCARD = object()
+
+def _pattern_template(node, in_list=False):
+    """Replace wildcards in a tree parsed from a pattern, in place"""
+    name = _wildcard_name(node)
+    if name is not None:
+        template = _wildcard_template(name, in_list)
+        if template is not _NOT_WILDCARD:
+            return template
+
+    if isinstance(node, ast.arguments):
+        # Default values can't be written in the pattern for arguments
+        # matched by ___, so only check the defaults which are written.
+        if any(_wildcard_name(arg) == '___' for arg in node.posonlyargs + node.args):
+            if (len(node.args) == 1) and not (node.posonlyargs or node.kwonlyargs
+                                              or node.vararg or node.kwarg):
+                return ast.AST() if in_list else None  # def f(___): any arguments
+            node.defaults = listmiddle(back=[_pattern_template(default, in_list=True)
+                                             for default in node.defaults])
+        if any(_wildcard_name(arg) == '___' for arg in node.kwonlyargs):
+            node.kw_defaults = None
+
+    identifier_fields = _IDENTIFIER_FIELDS.get(type(node), ())
+    for field, value in ast.iter_fields(node):
+        if isinstance(value, list):
+            setattr(node, field, _pattern_list(value))
+        elif isinstance(value, ast.AST):
+            setattr(node, field, _pattern_template(value))
+        elif isinstance(value, str) and (field in identifier_fields):
+            template = _wildcard_template(value, False)
+            if template is not _NOT_WILDCARD:
+                setattr(node, field, template)
+    return node
+
+def _pattern_list(items):
+    if not any(_wildcard_name(item) == '___' for item in items):
+        return [_pattern_template(item, in_list=True) if isinstance(item, ast.AST) else item
+                for item in items]
+
+    # Split into runs of items between list wildcards
+    runs = [[]]
+    for item in items:
+        if _wildcard_name(item) == '___':
+            runs.append([])
+        else:
+            runs[-1].append(_pattern_template(item, in_list=True))
+
+    front, back = runs[0], runs[-1]
+    middle = [run for run in runs[1:-1] if run]
+    if not middle:
+        return listmiddle(front, back)
+    elif not (front or back):
+        if len(middle) == 1:
+            return listcontains(middle[0])
+        elif all(len(run) == 1 for run in middle):
+            return listcontains([run[0] for run in middle], gaps=True)
+    raise ValueError("Can't make a template for this list: ___ can be used at "
+                     "the start and end, or around single items")
+
+def pattern(source):
+    """Make a template from a pattern written as Python code
+
+    The pattern may be an expression, or one or more statements. Names are
+    used as wildcards:
+
+    - ``__`` matches anything at that position, including nothing for
+      optional parts, like ``*__`` in a function definition.
+    - ``__name`` matches anything, and captures it as ``name``, as
+      :class:`capture` would. Using the same name twice requires the same
+      structure in both places.
+    - ``___`` matches any number of items in a list, e.g. arguments in
+      ``f(x, ___)``, or statements on a line by themselves. It's turned into
+      :class:`listmiddle` or :class:`listcontains`.
+
+    Everything else must be the same as in the pattern, including empty
+    lists, so ``f(___)`` only matches calls without keyword arguments; use
+    ``f(___, **___)`` to allow them. The exception is default values for
+    arguments matched by ``___``, which can't be written in the pattern;
+    ``def f(___): ___`` matches a function with any arguments. Several statements make an
+    :class:`ast.Module` template.
+    """
+    source = textwrap.dedent(source)
+    try:
+        nodes = [ast.parse(source, mode='eval').body]
+    except SyntaxError:
+        nodes = ast.parse(source).body
+
+    if len(nodes) == 1:
+        return _pattern_template(nodes[0], in_list=True)
+    return ast.Module(body=_pattern_list(nodes), type_ignores=[])
+
+@functools.lru_cache(maxsize=256)
+def compile_pattern(source):
+    """Make a template from a pattern and compile it, caching the result
+
+    Returns a :class:`CompiledTemplate` for :func:`pattern`. The most recently
+    used patterns are kept, so calling this repeatedly with the same pattern
+    text is fast.
+    """
+    return CompiledTemplate(pattern(source))
+
+def match(source, sample):
+    """Match a sample against a pattern written as Python code
+
+    Returns a dict of nodes captured by ``__name`` wildcards if the sample
+    matches, or None if it doesn't, like :func:`match_ast`. E.g.::
+
+        astcheck.match("open(__path, ___)", node)
+
+    The compiled pattern is cached; see :func:`compile_pattern`.
+    """
+    return compile_pattern(source).match(sample)
+
+
+# Searching trees
+# ---------------
+
+def _root_types(template):
+    """Get a tuple of the node types which could match the template
+
+    Returns None if any node might match, e.g. for a checker function.
+    """
+    if isinstance(template, ast.AST):
+        return (type(template),)
+    return getattr(template, '_node_types', None)
+
+def _move_before(fields, name, before):
+    if (name in fields) and (before in fields):
+        fields.remove(name)
+        fields.insert(fields.index(before), name)
+
+def _source_fields(cls):
+    """Get the fields of a node class in the order they appear in the source"""
+    fields = list(cls._fields)
+    if 'decorator_list' in fields:
+        fields.remove('decorator_list')
+        fields.insert(0, 'decorator_list')
+    _move_before(fields, 'type_params', 'args')    # def f[T](...)
+    _move_before(fields, 'type_params', 'bases')   # class C[T](...)
+    _move_before(fields, 'returns', 'body')
+    _move_before(fields, 'body', 'test')           # a if b else c
+    return tuple(fields)
+
+# Some nodes' children can't be put in source order by reordering fields,
+# because items of two list fields are mixed together. These functions list
+# (child, step) pairs for such a node in source order, or return None if the
+# fields are already in order.
+
+def _child_steps(node, step, fields):
+    """List (child, step) pairs for the nodes in these fields, in order"""
+    children = []
+    for name in fields:
+        value = getattr(node, name, None)
+        if isinstance(value, ast.AST):
+            children.append((value, (step, name)))
+        elif isinstance(value, list):
+            field_step = (step, name)
+            children.extend((item, (field_step, i)) for i, item in enumerate(value)
+                            if isinstance(item, ast.AST))
+    return children
+
+def _interleaved(first, second):
+    """Make a function listing items from two fields alternately
+
+    E.g. each key of a Dict comes before its value. None items are skipped,
+    such as the key for ``**d``.
+    """
+    def interleaved_children(node, step):
+        first_items, first_step = getattr(node, first), (step, first)
+        second_step = (step, second)
+        children = []
+        for i, item in enumerate(getattr(node, second)):
+            if first_items[i] is not None:
+                children.append((first_items[i], (first_step, i)))
+            children.append((item, (second_step, i)))
+        return children
+    return interleaved_children
+
+_interleave_ops = _interleaved('ops', 'comparators')
+
+def _compare_children(node, step):
+    # a < b < c: each operator comes before the value it compares with
+    if len(node.ops) < 2:
+        return None
+    return [(node.left, (step, 'left'))] + _interleave_ops(node, step)
+
+def _position(node):
+    if isinstance(node, ast.keyword) and getattr(node, 'lineno', None) is None:
+        node = node.value  # keywords have positions from Python 3.9
+    lineno = getattr(node, 'lineno', None)
+    return None if lineno is None else (lineno, node.col_offset)
+
+def _arguments_in_order(node, step, fields, args_field):
+    # *args can come after keyword arguments, as in f(x=1, *a), so the
+    # arguments are sorted by position if they may be mixed.
+    if not (node.keywords and any(isinstance(arg, ast.Starred)
+                                  for arg in getattr(node, args_field))):
+        return None
+    children = []
+    for name in fields:
+        if name == args_field:
+            arguments = _child_steps(node, step, [args_field, 'keywords'])
+            positions = [_position(arg) for arg, arg_step in arguments]
+            if None not in positions:
+                arguments = [arg for position, arg in sorted(
+                    zip(positions, arguments), key=lambda pair: pair[0])]
+            children += arguments
+        elif name != 'keywords':
+            children += _child_steps(node, step, [name])
+    return children
+
+_class_fields = _source_fields(ast.ClassDef)
+
+def _call_children(node, step):
+    return _arguments_in_order(node, step, ast.Call._fields, 'args')
+
+def _classdef_children(node, step):
+    return _arguments_in_order(node, step, _class_fields, 'bases')
+
+def _arguments_children(node, step):
+    # Each default value comes after the argument it belongs to
+    if not (node.defaults or any(node.kw_defaults)):
+        return None
+    positional = _child_steps(node, step, ['posonlyargs', 'args'])
+    defaults = _child_steps(node, step, ['defaults'])
+    first_default = len(positional) - len(defaults)
+    children = []
+    for i, arg in enumerate(positional):
+        children.append(arg)
+        if i >= first_default:
+            children.append(defaults[i - first_default])
+    children += _child_steps(node, step, ['vararg'])
+    kwonly_step, kw_defaults_step = (step, 'kwonlyargs'), (step, 'kw_defaults')
+    for i, arg in enumerate(node.kwonlyargs):
+        children.append((arg, (kwonly_step, i)))
+        if node.kw_defaults[i] is not None:  # None for no default
+            children.append((node.kw_defaults[i], (kw_defaults_step, i)))
+    children += _child_steps(node, step, ['kwarg'])
+    return children
+
+# Node classes whose fields aren't listed in source code order:
+# class -> (fields in order, function listing children in order, or None)
+_SOURCE_ORDER = {
+    ast.Dict: (ast.Dict._fields, _interleaved('keys', 'values')),
+    ast.Compare: (ast.Compare._fields, _compare_children),
+    ast.Call: (ast.Call._fields, _call_children),
+    ast.ClassDef: (_class_fields, _classdef_children),
+    ast.arguments: (ast.arguments._fields, _arguments_children),
+}
+for _cls in [ast.FunctionDef, ast.AsyncFunctionDef, ast.IfExp]:
+    _SOURCE_ORDER[_cls] = (_source_fields(_cls), None)
+if hasattr(ast, 'MatchMapping'):  # Python 3.10+
+    _SOURCE_ORDER[ast.MatchMapping] = (ast.MatchMapping._fields,
+                                       _interleaved('keys', 'patterns'))
+del _cls
+
+def _walk(tree):
+    """Iterate over (node, step) for each node in the tree, parents first
+
+    Child nodes are visited in the order they appear in the source code, e.g.
+    decorators before the function they decorate. *step* is the path to the
+    node, as nested tuples like those built while matching; use _path_list()
+    to turn it into a list if it's needed.
+    """
+    stack = [(tree, _ROOT_PATH)]
+    pop, push = stack.pop, stack.append
+    AST = ast.AST
+    source_order = _SOURCE_ORDER
+    while stack:
+        node, step = pop()
+        yield node, step
+
+        order = source_order.get(type(node))
+        if order is None:
+            fields = node._fields
+        else:
+            fields, list_children = order
+            children = None if list_children is None else list_children(node, step)
+            if children is not None:
+                stack.extend(reversed(children))
+                continue
+
+        # Push children in reverse, so they're popped in order
+        for name in reversed(fields):
+            value = getattr(node, name, None)
+            if isinstance(value, AST):
+                push((value, (step, name)))
+            elif isinstance(value, list) and value:
+                field_step = (step, name)
+                for i in range(len(value) - 1, -1, -1):
+                    item = value[i]
+                    if isinstance(item, AST):
+                        push((item, (field_step, i)))
+
+class TreeIndex(object):
+    """An index of the nodes in a tree, by type
+
+    Build this once to run several searches over the same tree: pass it to
+    :func:`iter_matches`, :func:`find_all` or :meth:`RuleSet.iter_matches` in
+    place of the tree, and they will only look at nodes of suitable types.
+    The tree should not be modified after it has been indexed.
+    """
+    def __init__(self, tree):
+        self.tree = tree
+        # Nodes in the order they're visited; other structures refer to
+        # positions in this list, because context and operator nodes such as
+        # ast.Load() may be shared between several places in the tree.
+        self._nodes = []
+        self._steps = []
+        self._by_type = {}
+        self._parents = {tree: None}
+        for i, (node, step) in enumerate(_walk(tree)):
+            self._nodes.append(node)
+            self._steps.append(step)
+            self._by_type.setdefault(type(node), []).append(i)
+            for child in ast.iter_child_nodes(node):
+                self._parents.setdefault(child, node)
+        self._positions = {}
+        for i, node in enumerate(self._nodes):
+            self._positions.setdefault(node, i)
+        self._node_types = None
+        self._table = None  # StructureTable, made when first needed
+        self._by_fingerprint = None
+
+    def __repr__(self):
+        return "<astcheck.TreeIndex of %d nodes>" % len(self)
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def __contains__(self, node):
+        return node in self._positions
+
+    @property
+    def node_types(self):
+        """The node classes in the tree, as for :func:`node_types_present`"""
+        if self._node_types is None:
+            self._node_types = _with_base_classes(self._by_type)
+        return self._node_types
+
+    def nodes(self, *node_types):
+        """Iterate over nodes of the given types, including subclasses
+
+        Nodes are in the order :func:`iter_matches` would visit them. With no
+        arguments, this iterates over all nodes in the tree.
+        """
+        nodes = self._nodes
+        return (nodes[i] for i in self._candidates(node_types or None))
+
+    def parent(self, node):
+        """Get the parent node of *node*, or None for the root of the tree
+
+        Context and operator nodes such as :class:`ast.Load` may be shared
+        between several places in a tree; for these, :meth:`parent` and
+        :meth:`path` refer to the first place they're used.
+        """
+        return self._parents[node]
+
+    def path(self, node):
+        """Get the path from the root of the tree to *node*, as a list"""
+        return _path_list(self._steps[self._positions[node]])
+
+    def same_structure(self, node):
+        """Find nodes in the tree with the same structure as *node*
+
+        *node* may come from this tree or elsewhere. Positions and expression
+        contexts are ignored, as for :class:`backref`. The first call
+        fingerprints the whole tree (see :class:`StructureTable`), so later
+        calls only need to fingerprint *node* and look it up. Nodes are in
+        the order :func:`iter_matches` would visit them.
+        """
+        if self._by_fingerprint is None:
+            self._table = StructureTable()
+            nodes, parents, fingerprints = self._table._fingerprint_tree(self.tree)
+            fingerprint_of = dict(zip(nodes, fingerprints))
+            by_fingerprint = {}
+            for i, tree_node in enumerate(self._nodes):
+                fp = fingerprint_of.get(tree_node)
+                if fp is not None:  # Not for expression contexts
+                    by_fingerprint.setdefault(fp, []).append(i)
+            self._by_fingerprint = by_fingerprint
+        tree_nodes = self._nodes
+        return [tree_nodes[i] for i in
+                self._by_fingerprint.get(self._table.fingerprint(node), ())]
+
+    def _candidates(self, node_types):
+        """Iterate over positions of nodes which are instances of node_types"""
+        if node_types is None:
+            return iter(range(len(self._nodes)))
+        classes = [cls for cls in self._by_type if issubclass(cls, node_types)]
+        return self._merge(classes)
+
+    def _merge(self, classes):
+        """Iterate over positions of nodes of exactly these classes, in order"""
+        if len(classes) == 1:
+            return iter(self._by_type[classes[0]])
+        return heapq.merge(*[self._by_type[cls] for cls in classes])
+
+# Comparing structure
+# -------------------
+
+class StructureTable(object):
+    """Fingerprints for the structure of subtrees, shared between trees
+
+    Nodes with the same structure get the same fingerprint (an int) from the
+    same table. As for :class:`backref`, positions and expression contexts
+    (Load, Store, Del) are ignored. Each distinct structure is stored once,
+    in terms of the fingerprints of its children, so fingerprinting a tree
+    takes time in proportion to its size, and equal fingerprints always mean
+    equal structure. The table only grows with the number of distinct
+    subtrees, so one table can be used for a large corpus.
+    """
+    def __init__(self):
+        self._ids = {}    # Key made from children's fingerprints -> fingerprint
+        self._sizes = []  # Number of nodes, by fingerprint
+
+    def __repr__(self):
+        return "<astcheck.StructureTable of %d structures>" % len(self)
+
+    def __len__(self):
+        return len(self._sizes)
+
+    def fingerprint(self, node):
+        """Get the fingerprint for *node*"""
+        nodes, parents, fingerprints = self._fingerprint_tree(node)
+        return fingerprints[0]
+
+    def size(self, fingerprint):
+        """The number of nodes in subtrees with this fingerprint
+
+        Expression context nodes aren't counted.
+        """
+        return self._sizes[fingerprint]
+
+    def _fingerprint_tree(self, tree):
+        """Fingerprint every node in a tree
+
+        Returns lists of nodes, the positions of their parents (-1 for the
+        root) and their fingerprints, with parents before their children.
+        """
+        AST = ast.AST
+        nodes, parents = [], []
+        stack = [(tree, -1)]
+        pop, push = stack.pop, stack.append
+        while stack:
+            node, parent = pop()
+            pos = len(nodes)
+            nodes.append(node)
+            parents.append(parent)
+            for name in node._fields:
+                if name == 'ctx':
+                    continue
+                value = getattr(node, name, None)
+                if isinstance(value, AST):
+                    push((value, pos))
+                elif isinstance(value, list):
+                    for item in value:
+                        if isinstance(item, AST):
+                            push((item, pos))
+
+        # Working backwards, each node comes after all of its children
+        ids, sizes = self._ids, self._sizes
+        fingerprints = [0] * len(nodes)
+        fingerprint_of = {}
+        for i in range(len(nodes) - 1, -1, -1):
+            node = nodes[i]
+            key = [type(node)]
+            size = 1
+            for name in node._fields:
+                if name == 'ctx':
+                    continue
+                value = getattr(node, name, None)
+                if isinstance(value, AST):
+                    fp = fingerprint_of[value]
+                    key.append(fp)
+                    size += sizes[fp]
+                elif isinstance(value, list):
+                    items = []
+                    for item in value:
+                        if isinstance(item, AST):
+                            fp = fingerprint_of[item]
+                            items.append(fp)
+                            size += sizes[fp]
+                        else:
+                            items.append(_value_key(item))
+                    key.append((list, tuple(items)))
+                else:
+                    key.append(_value_key(value))
+
+            key = tuple(key)
+            fp = ids.get(key)
+            if fp is None:
+                fp = ids[key] = len(sizes)
+                sizes.append(size)
+            fingerprint_of[node] = fingerprints[i] = fp
+        return nodes, parents, fingerprints
+
+def find_duplicates(trees, min_nodes=10):
+    """Find subtrees which occur more than once in a set of trees
+
+    *trees* is a dict mapping labels, such as file names, to trees, or an
+    iterable of ``(label, tree)`` pairs. Subtrees are compared by structure,
+    ignoring positions and expression contexts, and only those with at least
+    *min_nodes* nodes are considered.
+
+    Returns a list of groups, largest subtrees first. Each group is a list of
+    ``(label, node)`` pairs for nodes with the same structure. A duplicated
+    subtree isn't reported separately if every copy of it is part of a larger
+    duplicate.
+    """
+    if isinstance(trees, dict):
+        trees = trees.items()
+    table = StructureTable()
+    sizes = table._sizes
+    # fingerprint -> [(label, node, parent's fingerprint)]
+    occurrences = {}
+    for label, tree in trees:
+        nodes, parents, fingerprints = table._fingerprint_tree(tree)
+        for node, parent, fp in zip(nodes, parents, fingerprints):
+            if sizes[fp] >= min_nodes:
+                parent_fp = fingerprints[parent] if parent >= 0 else None
+                occurrences.setdefault(fp, []).append((label, node, parent_fp))
+
+    duplicated = {fp for fp, found in occurrences.items() if len(found) > 1}
+    groups = []
+    for fp, found in occurrences.items():
+        if (fp in duplicated) and any(parent_fp not in duplicated
+                                      for _, _, parent_fp in found):
+            groups.append((sizes[fp], [(label, node) for label, node, _ in found]))
+    groups.sort(key=lambda group: group[0], reverse=True)
+    return [group for size, group in groups]
+
+def iter_matches(tree, template):
+    """Find all the nodes in *tree* which match *template*
+
+    Yields ``(node, path)`` tuples, in the order nodes appear in the tree.
+    *path* is a list describing how to get to the node from the root of the
+    tree, like those in :exc:`ASTMismatch`. Each node is checked as
+    :func:`is_ast_like` would check it. Nodes which can't match the type at
+    the top of the template are skipped without checking any further.
+
+    *tree* may also be a :class:`TreeIndex`. In this case, if the tree
+    doesn't contain all the node types in :func:`required_node_types`, no
+    nodes are checked.
+    """
+    if not isinstance(template, CompiledTemplate):
+        template = CompiledTemplate(template)
+    test = template._top_test
+    node_types = _root_types(template)
+
+    if isinstance(tree, TreeIndex):
+        if not (template._required_types <= tree.node_types):
+            return
+        nodes, steps = tree._nodes, tree._steps
+        for i in tree._candidates(node_types):
+            if test(nodes[i], _ROOT_PATH):
+                yield nodes[i], _path_list(steps[i])
+        return
+
+    for node, step in _walk(tree):
+        if (node_types is not None) and not isinstance(node, node_types):
+            continue
+        if test(node, _ROOT_PATH):
+            yield node, _path_list(step)
+
+def find_all(tree, template):
+    """Return a list of all the nodes in *tree* which match *template*
+
+    Nodes are in the order they appear in the tree. *tree* may also be a
+    :class:`TreeIndex`. See :func:`iter_matches`.
+    """
+    return [node for node, path in iter_matches(tree, template)]
+
+class RuleSet(object):
+    """A collection of templates to search for together
+
+    *rules* is a dict mapping rule IDs to templates, or an iterable of
+    ``(rule_id, template)`` pairs. Searching a tree with a rule set walks it
+    once, checking each node only against the rules whose template could
+    match its type.
+    """
+    def __init__(self, rules):
+        if isinstance(rules, dict):
+            rules = rules.items()
+        self.rules = []
+        for rule_id, template in rules:
+            if not isinstance(template, CompiledTemplate):
+                template = CompiledTemplate(template)
+            self.rules.append((rule_id, template))
+
+        # Dispatch table from concrete node classes to the rules to check,
+        # filled in as each class is first seen.
+        self._by_type = {}
+
+    def __repr__(self):
+        return "astcheck.RuleSet(%r)" % (self.rules,)
+
+    def __reduce__(self):
+        return (RuleSet, (self.rules,))
+
+    def __len__(self):
+        return len(self.rules)
+
+    def _rules_for_type(self, node_type):
+        rules = self._by_type.get(node_type)
+        if rules is not None:
+            return rules
+
+        rules = []
+        for rule_id, template in self.rules:
+            node_types = _root_types(template)
+            if (node_types is None) or issubclass(node_type, node_types):
+                rules.append((rule_id, template._top_test, template._required_types))
+        self._by_type[node_type] = rules
+        return rules
+
+    def iter_matches(self, tree):
+        """Find all matches for all rules in *tree*
+
+        Yields ``(rule_id, node, path)`` tuples, ordered by node as in
+        :func:`iter_matches`, and then in the order the rules were given.
+        *tree* may also be a :class:`TreeIndex`. In this case, rules are only
+        checked if the tree contains all their :func:`required_node_types`.
+        """
+        if isinstance(tree, TreeIndex):
+            present = tree.node_types
+            by_type = {}
+            for cls in tree._by_type:
+                rules = [rule for rule in self._rules_for_type(cls)
+                         if rule[2] <= present]
+                if rules:
+                    by_type[cls] = rules
+            nodes = ((tree._nodes[i], tree._steps[i]) for i in tree._merge(list(by_type)))
+        else:
+            by_type = self._by_type
+            nodes = _walk(tree)
+
+        for node, step in nodes:
+            rules = by_type.get(type(node))
+            if rules is None:
+                rules = self._rules_for_type(type(node))
+            for rule_id, test, _ in rules:
+                if test(node, _ROOT_PATH):
+                    yield rule_id, node, _path_list(step)
+
+
+# Template analysis
+# -----------------
+
+# Fields holding identifiers, which appear literally in the source code
+_IDENTIFIER_FIELDS = {}
+for _cls_name, _field in [
+        ('Name', 'id'), ('Attribute', 'attr'), ('arg', 'arg'), ('keyword', 'arg'),
+        ('FunctionDef', 'name'), ('AsyncFunctionDef', 'name'), ('ClassDef', 'name'),
+        ('alias', 'name'), ('alias', 'asname'), ('ImportFrom', 'module'),
+        ('Global', 'names'), ('Nonlocal', 'names'), ('ExceptHandler', 'name'),
+        ('MatchAs', 'name'), ('MatchStar', 'name'), ('MatchMapping', 'rest'),
+        ('MatchClass', 'kwd_attrs'), ('TypeVar', 'name'), ('ParamSpec', 'name'),
+        ('TypeVarTuple', 'name'),
+    ]:
+    if hasattr(ast, _cls_name):
+        _IDENTIFIER_FIELDS.setdefault(getattr(ast, _cls_name), set()).add(_field)
+del _cls_name, _field
+
+def _add_identifier(value, names):
+    # Dotted module names may have spaces around the dots, e.g. 'import a . b'
+    names.update(part for part in value.split('.') if part)
+
+def _add_required_names(template, names):
+    stack = [template]
+    while stack:
+        template = stack.pop()
+        if not isinstance(template, ast.AST):
+            add_names = getattr(template, '_add_required_names', None)
+            if add_names is not None:
+                add_names(names)
+            continue
+
+        identifier_fields = _IDENTIFIER_FIELDS.get(type(template), ())
+        for name, template_field in ast.iter_fields(template):
+            if name in identifier_fields:
+                if isinstance(template_field, str):
+                    _add_identifier(template_field, names)
+                elif isinstance(template_field, list):
+                    for item in template_field:
+                        if isinstance(item, str):
+                            _add_identifier(item, names)
+
+            if isinstance(template_field, list):
+                stack.extend(template_field)
+            else:
+                stack.append(template_field)
+
+def required_names(template):
+    """Find identifiers which must appear in any code matching *template*
+
+    These include names, attribute names, function & argument names and
+    imported modules specified in the template, including those inside
+    :class:`name_or_attr`, :class:`single_assign` and :class:`listmiddle`.
+    If source code doesn't contain one of these strings, it can't match the
+    template, so there's no need to parse it. Checker functions are assumed
+    not to require any names.
+
+    Returns a frozenset of strings.
+    """
+    names = set()
+    _add_required_names(template, names)
+    return frozenset(names)
+
+def _add_required_types(template, types):
+    stack = [template]
+    while stack:
+        template = stack.pop()
+        if not isinstance(template, ast.AST):
+            add_types = getattr(template, '_add_required_types', None)
+            if add_types is not None:
+                add_types(types)
+            continue
+
+        types.add(type(template))
+        for name, template_field in ast.iter_fields(template):
+            if isinstance(template_field, list):
+                stack.extend(template_field)
+            else:
+                stack.append(template_field)
+
+def required_node_types(template):
+    """Find the node classes which must be present in a match for *template*
+
+    E.g. ``ast.For(orelse=astcheck.must_exist)`` requires an :class:`ast.For`
+    node. Helpers like :class:`name_or_attr`, which allow a choice of node
+    types, don't require any particular one. Compare the result with
+    :func:`node_types_present` to rule out trees which can't contain a match::
+
+        if astcheck.required_node_types(template) <= astcheck.node_types_present(tree):
+            ...
+
+    Returns a frozenset of classes.
+    """
+    types = set()
+    _add_required_types(template, types)
+    return frozenset(types)
+
+def _with_base_classes(classes):
+    present = set()
+    for cls in classes:
+        present.update(cls.__mro__)
+    return frozenset(present)
+
+def node_types_present(tree):
+    """Get the node classes used in *tree*, and their base classes
+
+    Base classes such as :class:`ast.stmt` are included, so this can be
+    compared directly with :func:`required_node_types`. *tree* may also be a
+    :class:`TreeIndex`, which keeps this information ready.
+    """
+    if isinstance(tree, TreeIndex):
+        return tree.node_types
+    return _with_base_classes({type(node) for node in ast.walk(tree)})
@@ -0,0 +1,250 @@
+"""An on-disk cache of scan results
+
+Scanning the same files repeatedly, e.g. in CI, spends most of its time
+parsing and checking files which haven't changed. A :class:`ResultCache`
+stores the matches found in each file, keyed by a hash of the source code,
+the Python version and the rules, so unchanged files aren't parsed at all.
+"""
+import ast
+import functools
+import hashlib
+import json
+import os
+import re
+import sys
+import tempfile
+import types
+
+import astcheck
+from . import CompiledTemplate
+
+# Different Python versions can produce different trees for the same code.
+_PYTHON_TAG = '{}-{}.{}.{}'.format(sys.implementation.name, *sys.version_info[:3])
+
+_PLAIN_TYPES = (str, bytes, int, float, complex, bool, type(None), type(Ellipsis))
+
+def _describe_code(code, parts, stack):
+    parts += (code.co_name, code.co_code.hex(), repr(code.co_names),
+              len(code.co_consts))
+    stack.extend(reversed(code.co_consts))
+
+def _describe_function(func, parts, stack):
+    parts += (func.__module__, func.__qualname__)
+    if func.__module__ is not None and func.__module__.startswith('astcheck'):
+        return  # Covered by the astcheck version
+    _describe_code(func.__code__, parts, stack)
+    cells = [cell.cell_contents for cell in (func.__closure__ or ())]
+    kwdefaults = sorted((func.__kwdefaults__ or {}).items())
+    stack += [cells, list(func.__defaults__ or ()), kwdefaults]
+
+def _describe_class(cls, parts, stack):
+    parts += (cls.__module__, cls.__qualname__)
+    if cls.__module__.startswith('astcheck') or cls.__module__ == 'builtins':
+        return
+    # The code of checker classes defined elsewhere can change
+    for base in cls.__mro__[:-1]:
+        methods = sorted((name, value) for name, value in vars(base).items()
+                         if isinstance(value, types.FunctionType))
+        parts.append(len(methods))
+        stack.extend(func for _, func in reversed(methods))
+
+def rules_fingerprint(rules):
+    """Make a hash of a :class:`~astcheck.RuleSet`, stable between processes
+
+    Templates are described by their structure, and checker functions by
+    their code, including the values they use from enclosing scopes, so
+    changing a rule changes the fingerprint. Raises :exc:`ValueError` if a
+    template contains something which can't be described this way.
+    """
+    parts = [_PYTHON_TAG, astcheck.__version__]
+    stack = [[list(rule) for rule in rules.rules]]
+    seen = {}  # Keeps the objects alive, so their ids aren't reused
+    while stack:
+        item = stack.pop()
+        parts.append(type(item).__qualname__)
+        if isinstance(item, _PLAIN_TYPES):
+            parts.append(repr(item))
+            continue
+
+        if id(item) in seen:
+            # Shared or recursive objects; the ids are in a stable order
+            parts.append('seen')
+            continue
+        seen[id(item)] = item
+
+        if isinstance(item, ast.AST):
+            fields = [getattr(item, name, None) for name in item._fields]
+            stack.extend(reversed(fields))
+        elif isinstance(item, (list, tuple)):
+            parts.append(len(item))
+            stack.extend(reversed(item))
+        elif isinstance(item, (set, frozenset)):
+            if not all(isinstance(value, _PLAIN_TYPES) for value in item):
+                raise ValueError("Can't describe set %r" % (item,))
+            parts += sorted(repr(value) for value in item)
+        elif isinstance(item, dict):
+            if not all(isinstance(key, str) for key in item):
+                raise ValueError("Can't describe dict %r" % (item,))
+            stack.extend(list(pair) for pair in sorted(item.items(), reverse=True))
+        elif isinstance(item, CompiledTemplate):
+            stack.append(item.template)
+        elif isinstance(item, re.Pattern):
+            parts += (repr(item.pattern), item.flags)
+        elif isinstance(item, types.FunctionType):
+            _describe_function(item, parts, stack)
+        elif isinstance(item, types.CodeType):
+            _describe_code(item, parts, stack)
+        elif isinstance(item, types.MethodType):
+            stack += [item.__func__, item.__self__]
+        elif isinstance(item, types.BuiltinFunctionType):
+            parts += (item.__module__, item.__qualname__)
+        elif isinstance(item, functools.partial):
+            stack += [item.func, list(item.args), item.keywords]
+        elif isinstance(item, type):
+            _describe_class(item, parts, stack)
+        elif hasattr(item, '__dict__'):
+            # Helpers like name_or_attr keep their settings in attributes
+            stack += [type(item), {name: value for name, value in vars(item).items()
+                                   if not name.startswith('_')}]
+        else:
+            raise ValueError("Can't describe %r in a template" % (item,))
+
+    digest = hashlib.blake2b(digest_size=20)
+    for part in parts:
+        digest.update(str(part).encode('utf-8', 'surrogatepass') + b'\0')
+    return digest.hexdigest()
+
+class ResultCache(object):
+    """Cache the matches for *rules* (a :class:`~astcheck.RuleSet`) in *directory*
+
+    Each entry holds the matches found in one source file, so a file which
+    hasn't changed is neither parsed nor checked again. Entries are keyed by
+    a hash of the source, the Python version and the rules (see
+    :func:`rules_fingerprint`), so changing the rules or the files makes new
+    entries.
+
+    Entries are JSON files, so reading them can't run any code. But anyone
+    who can write to the directory can change the results of a scan, so only
+    use a directory which you trust.
+
+    Several processes can safely share one cache directory: entries are
+    written to a temporary file and then renamed into place, so readers never
+    see a partial entry. Once the entries add up to more than *max_size*
+    bytes, the least recently used ones are deleted.
+
+    Caching is done on a best-effort basis: entries which can't be read or
+    written are treated as missing, rather than causing an error.
+    """
+    def __init__(self, directory, rules, max_size=256 * 1024 * 1024):
+        self.directory = directory
+        self.rules = rules
+        self.max_size = max_size
+        self.fingerprint = rules_fingerprint(rules)
+        # Rules are stored by their position, as rule IDs can be any object
+        self._rule_ids = [rule_id for rule_id, _ in rules.rules]
+        self._indexes = {}
+        for i, rule_id in enumerate(self._rule_ids):
+            try:
+                self._indexes.setdefault(rule_id, i)
+            except TypeError:
+                raise ValueError("Can't cache results for unhashable rule ID %r" % (rule_id,))
+        # Bytes written by this process since the cache was last pruned
+        self._written = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def __repr__(self):
+        return "astcheck.cache.ResultCache(%r, <%d rules>, max_size=%d)" % (
+            self.directory, len(self.rules), self.max_size)
+
+    def _entry_path(self, source):
+        if isinstance(source, str):
+            # Parsing str & bytes can differ, e.g. if there's a coding cookie
+            kind, source = b's', source.encode('utf-8', 'surrogatepass')
+        else:
+            kind = b'b'
+        digest = hashlib.blake2b(source, digest_size=20)
+        digest.update(kind + self.fingerprint.encode('ascii'))
+        key = digest.hexdigest()
+        return os.path.join(self.directory, key[:2], key + '.json')
+
+    def get(self, source):
+        """Get the cached matches for *source* (str or bytes), or None
+
+        Matches are a list of ``(rule_id, lineno, col_offset)`` tuples.
+        """
+        path = self._entry_path(source)
+        try:
+            with open(path, 'rb') as f:
+                entry = json.load(f)
+            matches = [(self._rule_ids[i], lineno, col_offset)
+                       for i, lineno, col_offset in entry]
+        except FileNotFoundError:
+            return None
+        except Exception:
+            # Unreadable or corrupt entry; it will be overwritten
+            return None
+
+        try:
+            os.utime(path)  # Mark it as recently used
+        except OSError:
+            pass
+        return matches
+
+    def put(self, source, matches):
+        """Store *matches* for *source*, as ``(rule_id, lineno, col_offset)`` tuples"""
+        path = self._entry_path(source)
+        entry = [[self._indexes[rule_id], lineno, col_offset]
+                 for rule_id, lineno, col_offset in matches]
+        data = json.dumps(entry, separators=(',', ':')).encode('ascii')
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        except OSError:
+            return
+
+        # Checking the size of the cache means listing every entry, so only do
+        # it after writing a fair fraction of the size limit.
+        self._written += len(data)
+        if self._written > self.max_size // 8:
+            self.prune()
+
+    def prune(self):
+        """Delete the least recently used entries to fit within max_size"""
+        self._written = 0
+        entries = []
+        total = 0
+        for subdir in _scandir(self.directory):
+            if not subdir.is_dir():
+                continue
+            for entry in _scandir(subdir.path):
+                if not entry.name.endswith('.json'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue  # Removed by another process
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            total -= size
+
+def _scandir(path):
+    try:
+        return list(os.scandir(path))
+    except OSError:
+        return []
@@ -0,0 +1,253 @@
+"""Re-check source code as it's edited, e.g. in an editor
+
+A :class:`Session` keeps the tree and matches from the last version of a
+file. When it gets a new version, it only parses and checks the top-level
+statements around the lines which changed, and reuses the rest.
+"""
+import ast
+import re
+from itertools import accumulate
+
+from . import RuleSet, _ROOT_PATH
+
+# Python only treats these as line breaks; str.splitlines() also splits on
+# characters like form feed.
+_LINE_RE = re.compile(r'[^\r\n]*(?:\r\n|\r|\n)|[^\r\n]+')
+
+def _split_lines(source):
+    return _LINE_RE.findall(source)
+
+def _first_line(stmt):
+    """The first line of a statement, including any decorators"""
+    decorators = getattr(stmt, 'decorator_list', None)
+    if decorators:
+        return min(stmt.lineno, min(d.lineno for d in decorators))
+    return stmt.lineno
+
+def _is_future_import(stmt):
+    return isinstance(stmt, ast.ImportFrom) and stmt.module == '__future__'
+
+class Session(object):
+    """Check successive versions of one file against a set of rules
+
+    *rules* is a :class:`~astcheck.RuleSet`, or a dict or iterable of
+    ``(rule_id, template)`` pairs to make one. Call :meth:`update` with the
+    source code each time it changes, or :meth:`edit` with just the lines
+    which changed.
+
+    Top-level statements which are unchanged (apart from moving up or down)
+    are reused from the previous tree, along with their matches. Moving a
+    statement doesn't update its line numbers straight away: this is done
+    when it's part of a match returned by :meth:`update` or :meth:`edit`, or
+    for the whole tree when :attr:`tree` is used. Don't keep using a previous
+    tree after calling :meth:`update` or :meth:`edit`.
+    """
+    def __init__(self, rules, filename='<unknown>'):
+        if not isinstance(rules, RuleSet):
+            rules = RuleSet(rules)
+        self.rules = rules
+        self.filename = filename
+        #: The latest list of matches, as returned by :meth:`update`
+        self.matches = []
+        #: How many top-level statements were checked in the last update
+        self.last_rechecked = 0
+        self._tree = None
+        self._lines = []
+        # For each top-level statement, (rule_id, node, path) for matches,
+        # with paths relative to the statement.
+        self._stmt_matches = []
+        # Line numbers of top-level statements which haven't been shifted yet.
+        # The shift for statement i is sum(self._shifts[:i+1]), so moving all
+        # the statements after an edit only changes one entry.
+        self._shifts = []
+
+    def __repr__(self):
+        return "<astcheck.incremental.Session for %s>" % self.filename
+
+    @property
+    def tree(self):
+        """The tree of the latest source code, or None before the first update"""
+        if self._tree is not None:
+            for i, shift in enumerate(accumulate(self._shifts)):
+                if shift:
+                    ast.increment_lineno(self._tree.body[i], shift)
+            self._shifts = [0] * len(self._shifts)
+        return self._tree
+
+    def update(self, source):
+        """Check a new version of the source code (a str)
+
+        Returns a list of ``(rule_id, node, path)`` tuples, the same as
+        ``list(rules.iter_matches(ast.parse(source)))``. Raises
+        :exc:`SyntaxError` if the source can't be parsed, in which case the
+        session stays as it was.
+
+        This compares the whole source with the previous version to find the
+        lines which changed. If you know which lines those are, :meth:`edit`
+        is quicker for big files.
+        """
+        lines = _split_lines(source)
+        if self._tree is None:
+            return self._replace(0, 0, lines)
+
+        old_lines = self._lines
+        n = min(len(old_lines), len(lines))
+        prefix = 0
+        while prefix < n and old_lines[prefix] == lines[prefix]:
+            prefix += 1
+        suffix = 0
+        while suffix < n - prefix and old_lines[-1 - suffix] == lines[-1 - suffix]:
+            suffix += 1
+        return self._replace(prefix, len(old_lines) - suffix,
+                             lines[prefix:len(lines) - suffix])
+
+    def edit(self, start, stop, text):
+        """Replace some lines of the source code, and check the new version
+
+        Lines *start* up to (not including) *stop* of the previous version,
+        counting from 0, are replaced by *text*; ``start == stop`` inserts
+        lines. Only the statements around the edit are parsed and checked,
+        and statements after it are moved without visiting their nodes.
+        Returns and raises the same as :meth:`update`.
+        """
+        if self._tree is None:
+            raise ValueError("Call update() with the whole source before edit()")
+        old_lines = self._lines
+        if not 0 <= start <= stop <= len(old_lines):
+            raise IndexError("Lines %d:%d out of range for %d lines"
+                             % (start, stop, len(old_lines)))
+        # Line breaks at either end of the text may join it to the lines
+        # around it (including \r + \n).
+        if start and not old_lines[start - 1].endswith('\n'):
+            start -= 1
+            text = old_lines[start] + text
+        if stop < len(old_lines) and not text.endswith('\n'):
+            text += old_lines[stop]
+            stop += 1
+        return self._replace(start, stop, _split_lines(text))
+
+    def _replace(self, start, stop, new_lines):
+        """Replace lines start:stop (0-based) of the source & check it"""
+        lines = self._lines
+        removed = lines[start:stop]
+        lines[start:stop] = new_lines
+        try:
+            rechecked = self._splice(start, stop, len(new_lines) - len(removed))
+        except BaseException:
+            lines[start:start + len(new_lines)] = removed
+            raise
+
+        # The module itself has to be checked each time
+        tree = self._tree
+        matches = [(rule_id, tree, ['tree'])
+                   for rule_id, test, _ in self.rules._rules_for_type(type(tree))
+                   if test(tree, _ROOT_PATH)]
+        shifts = self._shifts
+        for i, (stmt_matched, shift) in enumerate(zip(self._stmt_matches,
+                                                      list(accumulate(shifts)))):
+            if not stmt_matched:
+                continue
+            if shift:
+                # Matched nodes are returned, so they need the right positions
+                ast.increment_lineno(tree.body[i], shift)
+                shifts[i] -= shift
+                if i + 1 < len(shifts):
+                    shifts[i + 1] += shift
+            for rule_id, node, path in stmt_matched:
+                matches.append((rule_id, node, ['tree', 'body', i] + path))
+
+        self.matches = matches
+        self.last_rechecked = rechecked
+        return matches
+
+    def _splice(self, start, stop, delta):
+        """Update the tree after replacing lines start:stop of the old source
+
+        Only the changed part of the source is reparsed, if possible, and the
+        new top-level statements are checked. Returns the number of
+        statements checked.
+        """
+        reparsed = None
+        if self._tree is not None:
+            reparsed = self._reparse(start, stop, delta)
+        if reparsed is None:
+            tree = ast.parse(''.join(self._lines), filename=self.filename)
+            self._tree = tree
+            self._shifts = [0] * len(tree.body)
+            self._stmt_matches = [None] * len(tree.body)
+            reparsed = 0, len(tree.body)
+
+        first, last = reparsed
+        body, stmt_matches = self._tree.body, self._stmt_matches
+        for i in range(first, last):
+            stmt_matches[i] = [(rule_id, node, path[1:]) for rule_id, node, path
+                               in self.rules.iter_matches(body[i])]
+        return last - first
+
+    def _reparse(self, start, stop, delta):
+        """Reparse the top-level statements around lines start:stop
+
+        Returns the range of indexes of the new statements in the body, or
+        None if the changed part can't be parsed separately.
+        """
+        body, shifts = self._tree.body, self._shifts
+        offsets = list(accumulate(shifts))
+        def first_line(i):
+            return _first_line(body[i]) + offsets[i]
+        def end_line(i):
+            return body[i].end_lineno + offsets[i]
+
+        # Find the statements entirely before and after the changed lines
+        # (1-based line numbers in the old source).
+        before = _bisect(len(body), lambda i: end_line(i) > start)
+        after = _bisect(len(body), lambda i: first_line(i) > stop, before)
+
+        # Reparse the last statement before the change as well, as new lines
+        # may be part of it (e.g. 'else:', or more of a function body).
+        before = max(before - 1, 0)
+        # Statements on one line (separated by ';') are reparsed together.
+        while 0 < before < len(body) and end_line(before - 1) >= first_line(before):
+            before -= 1
+        while before < after < len(body) and first_line(after) <= end_line(after - 1):
+            after += 1
+
+        region_start = end_line(before - 1) if before else 0
+        if after < len(body):
+            region_end = first_line(after) - 1 + delta
+        else:
+            region_end = len(self._lines)
+        try:
+            region = ast.parse(''.join(self._lines[region_start:region_end]),
+                               filename=self.filename)
+        except (SyntaxError, ValueError):
+            return None
+        if before and any(_is_future_import(stmt) for stmt in region.body):
+            return None  # Only allowed at the start of the file
+        ast.increment_lineno(region, region_start)
+
+        # The new statements have the right line numbers, and the ones after
+        # them move by delta lines.
+        new_shifts = [0] * len(region.body)
+        shift_before = offsets[before - 1] if before else 0
+        if new_shifts:
+            new_shifts[0] = -shift_before
+            shift_before = 0
+        if after < len(body):
+            new_shifts.append(offsets[after] + delta - shift_before)
+            shifts[before:after + 1] = new_shifts
+        else:
+            shifts[before:after] = new_shifts
+        body[before:after] = region.body
+        self._stmt_matches[before:after] = [None] * len(region.body)
+        return before, before + len(region.body)
+
+def _bisect(n, pred, lo=0):
+    """Find the first index in lo:n where pred(i) is True, for monotonic pred"""
+    hi = n
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if pred(mid):
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
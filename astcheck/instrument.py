@@ -0,0 +1,270 @@
+"""Measure how templates perform while matching
+
+When a set of rules gets slow, a :class:`Profiler` can show which templates,
+and which checker functions inside them, are responsible::
+
+    profiler = astcheck.instrument.Profiler()
+    rules = profiler.ruleset(TEMPLATES)
+    for tree in trees:
+        for match in rules.iter_matches(tree):
+            ...
+    print(profiler.report())
+
+Only templates compiled through a profiler collect statistics. Templates
+compiled normally don't contain any instrumentation code, so it costs nothing
+when it's not used.
+"""
+import ast
+from time import perf_counter
+
+from . import (ASTMismatch, CompiledTemplate, RuleSet, _instrumentation,
+               _path_list, must_exist, must_not_exist)
+
+class CheckerStats(object):
+    """Statistics for one checker function in a template"""
+    __slots__ = ('name', 'calls', 'failures', 'seconds')
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.failures = 0
+        self.seconds = 0.
+
+    def __repr__(self):
+        return "<CheckerStats %s: %d calls, %d failures, %.6f s>" % (
+            self.name, self.calls, self.failures, self.seconds)
+
+class TemplateStats(object):
+    """Statistics for one instrumented template
+
+    *mismatch_depths* maps the number of steps from the top of the template
+    to the place where a mismatch was found, to the number of mismatches
+    found at that depth. *checkers* maps checker function names to
+    :class:`CheckerStats`.
+    """
+    __slots__ = ('label', 'calls', 'hits', 'misses', 'seconds',
+                 'mismatch_depths', 'checkers', '_depth')
+
+    def __init__(self, label):
+        self.label = label
+        self.calls = 0
+        self.hits = 0
+        self.misses = 0
+        self.seconds = 0.
+        self.mismatch_depths = {}
+        self.checkers = {}
+        self._depth = None  # Set by the first test to fail in a check
+
+    def __repr__(self):
+        return "<TemplateStats %s: %d calls, %d hits, %.6f s>" % (
+            self.label, self.calls, self.hits, self.seconds)
+
+    def _record(self, matched, depth, seconds):
+        self.calls += 1
+        self.seconds += seconds
+        if matched:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.mismatch_depths[depth] = self.mismatch_depths.get(depth, 0) + 1
+
+def _is_user_checker(template):
+    return callable(template) and not isinstance(template, ast.AST) \
+        and getattr(template, '_compile_test', None) is None \
+        and (template is not must_exist) and (template is not must_not_exist)
+
+def _checker_name(checker):
+    return getattr(checker, '__qualname__', None) or type(checker).__name__
+
+class _Instrumentation(object):
+    """Wraps the test functions built while compiling a template"""
+    def __init__(self, stats):
+        self.stats = stats
+        # Steps to the base path of the template being compiled, which is
+        # deeper than the top for the items of a listcontains.
+        self.depth = 0
+
+    def wrap_test(self, test, template, suffix):
+        stats = self.stats
+        depth = self.depth + len(suffix)
+
+        if _is_user_checker(template):
+            name = _checker_name(template)
+            checker = stats.checkers.get(name)
+            if checker is None:
+                checker = stats.checkers[name] = CheckerStats(name)
+
+            def timed_test(sample, base):
+                start = perf_counter()
+                passed = test(sample, base)
+                checker.seconds += perf_counter() - start
+                checker.calls += 1
+                if not passed:
+                    checker.failures += 1
+                    if stats._depth is None:
+                        stats._depth = depth
+                return passed
+            return timed_test
+
+        def tracked_test(sample, base):
+            if test(sample, base):
+                return True
+            # Failures propagate outwards, so the first one is the innermost
+            if stats._depth is None:
+                stats._depth = depth
+            return False
+        return tracked_test
+
+class InstrumentedTemplate(CompiledTemplate):
+    """A compiled template which records statistics in a :class:`Profiler`
+
+    Create these with :meth:`Profiler.compile`. They can be used anywhere a
+    :class:`~astcheck.CompiledTemplate` can. Checker functions are only timed
+    in non-raising checks, e.g. ``is_ast_like()`` and searches.
+
+    Pickling an instrumented template, e.g. to send a rule set to worker
+    processes, pickles its profiler with it, so its hooks must be picklable.
+    The copies collect their own statistics, which aren't sent back.
+    """
+    def __init__(self, template, profiler, label=None):
+        if label is None:
+            label = repr(template)
+        self.label = label
+        self.profiler = profiler
+        stats = profiler._stats_for(label)
+
+        token = _instrumentation.set(_Instrumentation(stats))
+        try:
+            super().__init__(template)
+        finally:
+            _instrumentation.reset(token)
+
+        inner_test, inner_check = self._test, self._check
+        hooks = profiler.hooks
+
+        def test(sample, base):
+            stats._depth = None
+            start = perf_counter()
+            matched = inner_test(sample, base)
+            elapsed = perf_counter() - start
+            depth = None if matched else stats._depth
+            stats._record(matched, depth, elapsed)
+            for hook in hooks:
+                hook(label, sample, matched, depth, elapsed)
+            return matched
+
+        def check(sample, base):
+            start = perf_counter()
+            try:
+                inner_check(sample, base)
+            except ASTMismatch as e:
+                elapsed = perf_counter() - start
+                depth = len(e.path) - len(_path_list(base))
+                stats._record(False, depth, elapsed)
+                for hook in hooks:
+                    hook(label, sample, False, depth, elapsed)
+                raise
+            elapsed = perf_counter() - start
+            stats._record(True, None, elapsed)
+            for hook in hooks:
+                hook(label, sample, True, None, elapsed)
+
+        self._test = test
+        self._check = check
+
+    def __repr__(self):
+        return "<astcheck.instrument.InstrumentedTemplate %s>" % self.label
+
+    def __reduce__(self):
+        # Compile again with the same profiler, rather than dropping the
+        # instrumentation as CompiledTemplate would
+        return (InstrumentedTemplate, (self.template, self.profiler, self.label))
+
+class Profiler(object):
+    """Collects statistics about matching for instrumented templates
+
+    :attr:`stats` is a dict mapping template labels to :class:`TemplateStats`.
+    Templates compiled with the same label share statistics.
+    """
+    def __init__(self):
+        self.stats = {}
+        self.hooks = []
+
+    def _stats_for(self, label):
+        stats = self.stats.get(label)
+        if stats is None:
+            stats = self.stats[label] = TemplateStats(label)
+        return stats
+
+    def add_hook(self, hook):
+        """Call *hook* after each check with an instrumented template
+
+        It is called as ``hook(label, sample, matched, mismatch_depth, seconds)``,
+        where *mismatch_depth* is None if the sample matched.
+        """
+        self.hooks.append(hook)
+
+    def compile(self, template, label=None):
+        """Compile a template with instrumentation
+
+        *label* identifies the template in :attr:`stats` and the report; by
+        default, it's the repr of the template.
+        """
+        return InstrumentedTemplate(template, self, label)
+
+    def ruleset(self, rules):
+        """Make a :class:`~astcheck.RuleSet` of instrumented templates
+
+        *rules* is a dict or iterable of pairs, as for
+        :class:`~astcheck.RuleSet`. Rule IDs are used as labels.
+        """
+        if isinstance(rules, dict):
+            rules = rules.items()
+        return RuleSet([(rule_id, self.compile(template, label=rule_id))
+                        for rule_id, template in rules])
+
+    def reset(self):
+        """Clear the statistics collected so far"""
+        for stats in self.stats.values():
+            # Compiled templates hold on to these objects, so reset them in place
+            checkers = stats.checkers
+            stats.__init__(stats.label)
+            for checker in checkers.values():
+                checker.__init__(checker.name)
+            stats.checkers = checkers
+
+    def report(self, limit=None):
+        """Format the statistics as a table, slowest templates first
+
+        *limit* is the maximum number of templates to show.
+        """
+        template_stats = sorted(self.stats.values(), key=lambda s: s.seconds, reverse=True)
+        if limit is not None:
+            template_stats = template_stats[:limit]
+
+        lines = ["{:<30} {:>9} {:>9} {:>9} {:>11} {:>9}  {}".format(
+            'Template', 'Calls', 'Hits', 'Misses', 'Total ms', 'us/call',
+            'Mismatch depths (depth:count)')]
+        checker_lines = []
+        for stats in template_stats:
+            per_call = (stats.seconds / stats.calls * 1e6) if stats.calls else 0.
+            depths = " ".join("%s:%d" % (depth, n)
+                              for depth, n in sorted(stats.mismatch_depths.items(),
+                                                     key=lambda item: item[1], reverse=True))
+            lines.append("{:<30} {:>9} {:>9} {:>9} {:>11.3f} {:>9.2f}  {}".format(
+                _truncate(str(stats.label), 30), stats.calls, stats.hits, stats.misses,
+                stats.seconds * 1e3, per_call, depths))
+            for checker in sorted(stats.checkers.values(),
+                                  key=lambda c: c.seconds, reverse=True):
+                checker_lines.append("{:<30} {:<30} {:>9} {:>9} {:>11.3f}".format(
+                    _truncate(checker.name, 30), _truncate(str(stats.label), 30),
+                    checker.calls, checker.failures, checker.seconds * 1e3))
+
+        if checker_lines:
+            lines += ["", "{:<30} {:<30} {:>9} {:>9} {:>11}".format(
+                'Checker function', 'Template', 'Calls', 'Failures', 'Total ms')]
+            lines += checker_lines
+        return "\n".join(lines)
+
+def _truncate(text, width):
+    return text if len(text) <= width else text[:width - 3] + '...'
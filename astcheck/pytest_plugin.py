@@ -0,0 +1,247 @@
+"""A pytest plugin for test suites which use astcheck
+
+pytest loads this automatically when astcheck is installed. It:
+
+- Provides an ``ast_templates`` fixture, a :class:`TemplateCache` shared by
+  all the tests in a session, so templates used by many tests are only
+  built and compiled once.
+- Adds the details of an :exc:`~astcheck.ASTMismatch` to the report when a
+  test fails with one, and leaves astcheck's own code out of the traceback.
+- With ``--astcheck-durations=N``, lists the N tests which spent longest in
+  AST assertions at the end of the run.
+"""
+import ast
+from time import perf_counter
+
+import pytest
+
+import astcheck
+from . import (ASTMismatch, CompiledTemplate, _assertion_timer, _value_key,
+               compile_pattern, format_path)
+
+_PLAIN_TYPES = (str, bytes, int, float, complex, type(None))
+
+def _template_key(template):
+    """Make a hashable key for a template
+
+    AST nodes and plain values are compared by structure, so equal templates
+    built separately have the same key. Anything else, such as checker
+    functions and helpers, is compared by identity.
+    """
+    key = []
+    stack = [template]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, ast.AST):
+            fields = [getattr(item, name, None) for name in item._fields]
+            key += (type(item), len(fields))
+            stack.extend(reversed(fields))
+        elif isinstance(item, list):
+            key += (list, len(item))
+            stack.extend(reversed(item))
+        elif isinstance(item, _PLAIN_TYPES):
+            key.append(_value_key(item))
+        else:
+            # The cache keeps the template alive, so the id isn't reused
+            key.append((object, id(item)))
+    return tuple(key)
+
+class TemplateCache(object):
+    """Compiled templates shared between the tests in a session
+
+    Get this with the ``ast_templates`` fixture::
+
+        def test_codegen(ast_templates, case):
+            template = ast_templates.build(make_template, case.name)
+            ast_templates.assert_ast_like(generate(case), template)
+
+    *hits* and *misses* count how often a compiled template was reused.
+    """
+    def __init__(self):
+        self._compiled = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return "<astcheck.pytest_plugin.TemplateCache of %d templates>" % len(self)
+
+    def __len__(self):
+        return len(self._compiled)
+
+    def _get(self, key, make):
+        try:
+            compiled = self._compiled[key]
+        except KeyError:
+            self.misses += 1
+            compiled = self._compiled[key] = make()
+        else:
+            self.hits += 1
+        return compiled
+
+    def compile(self, template):
+        """Get a compiled template, only compiling it the first time
+
+        *template* may be a template or a pattern string (see
+        :func:`~astcheck.pattern`). Templates made of AST nodes and plain
+        values are compared by structure, so a template rebuilt in each test
+        is only compiled once. Checker functions and helpers such as
+        :class:`~astcheck.name_or_attr` must be the same objects to be
+        reused; create them once, or use :meth:`build`.
+        """
+        if isinstance(template, CompiledTemplate):
+            return template
+        if isinstance(template, str):
+            return self._get(('pattern', template), lambda: compile_pattern(template))
+        return self._get(_template_key(template), lambda: CompiledTemplate(template))
+
+    def build(self, factory, *args, **kwargs):
+        """Get a compiled template made by ``factory(*args, **kwargs)``
+
+        The factory is called once for each set of arguments in a session.
+        The arguments must be hashable.
+        """
+        key = ('build', factory, args, tuple(sorted(kwargs.items())))
+        return self._get(key, lambda: CompiledTemplate(factory(*args, **kwargs)))
+
+    def assert_ast_like(self, sample, template):
+        """Check a sample against a cached template, as :func:`~astcheck.assert_ast_like`"""
+        self.compile(template).assert_ast_like(sample)
+
+    def is_ast_like(self, sample, template):
+        """Check a sample against a cached template, as :func:`~astcheck.is_ast_like`"""
+        return self.compile(template).is_ast_like(sample)
+
+@pytest.fixture(scope='session')
+def ast_templates():
+    """A :class:`TemplateCache` shared by all tests in the session"""
+    return TemplateCache()
+
+# Describing mismatches
+# ---------------------
+
+def _hide_mismatch_frames(excinfo):
+    # Used as astcheck.__tracebackhide__: pytest leaves frames in astcheck out
+    # of the traceback for mismatches, where they only show the matching
+    # machinery. Frames are still shown for other errors.
+    return (excinfo is not None) and excinfo.errisinstance(ASTMismatch)
+
+# The same applies to TemplateCache methods
+__tracebackhide__ = _hide_mismatch_frames
+
+def _shorten(text, width=100):
+    lines = text.strip().splitlines() or ['']
+    text = lines[0] + (' ...' if len(lines) > 1 else '')
+    return text if len(text) <= width else text[:width - 3] + '...'
+
+def _node_code(node):
+    """Show a node as source code if possible, or as a dump"""
+    unparse = getattr(ast, 'unparse', None)  # Python 3.9+
+    if unparse is not None:
+        try:
+            return _shorten(unparse(node))
+        except Exception:
+            # Templates often leave fields out, which unparse can't handle
+            pass
+    return _shorten(ast.dump(node))
+
+def _describe_value(value, plain=repr):
+    if isinstance(value, ast.AST):
+        where = ""
+        if getattr(value, 'lineno', None) is not None:
+            where = " at line %d, column %d" % (value.lineno, value.col_offset)
+        return "%s node%s: %s" % (type(value).__name__, where, _node_code(value))
+    elif isinstance(value, list) and any(isinstance(item, ast.AST) for item in value):
+        return "list of %d item(s): [%s]" % (
+            len(value), _shorten(", ".join(_describe_value(item) for item in value)))
+    return _shorten(plain(value))
+
+def _describe_mismatch(exc):
+    # Descriptions like "non empty" are shown as they are, not as a repr
+    expected_plain = str if isinstance(exc.expected, str) and (
+        type(exc) in (ASTMismatch, astcheck.ASTNodeTypeMismatch)) else repr
+    return "\n".join([
+        "Path:     " + format_path(exc.path),
+        "Found:    " + _describe_value(exc.got),
+        "Expected: " + _describe_value(exc.expected, expected_plain),
+    ])
+
+# Hooks
+# -----
+
+_active_configs = 0  # pytester can run pytest inside a pytest session
+
+def pytest_addoption(parser):
+    group = parser.getgroup('astcheck')
+    group.addoption('--astcheck-durations', type=int, default=None, metavar='N',
+                    help="Show the N tests which spent longest in astcheck "
+                         "assertions (N=0 for all).")
+
+def pytest_configure(config):
+    global _active_configs
+    if not _active_configs:
+        astcheck.__tracebackhide__ = _hide_mismatch_frames
+    _active_configs += 1
+
+    limit = config.getoption('astcheck_durations')
+    if limit is not None:
+        config.pluginmanager.register(_DurationsReport(limit), 'astcheck-durations')
+
+def pytest_unconfigure(config):
+    global _active_configs
+    _active_configs -= 1
+    if not _active_configs:
+        del astcheck.__tracebackhide__
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_makereport(item, call):
+    outcome = yield
+    report = outcome.get_result()
+    excinfo = call.excinfo
+    if report.failed and (excinfo is not None) and excinfo.errisinstance(ASTMismatch) \
+            and hasattr(report.longrepr, 'addsection'):
+        report.longrepr.addsection("AST mismatch", _describe_mismatch(excinfo.value))
+
+class _DurationsReport(object):
+    """Times AST assertions in each test, and reports the slowest tests"""
+    def __init__(self, limit):
+        self.limit = limit
+        # Test ID -> [assertions, total seconds, slowest assertion]
+        self.times = {}
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtest_call(self, item):
+        times = self.times
+        nodeid = item.nodeid
+
+        def timer(func, *args):
+            start = perf_counter()
+            try:
+                return func(*args)
+            finally:
+                elapsed = perf_counter() - start
+                record = times.get(nodeid)
+                if record is None:
+                    record = times[nodeid] = [0, 0., 0.]
+                record[0] += 1
+                record[1] += elapsed
+                record[2] = max(record[2], elapsed)
+
+        token = _assertion_timer.set(timer)
+        try:
+            yield
+        finally:
+            _assertion_timer.reset(token)
+
+    def pytest_terminal_summary(self, terminalreporter):
+        tr = terminalreporter
+        slowest = sorted(self.times.items(), key=lambda item: item[1][1], reverse=True)
+        if self.limit:
+            tr.write_sep("=", "slowest %d astcheck assertion tests" % self.limit)
+            slowest = slowest[:self.limit]
+        else:
+            tr.write_sep("=", "slowest astcheck assertion tests")
+        if not slowest:
+            tr.write_line("No astcheck assertions were run.")
+        for nodeid, (calls, total, longest) in slowest:
+            tr.write_line("{:.4f}s {:>7} assertion(s), slowest {:.4f}s  {}".format(
+                total, calls, longest, nodeid))
@@ -0,0 +1,427 @@
+"""Scan many Python files for nodes matching a set of templates
+
+This can be used from Python with :func:`scan`, or from the command line::
+
+    astcheck scan --templates mytemplates src/ tests/
+"""
+import argparse
+import ast
+import asyncio
+import functools
+import importlib
+import importlib.util
+import os
+import sys
+import unicodedata
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from . import RuleSet, required_names
+from .cache import ResultCache
+
+ScanResult = namedtuple('ScanResult', ['path', 'rule_id', 'lineno', 'col_offset'])
+ScanResult.__doc__ = """A match for one rule in one file
+
+*lineno* and *col_offset* are taken from the matching node, and are None for
+nodes which don't have a position, such as :class:`ast.Module`.
+"""
+
+def load_templates(spec):
+    """Load a :class:`~astcheck.RuleSet` from a templates module
+
+    *spec* is an importable module name, or the path of a ``.py`` file. The
+    module should define ``TEMPLATES``, either a dict mapping rule IDs to
+    templates or a :class:`~astcheck.RuleSet`.
+    """
+    if spec.endswith('.py') or os.sep in spec:
+        name = os.path.splitext(os.path.basename(spec))[0]
+        module_spec = importlib.util.spec_from_file_location(name, spec)
+        if module_spec is None:
+            raise ImportError("Can't load templates from %r" % spec)
+        module = importlib.util.module_from_spec(module_spec)
+        module_spec.loader.exec_module(module)
+    else:
+        module = importlib.import_module(spec)
+
+    try:
+        templates = module.TEMPLATES
+    except AttributeError:
+        raise ValueError("Templates module %r doesn't define TEMPLATES" % spec)
+    return _as_ruleset(templates)
+
+def _as_ruleset(templates):
+    if isinstance(templates, RuleSet):
+        return templates
+    elif isinstance(templates, str):
+        return load_templates(templates)
+    return RuleSet(templates)
+
+class SourcePrefilter(object):
+    """Quickly rule out source code which can't match any rule in a RuleSet
+
+    This uses :func:`~astcheck.required_names` to find the identifiers each
+    rule needs, and looks for them in the source code before it's parsed.
+    Source code which is ruled out is never parsed, so syntax errors in it
+    aren't found.
+    """
+    def __init__(self, rules):
+        self.rule_names = [required_names(template) for _, template in rules.rules]
+        self.names = frozenset().union(*self.rule_names)
+        self._encoded = [(name, name.encode('utf-8')) for name in self.names]
+
+    def could_match(self, source):
+        """Returns False if *source* (str or bytes) can't match any rule"""
+        if not source.isascii():
+            source = _normalise_source(source)
+            if source is None:
+                return True  # Leave it to the parser to report the error
+        if isinstance(source, str):
+            present = {name for name in self.names if name in source}
+        else:
+            present = {name for name, encoded in self._encoded if encoded in source}
+        return any(names <= present for names in self.rule_names)
+
+def _normalise_source(source):
+    """Decode source code, and normalise it as the parser does identifiers
+
+    Identifiers are NFKC normalised, so e.g. fullwidth letters in the source
+    are ASCII names in the tree. Returns None if *source* can't be decoded.
+    """
+    if isinstance(source, bytes):
+        try:
+            # Handles a coding cookie, as the parser does
+            source = importlib.util.decode_source(source)
+        except (SyntaxError, UnicodeDecodeError, LookupError):
+            return None
+    return unicodedata.normalize('NFKC', source)
+
+def iter_source_files(paths):
+    """Iterate over Python files in the given files & directories
+
+    Directories are searched recursively for ``.py`` files, skipping hidden
+    directories. Files are given in a stable (sorted) order.
+    """
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+            for filename in sorted(filenames):
+                if filename.endswith('.py'):
+                    yield os.path.join(dirpath, filename)
+
+def scan_file(path, rules, cache=None, prefilter=None):
+    """Find matches for a :class:`~astcheck.RuleSet` in one file
+
+    Returns a list of :class:`ScanResult` tuples. Raises :exc:`OSError` if the
+    file can't be read, and :exc:`SyntaxError`, :exc:`ValueError` or
+    :exc:`RecursionError` if it can't be parsed. *cache* may be a
+    :class:`~astcheck.cache.ResultCache`, and *prefilter* a
+    :class:`SourcePrefilter`, both for the same rules; files found in the
+    cache, or which can't match, aren't parsed at all.
+    """
+    with open(path, 'rb') as f:
+        source = f.read()
+    return _match_source(path, source, rules, cache, prefilter)
+
+# Errors from parsing a file which can't be handled. Very deeply nested code
+# makes the parser raise RecursionError (or run out of memory).
+_PARSE_ERRORS = (SyntaxError, ValueError, RecursionError, MemoryError)
+
+def _match_source(path, source, rules, cache=None, prefilter=None):
+    if cache is not None:
+        matches = cache.get(source)
+        if matches is not None:
+            return [ScanResult(path, *match) for match in matches]
+    if (prefilter is not None) and not prefilter.could_match(source):
+        return []
+    results = _match_tree(path, ast.parse(source, filename=path), rules)
+    if cache is not None:
+        cache.put(source, [result[1:] for result in results])
+    return results
+
+def _match_tree(path, tree, rules):
+    return [ScanResult(path, rule_id, getattr(node, 'lineno', None),
+                       getattr(node, 'col_offset', None))
+            for rule_id, node, _ in rules.iter_matches(tree)]
+
+# The stages of scanning files. Each one takes and returns a
+# (path, item, error) tuple, and they're chained with map(), so only one file
+# is in memory at a time: map() doesn't hold on to its input or output once
+# it's passed on. After an error, the item is None.
+
+def _read_stage(path):
+    try:
+        with open(path, 'rb') as f:
+            return path, f.read(), None
+    except OSError as e:
+        return path, None, _error_message(e)
+
+def _match_stage(item, rules, cache, prefilter):
+    path, source, error = item
+    if source is None:
+        return path, [], error
+    # Only the compact results are passed on, so the tree can be freed.
+    try:
+        return path, _match_source(path, source, rules, cache, prefilter), None
+    except _PARSE_ERRORS as e:
+        return path, [], _error_message(e)
+
+def _scan_files(paths, rules, cache=None, prefilter=None):
+    """Scan files lazily, yielding (path, results, error) tuples"""
+    return map(functools.partial(_match_stage, rules=rules, cache=cache,
+                                 prefilter=prefilter),
+               map(_read_stage, paths))
+
+def _error_message(e):
+    return "%s: %s" % (type(e).__name__, e)
+
+def _make_cache(cache_dir, cache_size, rules):
+    if cache_dir is None:
+        return None
+    elif cache_size is None:
+        return ResultCache(cache_dir, rules)
+    return ResultCache(cache_dir, rules, max_size=cache_size)
+
+# Each worker process gets the rules once, when it starts.
+_worker_rules = None
+_worker_cache = None
+_worker_prefilter = None
+
+def _init_worker(rules, cache=None, prefilter=True):
+    global _worker_rules, _worker_cache, _worker_prefilter
+    _worker_rules = rules
+    _worker_prefilter = SourcePrefilter(rules) if prefilter else None
+    _worker_cache = cache
+
+def _scan_chunk(paths):
+    """Scan a list of files, returning (path, results, error) tuples"""
+    return list(_scan_files(paths, _worker_rules, _worker_cache, _worker_prefilter))
+
+def _chunks(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _bounded_map(executor, func, items, max_pending):
+    """Like executor.map(), but only take items as results are used
+
+    executor.map() submits everything at once, so for a long iterable, all
+    the results can pile up in memory if they're produced faster than
+    they're used. Results are yielded in order.
+    """
+    pending = deque()
+    for item in items:
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+        pending.append(executor.submit(func, item))
+    try:
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+def scan(paths, templates, workers=None, chunksize=32, on_error=None,
+         cache_dir=None, cache_size=None, prefilter=True):
+    """Scan Python files for matches, using several processes
+
+    *paths* is a list of files and directories, as for
+    :func:`iter_source_files`. *templates* is the name or path of a templates
+    module (see :func:`load_templates`), or a dict or
+    :class:`~astcheck.RuleSet`. Templates are loaded once, when this is
+    called, and any error loading them is raised here. Worker processes get a
+    copy of the rules when they start; where processes are started by
+    'spawn' (e.g. on macOS and Windows), the rules are pickled and compiled
+    again, so any checker functions they use must be defined at the top level
+    of an importable module.
+
+    Files are split into chunks of *chunksize* and spread over *workers*
+    processes (by default, one per CPU). With ``workers=1``, everything runs
+    in this process. :class:`ScanResult` tuples are yielded as chunks finish,
+    but always in the same order: by file, then as from
+    :meth:`RuleSet.iter_matches <astcheck.RuleSet.iter_matches>`.
+
+    Files which can't be read or parsed are skipped; if *on_error* is given,
+    it is called with the file path and an error message.
+
+    If *cache_dir* is given, the matches in each file are cached there (see
+    :class:`~astcheck.cache.ResultCache`), up to *cache_size* bytes, so files
+    which haven't changed aren't parsed again. This raises :exc:`ValueError`
+    if the rules can't be fingerprinted for caching.
+
+    Unless *prefilter* is False, files which don't contain the names a rule
+    requires are skipped without parsing them (see :class:`SourcePrefilter`).
+    This doesn't change the results, but *on_error* isn't called for syntax
+    errors in the skipped files.
+    """
+    rules = _as_ruleset(templates)
+    cache = _make_cache(cache_dir, cache_size, rules)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    return _scan(iter_source_files(paths), rules, workers, chunksize, on_error,
+                 cache, prefilter)
+
+def _scan(files, rules, workers, chunksize, on_error, cache, prefilter):
+    if workers == 1:
+        yield from _report(_scan_files(files, rules, cache,
+                                       SourcePrefilter(rules) if prefilter else None),
+                           on_error)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(rules, cache, prefilter)) as executor:
+        chunk_results = _bounded_map(executor, _scan_chunk,
+                                     _chunks(files, chunksize), 2 * workers)
+        yield from _report((scanned for chunk in chunk_results for scanned in chunk),
+                           on_error)
+
+def _report(scanned, on_error):
+    for path, results, error in scanned:
+        if error is not None and on_error is not None:
+            on_error(path, error)
+        yield from results
+
+def _match_checked(path, source, rules, prefilter):
+    """Match one source, returning (path, results, error)"""
+    try:
+        return path, _match_source(path, source, rules, prefilter=prefilter), None
+    except _PARSE_ERRORS as e:
+        return path, [], _error_message(e)
+
+def _match_in_worker(path, source):
+    return _match_checked(path, source, _worker_rules, _worker_prefilter)
+
+async def _iter_async(items):
+    for item in items:
+        yield item
+
+async def aiter_matches(sources, templates, workers=None, max_pending=None,
+                        on_error=None, processes=False, prefilter=True):
+    """Check sources as they arrive, yielding matches as each one finishes
+
+    *sources* is an iterable or an async iterable of ``(path, source)``
+    pairs, where *source* is a str or bytes; *path* is only used in the
+    results and error messages. *templates* is as for :func:`scan`.
+
+    Sources are parsed and checked in a pool of *workers* threads, or
+    processes if *processes* is True (by default, one per CPU). At most
+    *max_pending* sources (by default, twice the number of workers) are
+    queued or being checked at once; more aren't taken from *sources* until
+    one finishes. :class:`ScanResult` tuples are yielded as soon as each
+    source is checked, so the order of sources in the results can differ from
+    the order they arrived in.
+
+    Sources which can't be parsed are skipped; if *on_error* is given, it is
+    called with the path and an error message.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if max_pending is None:
+        max_pending = 2 * workers
+
+    rules = _as_ruleset(templates)
+    if processes:
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                       initargs=(rules, None, prefilter))
+        match = _match_in_worker
+    else:
+        executor = ThreadPoolExecutor(max_workers=workers)
+        match = functools.partial(_match_checked, rules=rules,
+                                  prefilter=SourcePrefilter(rules) if prefilter else None)
+
+    if not hasattr(sources, '__aiter__'):
+        sources = _iter_async(sources)
+    sources = sources.__aiter__()
+    loop = asyncio.get_running_loop()
+    pending = set()
+    next_source = None  # A task getting the next item from sources
+    exhausted = False
+    try:
+        while True:
+            if next_source is None and not exhausted and len(pending) < max_pending:
+                next_source = asyncio.ensure_future(sources.__anext__())
+            waiting = pending if next_source is None else (pending | {next_source})
+            if not waiting:
+                break
+            done, _ = await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+
+            if next_source in done:
+                try:
+                    path, source = next_source.result()
+                except StopAsyncIteration:
+                    exhausted = True
+                else:
+                    pending.add(loop.run_in_executor(executor, match, path, source))
+                next_source = None
+
+            for future in done & pending:
+                pending.discard(future)
+                path, results, error = future.result()
+                if error is not None and on_error is not None:
+                    on_error(path, error)
+                for result in results:
+                    yield result
+    finally:
+        # If iteration stops early, don't wait for sources which haven't started
+        if next_source is not None:
+            next_source.cancel()
+        for future in pending:
+            future.cancel()
+        # Wait for work already running to finish, without blocking the loop.
+        # Shutting down a process pool without waiting can leave its manager
+        # thread writing to queues after they're closed.
+        await loop.run_in_executor(None, executor.shutdown)
+
+def main(argv=None):
+    """Entry point for the ``astcheck`` command"""
+    ap = argparse.ArgumentParser(prog='astcheck',
+                                 description="Check Python ASTs against templates")
+    subparsers = ap.add_subparsers(dest='command', required=True)
+    scan_parser = subparsers.add_parser('scan', help="Find code matching templates")
+    scan_parser.add_argument('paths', nargs='+', help="Files & directories to scan")
+    scan_parser.add_argument('-t', '--templates', required=True,
+        help="Module name or .py file defining a TEMPLATES dict")
+    scan_parser.add_argument('-j', '--jobs', type=int, default=None,
+        help="Number of worker processes (default: number of CPUs)")
+    scan_parser.add_argument('--cache-dir',
+        help="Directory to cache results in, to speed up repeated scans")
+    scan_parser.add_argument('--cache-size', type=int, default=None, metavar='BYTES',
+        help="Maximum size of the cache (default: 256 MiB)")
+    scan_parser.add_argument('--no-prefilter', dest='prefilter', action='store_false',
+        help="Parse every file, even if it can't contain a match, so that "
+             "syntax errors in all files are reported")
+    args = ap.parse_args(argv)
+
+    try:
+        rules = load_templates(args.templates)
+    except Exception as e:
+        # Running the templates module could raise anything
+        print("astcheck: can't load templates from {}: {}".format(
+            args.templates, _error_message(e)), file=sys.stderr)
+        return 2
+
+    def report_error(path, message):
+        print("{}: {}".format(path, message), file=sys.stderr)
+
+    try:
+        results = scan(args.paths, rules, workers=args.jobs,
+                       on_error=report_error, cache_dir=args.cache_dir,
+                       cache_size=args.cache_size, prefilter=args.prefilter)
+    except ValueError as e:
+        print("astcheck: can't cache results: {}".format(e), file=sys.stderr)
+        return 2
+
+    found = False
+    for result in results:
+        found = True
+        print("{}:{}:{}: {}".format(result.path, result.lineno,
+                                    result.col_offset, result.rule_id))
+    return 1 if found else 0
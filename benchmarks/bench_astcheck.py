@@ -0,0 +1,263 @@
+"""Benchmark astcheck against a corpus of real Python code
+
+Run this from a checkout of the repository; it uses the astcheck package
+next to the ``benchmarks`` directory, rather than an installed copy. By
+default, the corpus is the first 200 files (in sorted order) of the standard
+library of the running Python::
+
+    python benchmarks/bench_astcheck.py
+    python benchmarks/bench_astcheck.py --corpus ~/src/myproject --json results.json
+
+For each template and matching method, this reports how many matches are
+found and how many nodes are checked per second, the average cost of a check which doesn't match, and the
+peak memory used. It also times scanning the corpus with and without a
+:class:`~astcheck.cache.ResultCache`. Results are listed in a fixed order, so the output of two
+runs (e.g. two releases) can be compared line by line.
+"""
+import argparse
+import ast
+import gc
+import json
+import os
+import platform
+import sys
+import sysconfig
+import tempfile
+import time
+import tracemalloc
+
+# Benchmark the code in this checkout, even if another version is installed
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import astcheck
+from astcheck.scan import scan
+
+TEMPLATES = {
+    'open-call': ast.Call(func=astcheck.name_or_attr('open')),
+    'for-else': ast.For(orelse=astcheck.must_exist),
+    'self-assign': astcheck.single_assign(
+        target=ast.Attribute(value=ast.Name(id='self'))),
+    'return-none': ast.FunctionDef(
+        body=astcheck.listmiddle() + [ast.Return(value=ast.Constant(value=None))]),
+    'try-pass': ast.Try(handlers=[ast.ExceptHandler(body=[ast.Pass()])]),
+    'increment': astcheck.single_assign(
+        target=astcheck.capture('var'),
+        value=ast.BinOp(left=astcheck.backref('var'), op=ast.Add())),
+    'open-then-read': ast.FunctionDef(body=astcheck.listcontains([
+        astcheck.single_assign(value=ast.Call(func=ast.Name(id='open'))),
+        ast.Expr(value=ast.Call(func=ast.Attribute(attr='read'))),
+    ], gaps=True)),
+}
+
+def find_corpus(corpus_dir, max_files=None):
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(corpus_dir):
+        dirnames[:] = sorted(d for d in dirnames
+                             if not d.startswith('.') and d != 'site-packages')
+        paths.extend(os.path.join(dirpath, f) for f in sorted(filenames) if f.endswith('.py'))
+    return paths[:max_files]
+
+def load_corpus(paths):
+    """Read & parse files, returning (trees, bytes read, parse seconds)"""
+    trees = []
+    nbytes = 0
+    parse_time = 0.
+    for path in paths:
+        try:
+            with open(path, 'rb') as f:
+                source = f.read()
+            start = time.perf_counter()
+            tree = ast.parse(source)
+            parse_time += time.perf_counter() - start
+        except (OSError, SyntaxError, ValueError):
+            continue
+        nbytes += len(source)
+        trees.append(tree)
+    return trees, nbytes, parse_time
+
+# Each method returns the number of matches and the number of nodes checked.
+
+def method_interpreted(trees, template):
+    matches = checked = 0
+    for tree in trees:
+        for node in ast.walk(tree):
+            checked += 1
+            matches += astcheck.is_ast_like(node, template)
+    return matches, checked
+
+def method_compiled(trees, template):
+    compiled = astcheck.compile(template)
+    matches = checked = 0
+    for tree in trees:
+        for node in ast.walk(tree):
+            checked += 1
+            matches += compiled.is_ast_like(node)
+    return matches, checked
+
+def method_iter_matches(trees, template):
+    matches = 0
+    for tree in trees:
+        matches += len(astcheck.find_all(tree, template))
+    return matches, None
+
+METHODS = [
+    ('is_ast_like', method_interpreted),
+    ('compiled', method_compiled),
+    ('iter_matches', method_iter_matches),
+]
+
+def measure(func, *args):
+    """Call func(*args), returning (result, seconds, peak bytes allocated)"""
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, elapsed, peak
+
+def time_only(func, *args, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+def miss_cost(trees, template, limit=20000):
+    """Average seconds for is_ast_like on nodes which don't match"""
+    misses = []
+    for tree in trees:
+        for node in ast.walk(tree):
+            if not astcheck.is_ast_like(node, template):
+                misses.append(node)
+                if len(misses) >= limit:
+                    break
+        if len(misses) >= limit:
+            break
+    if not misses:
+        return None
+
+    def check_all():
+        for node in misses:
+            astcheck.is_ast_like(node, template)
+    _, elapsed = time_only(check_all)
+    return elapsed / len(misses)
+
+def scan_times(paths, rules, repeat=3):
+    """Time scanning files in one process, with no cache, a cold and a warm cache"""
+    def run_scan(cache_dir=None):
+        # No prefilter, so every file without a cache entry is parsed
+        return sum(1 for _ in scan(paths, rules, workers=1, cache_dir=cache_dir,
+                                   prefilter=False))
+    _, uncached = time_only(run_scan, repeat=repeat)
+    cold = None
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            start = time.perf_counter()
+            run_scan(cache_dir)
+            elapsed = time.perf_counter() - start
+            cold = elapsed if cold is None else min(cold, elapsed)
+    with tempfile.TemporaryDirectory() as cache_dir:
+        run_scan(cache_dir)
+        _, warm = time_only(run_scan, cache_dir, repeat=repeat)
+    return {'uncached_seconds': uncached, 'cold_seconds': cold, 'warm_seconds': warm}
+
+def run(corpus_dir, max_files=None, repeat=3):
+    paths = find_corpus(corpus_dir, max_files)
+    trees, nbytes, parse_time = load_corpus(paths)
+    # Tracing allocations slows parsing down, so measure memory separately
+    del trees
+    _, _, parse_peak = measure(load_corpus, paths)
+    trees, _, _ = load_corpus(paths)
+    nnodes = sum(1 for tree in trees for _ in ast.walk(tree))
+    results = {
+        'python': platform.python_implementation() + ' ' + platform.python_version(),
+        'astcheck': astcheck.__version__,
+        'corpus': {'files': len(trees), 'bytes': nbytes, 'nodes': nnodes,
+                   'parse_seconds': parse_time, 'parse_peak_bytes': parse_peak},
+        'templates': {},
+    }
+
+    for name, template in TEMPLATES.items():
+        template_results = {}
+        for method_name, method in METHODS:
+            (matches, _), elapsed = time_only(method, trees, template, repeat=repeat)
+            _, _, peak = measure(method, trees, template)
+            template_results[method_name] = {
+                'matches': matches,
+                'seconds': elapsed,
+                'matches_per_second': matches / elapsed if elapsed else None,
+                'nodes_per_second': nnodes / elapsed if elapsed else None,
+                'peak_bytes': peak,
+            }
+        template_results['miss_seconds'] = miss_cost(trees, template)
+        results['templates'][name] = template_results
+
+    ruleset = astcheck.RuleSet(TEMPLATES)
+    def run_ruleset():
+        return sum(1 for tree in trees for _ in ruleset.iter_matches(tree))
+    matches, elapsed = time_only(run_ruleset, repeat=repeat)
+    _, _, peak = measure(run_ruleset)
+    results['ruleset'] = {'matches': matches, 'seconds': elapsed,
+                          'matches_per_second': matches / elapsed if elapsed else None,
+                          'peak_bytes': peak}
+    results['scan'] = scan_times(paths, ruleset, repeat=repeat)
+    return results
+
+def format_results(results):
+    corpus = results['corpus']
+    lines = [
+        "astcheck {} on {}".format(results['astcheck'], results['python']),
+        "Corpus: {files} files, {bytes} bytes, {nodes} nodes".format(**corpus),
+        "Parse: {:.3f} s, peak {:.1f} MiB".format(
+            corpus['parse_seconds'], corpus['parse_peak_bytes'] / 2**20),
+        "",
+        "{:<16} {:<13} {:>8} {:>10} {:>11} {:>14} {:>10}".format(
+            'template', 'method', 'matches', 'match s', 'matches/s', 'nodes/s', 'peak KiB'),
+    ]
+    for name, template_results in results['templates'].items():
+        for method_name, _ in METHODS:
+            r = template_results[method_name]
+            lines.append("{:<16} {:<13} {:>8} {:>10.4f} {:>11,.0f} {:>14,.0f} {:>10.1f}".format(
+                name, method_name, r['matches'], r['seconds'], r['matches_per_second'] or 0,
+                r['nodes_per_second'] or 0, r['peak_bytes'] / 1024))
+        miss = template_results['miss_seconds']
+        if miss is not None:
+            lines.append("{:<16} {:<13} {:>8} {:>10} {:>11} {:>11.0f} ns".format(
+                name, 'per miss', '', '', '', miss * 1e9))
+    r = results['ruleset']
+    lines += ["", "RuleSet of {} templates: {} matches, {:.4f} s, {:,.0f} matches/s, "
+                  "match/parse time {:.2f}, peak {:.1f} KiB".format(
+                      len(TEMPLATES), r['matches'], r['seconds'], r['matches_per_second'] or 0,
+                      r['seconds'] / corpus['parse_seconds'], r['peak_bytes'] / 1024)]
+    r = results['scan']
+    lines.append("Scan: {:.3f} s uncached, {:.3f} s with a cold cache, {:.3f} s with a "
+                 "warm cache ({:.2f} x parse time)".format(
+                     r['uncached_seconds'], r['cold_seconds'], r['warm_seconds'],
+                     r['warm_seconds'] / corpus['parse_seconds']))
+    return "\n".join(lines)
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument('--corpus', default=sysconfig.get_paths()['stdlib'],
+                    help="Directory of Python files (default: the standard library)")
+    ap.add_argument('--max-files', type=int, default=200,
+                    help="Only use this many files from the corpus (default: 200)")
+    ap.add_argument('--repeat', type=int, default=3,
+                    help="Take the best time of this many runs")
+    ap.add_argument('--json', help="Also write results to this JSON file")
+    args = ap.parse_args(argv)
+
+    results = run(args.corpus, args.max_files, args.repeat)
+    print(format_results(results))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,3 +1,4 @@
+import os
 import sys
 import unittest
 import re
@@ -10,6 +11,8 @@ from astcheck import (assert_ast_like, is_ast_like, mkarg, format_path,
                       listmiddle, name_or_attr,
                      )
 
+pytest_plugins = ['pytester']
+
 sample1_code = """
 def foobar(z, y, a, x, d):
     pass
@@ -350,3 +353,1194 @@ class TestCheckerFunction(unittest.TestCase):
 def test_missing_field():
     mod = ast.parse("import foo as bar")
     assert_ast_like(mod.body[0], ast.Import(names=[ast.alias(name='foo')]))
+
+
+compile_cases = [
+    (sample1, template1),
+    (sample1, template1_wrongnode),
+    (sample1, template1_wrongnodelist),
+    (sample1, template1_wrongvalue),
+    (sample2, template2),
+    (sample2, template2_wronglist),
+    (sample3, template3),
+    (sample3, template3_too_few_nodes),
+    (sample3, template3_wrong_front),
+    (sample3, template3_wrong_back),
+    (sample3, template3_wrong_node_type),
+    (sample4, template4),
+    (sample4, template4_not_name_or_attr),
+    (sample4, template4_name_wrong),
+    (sample4, template4_attr_wrong),
+    (number_sample, number_template_ok),
+    (number_sample, number_template_wrong),
+    (for_else_sample.body[0], for_else_template),
+    (for_noelse_sample.body[0], for_else_template),
+    (for_else_sample.body[0], for_noelse_template),
+    (assign_sample.body[0], astcheck.single_assign(target=ast.Name(id='a'))),
+    (assign_sample.body[1], astcheck.single_assign()),
+    (assign_sample.body[2], astcheck.single_assign(value=ast.Constant(99))),
+    (sample4, ast.Expression(body=ast.BinOp(right=ast.Constant(value=astcheck.compare('<', 7))))),
+    (sample4, ast.Expression(body=ast.BinOp(right=ast.Constant(value=astcheck.compare('>', 7))))),
+    (sample4, ast.Expression(body=ast.BinOp(left=ast.BinOp(
+        right=ast.Name(id=astcheck.one_of('c', 'd')))))),
+    (sample4, ast.Expression(body=ast.BinOp(left=ast.BinOp(
+        right=ast.Name(id=astcheck.one_of('d', 'e')))))),
+    (sample4, ast.Expression(body=ast.BinOp(left=ast.BinOp(
+        left=name_or_attr(astcheck.matches_regex('[a-c]')))))),
+    (sample4, ast.Expression(body=ast.BinOp(left=ast.BinOp(
+        left=name_or_attr(astcheck.matches_regex('b.')))))),
+    (assign_sample.body[1], ast.Assign(value=astcheck.must_not_exist)),
+    (sample4, ast.Expression(body=ast.BinOp(right=astcheck.any_of(
+        ast.Name(), ast.Constant(value=4))))),
+    (sample4, ast.Expression(body=ast.BinOp(right=astcheck.any_of(
+        ast.Name(), ast.Constant(value=5))))),
+    (sample4, ast.Expression(body=ast.BinOp(right=astcheck.any_of(
+        ast.Constant(value=5), ast.Constant(value=6))))),
+    (sample4, ast.Expression(body=ast.BinOp(right=astcheck.any_of(
+        ast.Name(), name_or_attr('x'))))),
+    (sample4, ast.Expression(body=ast.BinOp(right=astcheck.not_(ast.Name())))),
+    (sample4, ast.Expression(body=ast.BinOp(right=astcheck.not_(ast.Constant())))),
+]
+
+def _mismatch(sample, template):
+    try:
+        assert_ast_like(sample, template)
+    except astcheck.ASTMismatch as e:
+        return e
+
+@pytest.mark.parametrize(('sample', 'template'), compile_cases)
+def test_compiled_like_interpreted(sample, template):
+    compiled = astcheck.compile(template)
+    expected = _mismatch(sample, template)
+    assert compiled.is_ast_like(sample) == (expected is None)
+    if expected is None:
+        compiled.assert_ast_like(sample)
+    else:
+        with pytest.raises(type(expected)) as raised:
+            compiled.assert_ast_like(sample)
+        assert raised.value.path == expected.path
+        assert str(raised.value) == str(expected)
+
+def test_compiled_as_checker():
+    compiled = astcheck.compile(ast.Attribute(attr='q'))
+    template = ast.Expression(body=ast.BinOp(left=ast.BinOp(left=compiled)))
+    with pytest.raises(astcheck.ASTPlainObjMismatch) as raised:
+        assert_ast_like(sample4, template)
+    assert raised.value.path == ['tree', 'body', 'left', 'left', 'attr']
+
+@pytest.mark.parametrize(('sample', 'template'), compile_cases)
+def test_is_ast_like_agrees(sample, template):
+    assert is_ast_like(sample, template) == (_mismatch(sample, template) is None)
+
+def test_is_ast_like_without_exceptions(monkeypatch):
+    def no_mismatch(self, *args):
+        raise RuntimeError("ASTMismatch created")
+    monkeypatch.setattr(astcheck.ASTMismatch, '__init__', no_mismatch)
+
+    for template in [template1_wrongnode, template1_wrongvalue, template2_wronglist,
+                     template3_wrong_back, template4_attr_wrong]:
+        assert not is_ast_like(sample1, template)
+        assert not astcheck.compile(template).is_ast_like(sample1)
+    assert not is_ast_like(for_noelse_sample.body[0], for_else_template)
+    assert not is_ast_like(assign_sample.body[1], astcheck.single_assign())
+
+def test_checker_path_list():
+    seen = []
+    def record_path(node, path):
+        assert type(path) is list
+        seen.append((list(path), len(path), path[-1], format_path(path), path + ['x']))
+
+    assert_ast_like(sample4, ast.Expression(body=ast.BinOp(left=ast.BinOp(right=record_path))))
+    assert seen == [(['tree', 'body', 'left', 'right'], 4, 'right',
+                     'tree.body.left.right', ['tree', 'body', 'left', 'right', 'x'])]
+
+    del seen[:]
+    assert_ast_like(sample3, ast.Module(body=listmiddle() + [record_path]))
+    assert seen[0][0] == ['tree', 'body', -1]
+
+    del seen[:]
+    assert not is_ast_like(sample4, ast.Expression(body=ast.BinOp(
+        left=astcheck.not_(ast.BinOp(right=record_path)))))
+    assert seen[0][0] == ['tree', 'body', 'left', 'right']
+
+    # Compiled templates inside interpreted ones report the full path
+    inner = astcheck.compile(ast.BinOp(right=ast.Constant(value=99)))
+    with pytest.raises(astcheck.ASTNodeTypeMismatch) as excinfo:
+        assert_ast_like(sample4, ast.Expression(body=ast.BinOp(left=inner)))
+    assert excinfo.value.path == ['tree', 'body', 'left', 'right']
+
+search_sample = ast.parse("""
+f = open('a')
+def g(x):
+    with open(x) as h:
+        return mod.open(h.read())
+""")
+
+def test_iter_matches():
+    template = ast.Call(func=name_or_attr('open'))
+    matches = list(astcheck.iter_matches(search_sample, template))
+    assert [path for node, path in matches] == [
+        ['tree', 'body', 0, 'value'],
+        ['tree', 'body', 1, 'body', 0, 'items', 0, 'context_expr'],
+        ['tree', 'body', 1, 'body', 0, 'body', 0, 'value'],
+    ]
+    assert [node.lineno for node in astcheck.find_all(search_sample, template)] == [2, 4, 5]
+
+def test_iter_matches_equivalent():
+    templates = [
+        ast.Name(id='h'),
+        ast.Call(args=[ast.Name()]),
+        astcheck.single_assign(target=ast.Name(id='f')),
+        astcheck.must_exist,
+        astcheck.compile(ast.With()),
+    ]
+    for template in templates:
+        expected = [node for node in ast.walk(search_sample) if is_ast_like(node, template)]
+        found = astcheck.find_all(search_sample, template)
+        assert sorted(map(id, found)) == sorted(map(id, expected))
+
+def test_ruleset():
+    rules = astcheck.RuleSet({
+        'open': ast.Call(func=name_or_attr('open')),
+        'name_h': ast.Name(id='h'),
+        'any_call': ast.Call(),
+        'assign_f': astcheck.single_assign(target=ast.Name(id='f')),
+        'exists': astcheck.must_exist,
+    })
+    assert len(rules) == 5
+    found = list(rules.iter_matches(search_sample))
+
+    for rule_id, template in rules.rules:
+        expected = list(astcheck.iter_matches(search_sample, template))
+        assert [(node, path) for r, node, path in found if r == rule_id] == expected
+
+    # Rules for the same node come in the order they were given
+    assert [r for r, node, path in found if node is search_sample.body[0].value] \
+        == ['open', 'any_call', 'exists']
+
+def test_search_source_order():
+    tree = ast.parse("@open(1)\ndef f() -> open(2): open(3)\n"
+                     "x = {open(4): open(5), **open(6)}\n"
+                     "y = open(7) if open(8) else open(9)\n")
+    template = ast.Call(func=ast.Name(id='open'))
+    expected = list(range(1, 10))
+    assert [n.args[0].value for n in astcheck.find_all(tree, template)] == expected
+    index = astcheck.TreeIndex(tree)
+    assert [n.args[0].value for n in index.nodes(ast.Call)] == expected
+    assert [n.args[0].value for n in astcheck.find_all(index, template)] == expected
+    assert index.path(index.nodes(ast.Call).__next__()) == \
+        ['tree', 'body', 0, 'decorator_list', 0]
+
+    # Items of two list fields which are mixed together in the source
+    tree = ast.parse("def f(a=open(1), *b, c=open(2), d, e=open(3)): pass\n"
+                     "lambda a, b=open(4), /, c=open(5): 0\n"
+                     "f(x=open(6), *open(7), y=open(8), **open(9))\n"
+                     "class C(open(10), x=open(11), *open(12)): pass\n"
+                     "open(13) < open(14) < open(15)\n")
+    expected = list(range(1, 16))
+    assert [n.args[0].value for n in astcheck.find_all(tree, template)] == expected
+    index = astcheck.TreeIndex(tree)
+    assert [n.args[0].value for n in astcheck.find_all(index, template)] == expected
+    assert [path for node, path in astcheck.iter_matches(tree.body[2], template)] == [
+        ['tree', 'value', 'keywords', 0, 'value'], ['tree', 'value', 'args', 0, 'value'],
+        ['tree', 'value', 'keywords', 1, 'value'], ['tree', 'value', 'keywords', 2, 'value'],
+    ]
+    lt = ast.parse("a < b > c", mode='eval').body
+    assert [type(n) for n in astcheck.TreeIndex(lt).nodes()][1:] == \
+        [ast.Name, ast.Load, ast.Lt, ast.Name, ast.Load, ast.Gt, ast.Name, ast.Load]
+
+    if sys.version_info >= (3, 10):
+        tree = ast.parse("match x:\n    case {'a': 1, 'b': 2, **rest}: pass\n")
+        assert [n.value for n in astcheck.find_all(tree, ast.Constant())] == ['a', 1, 'b', 2]
+
+def test_tree_index():
+    index = astcheck.TreeIndex(search_sample)
+    assert len(index) == len(list(index.nodes())) > 0
+    assert search_sample.body[0] in index
+    calls = list(index.nodes(ast.Call))
+    assert [c.lineno for c in calls] == [2, 4, 5, 5]
+    assert list(index.nodes(ast.Call, ast.Name)) == \
+        [n for n in index.nodes() if isinstance(n, (ast.Call, ast.Name))]
+
+    call = calls[0]
+    assert index.parent(call) is search_sample.body[0]
+    assert index.parent(search_sample) is None
+    assert index.path(call) == ['tree', 'body', 0, 'value']
+
+    for template in [ast.Call(func=name_or_attr('open')), ast.Name(id='h'),
+                     astcheck.single_assign(), astcheck.must_exist, ast.stmt()]:
+        assert list(astcheck.iter_matches(index, template)) == \
+               list(astcheck.iter_matches(search_sample, template))
+
+    rules = astcheck.RuleSet([('open', ast.Call(func=name_or_attr('open'))),
+                              ('name', ast.Name())])
+    assert list(rules.iter_matches(index)) == list(rules.iter_matches(search_sample))
+
+scan_templates_code = """
+import ast, astcheck
+TEMPLATES = {
+    'open': ast.Call(func=astcheck.name_or_attr('open')),
+    'for-else': ast.For(orelse=astcheck.must_exist),
+}
+"""
+
+@pytest.fixture
+def scan_tree(tmp_path):
+    (tmp_path / 'templates_mod.py').write_text(scan_templates_code)
+    src = tmp_path / 'src'
+    (src / 'pkg').mkdir(parents=True)
+    (src / 'a.py').write_text("f = open('x')\n")
+    (src / 'pkg' / 'b.py').write_text("for a in b:\n    pass\nelse:\n    open(a)\n")
+    (src / 'pkg' / 'broken.py').write_text("def (:\n")
+    (src / 'notes.txt').write_text("open()")
+    return tmp_path
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_scan(scan_tree, workers):
+    from astcheck.scan import scan, ScanResult
+    src = scan_tree / 'src'
+    errors = []
+    results = list(scan([str(src)], str(scan_tree / 'templates_mod.py'),
+                        workers=workers, chunksize=1,
+                        on_error=lambda path, msg: errors.append(path)))
+    assert results == [
+        ScanResult(str(src / 'a.py'), 'open', 1, 4),
+        ScanResult(str(src / 'pkg' / 'b.py'), 'for-else', 1, 0),
+        ScanResult(str(src / 'pkg' / 'b.py'), 'open', 4, 4),
+    ]
+    assert errors == [str(src / 'pkg' / 'broken.py')]
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_scan_too_deep(scan_tree, workers):
+    from astcheck.scan import scan
+    src = scan_tree / 'src'
+    # Too deeply nested for the parser, which raises RecursionError
+    (src / 'deep.py').write_text("x = open(" + "+".join(["a"] * 100000) + ")\n")
+    errors = []
+    results = list(scan([str(src)], str(scan_tree / 'templates_mod.py'),
+                        workers=workers, on_error=lambda path, msg: errors.append(path)))
+    assert len(results) == 3
+    assert sorted(errors) == [str(src / 'deep.py'), str(src / 'pkg' / 'broken.py')]
+
+def test_scan_spawned_workers(scan_tree):
+    # Worker processes started with 'spawn' (the default on macOS & Windows)
+    # get the rules by pickling them, not by forking.
+    import multiprocessing
+    import pickle
+    from concurrent.futures import ProcessPoolExecutor
+    from astcheck.scan import _init_worker, _scan_chunk, ScanResult
+    rules = astcheck.RuleSet({'open': ast.Call(func=name_or_attr('open')),
+                              'for-else': ast.For(orelse=astcheck.must_exist)})
+    unpickled = pickle.loads(pickle.dumps(rules))
+    assert [rule_id for rule_id, _ in unpickled.rules] == ['open', 'for-else']
+
+    a_py = str(scan_tree / 'src' / 'a.py')
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_init_worker, initargs=(rules,)) as executor:
+        scanned = executor.submit(_scan_chunk, [a_py]).result()
+    assert scanned == [(a_py, [ScanResult(a_py, 'open', 1, 4)], None)]
+
+def test_scan_cli(scan_tree, capsys):
+    from astcheck.scan import main
+    a_py = str(scan_tree / 'src' / 'a.py')
+    assert main(['scan', '-t', str(scan_tree / 'templates_mod.py'), '-j', '1', a_py]) == 1
+    assert capsys.readouterr().out == "{}:1:4: open\n".format(a_py)
+
+    cache_dir = str(scan_tree / 'cache')
+    assert main(['scan', '-t', str(scan_tree / 'templates_mod.py'), '-j', '2',
+                 '--cache-dir', cache_dir, '--cache-size', '100000', a_py]) == 1
+    assert capsys.readouterr().out == "{}:1:4: open\n".format(a_py)
+    assert os.listdir(cache_dir)
+
+def test_scan_bad_templates(scan_tree, capsys):
+    from astcheck.scan import main, scan
+    (scan_tree / 'no_templates.py').write_text("RULES = {}\n")
+    bad = str(scan_tree / 'no_templates.py')
+    # Templates are loaded once, here, rather than in each worker process
+    with pytest.raises(ValueError):
+        scan([str(scan_tree / 'src')], bad, workers=2)
+
+    assert main(['scan', '-t', bad, '-j', '2', str(scan_tree / 'src')]) == 2
+    err = capsys.readouterr().err
+    assert err.startswith("astcheck: can't load templates from %s: ValueError" % bad)
+    assert len(err.splitlines()) == 1
+
+def test_result_cache(tmp_path):
+    from astcheck.cache import ResultCache
+    rules = astcheck.RuleSet({'open': ast.Call(func=name_or_attr('open'))})
+    cache = ResultCache(str(tmp_path / 'cache'), rules)
+    source = b"f = open('x')\n"
+    assert cache.get(source) is None
+    cache.put(source, [('open', 1, 4)])
+    assert cache.get(source) == [('open', 1, 4)]
+    assert cache.get("f = open('x')\n") is None  # str & bytes cached separately
+    assert open(cache._entry_path(source)).read() == '[[0,1,4]]'
+
+    # Changing the rules gives different entries
+    other = ResultCache(str(tmp_path / 'cache'), astcheck.RuleSet(
+        {'open': ast.Call(func=name_or_attr('open'), args=[])}))
+    assert other.fingerprint != cache.fingerprint
+    assert other.get(source) is None
+
+    with open(cache._entry_path(source), 'w') as f:
+        f.write('[[5, 1, 4]]')  # Corrupt entry
+    assert cache.get(source) is None
+
+def test_rules_fingerprint():
+    from astcheck.cache import rules_fingerprint
+    def fingerprint(template):
+        return rules_fingerprint(astcheck.RuleSet({'r': template}))
+    def make_checker(n):
+        def checker(node, path):
+            assert node == n
+        return checker
+
+    assert fingerprint(ast.Name(id='x')) == fingerprint(ast.Name(id='x'))
+    assert fingerprint(ast.Name(id='x')) != fingerprint(ast.Name(id='y'))
+    assert fingerprint(ast.Constant(value=1)) != fingerprint(ast.Constant(value=True))
+    assert fingerprint(astcheck.one_of('a', 'b')) == fingerprint(astcheck.one_of('b', 'a'))
+    assert fingerprint(astcheck.matches_regex('a')) != fingerprint(astcheck.matches_regex('b'))
+    assert fingerprint(make_checker(1)) == fingerprint(make_checker(1))
+    assert fingerprint(make_checker(1)) != fingerprint(make_checker(2))
+    assert fingerprint(lambda node, path: None) != fingerprint(lambda node, path: 1)
+    with pytest.raises(ValueError):
+        fingerprint(ast.Name(id=object()))
+
+def test_result_cache_prune(tmp_path):
+    from astcheck.cache import ResultCache
+    cache = ResultCache(str(tmp_path), astcheck.RuleSet({'x': ast.Name()}), max_size=10 ** 6)
+    sources = [("x%d = 1\n" % i).encode() for i in range(5)]
+    for i, source in enumerate(sources):
+        cache.put(source, [('x', 1, 0)])
+        os.utime(cache._entry_path(source), (i, i))
+    cache.get(sources[0])  # Mark as recently used
+
+    entry_size = os.path.getsize(cache._entry_path(sources[0]))
+    cache.max_size = entry_size * 3
+    cache.prune()
+    assert [cache.get(s) is not None for s in sources] == [True, False, False, True, True]
+
+def test_scan_cached(scan_tree, monkeypatch):
+    from astcheck.scan import scan
+    cache_dir = str(scan_tree / 'cache')
+    args = ([str(scan_tree / 'src')], str(scan_tree / 'templates_mod.py'))
+    uncached = list(scan(*args, workers=1))
+    assert list(scan(*args, workers=1, cache_dir=cache_dir)) == uncached
+    assert os.listdir(cache_dir)
+    assert list(scan(*args, workers=2, cache_dir=cache_dir)) == uncached
+
+    # Files found in the cache aren't parsed again
+    def no_parse(*args, **kwargs):
+        raise AssertionError("Parsed again")
+    good = [str(scan_tree / 'src' / 'a.py'), str(scan_tree / 'src' / 'pkg' / 'b.py')]
+    monkeypatch.setattr(ast, 'parse', no_parse)
+    assert list(scan(good, args[1], workers=1, cache_dir=cache_dir, prefilter=False)) == uncached
+
+def test_required_names():
+    template = ast.Module(body=[
+        ast.ImportFrom(module='os.path', names=[ast.alias(name='join')]),
+        ast.Global(names=['g']),
+    ] + listmiddle() + [
+        astcheck.single_assign(target=name_or_attr('f'), value=ast.Call(
+            func=ast.Attribute(attr='meth'), keywords=[ast.keyword(arg='kw')])),
+        ast.FunctionDef(name='func', args=ast.arguments(args=[mkarg('a')]),
+                        body=[ast.Return(value=ast.Constant(value='notaname'))]),
+    ])
+    assert astcheck.required_names(template) == \
+        {'os', 'path', 'join', 'g', 'f', 'meth', 'kw', 'func', 'a'}
+    assert astcheck.required_names(astcheck.compile(ast.Name(id='x'))) == {'x'}
+    assert astcheck.required_names(for_else_template) == set()
+    assert astcheck.required_names(number_template_ok) == set()
+
+def test_source_prefilter():
+    from astcheck.scan import SourcePrefilter
+    prefilter = SourcePrefilter(astcheck.RuleSet({
+        'a': ast.Call(func=name_or_attr('open')),
+        'b': ast.Assign(targets=[ast.Name(id='x')], value=ast.Name(id='y')),
+    }))
+    assert prefilter.could_match(b"open(f)")
+    assert prefilter.could_match("x = y")
+    assert not prefilter.could_match(b"x = z")
+    assert not prefilter.could_match("print(x)")
+    # Non-ASCII source is decoded and normalised as the parser does
+    assert not prefilter.could_match("# \u00e9\nprint(x)".encode('utf-8'))
+    assert not prefilter.could_match("# \u00e9\nprint(x)")
+    assert prefilter.could_match("\uff4f\uff50\uff45\uff4e(f)")  # Fullwidth letters
+    assert prefilter.could_match("\uff4f\uff50\uff45\uff4e(f)".encode('utf-8'))
+    assert prefilter.could_match("# coding: latin-1\n'\u00e9'; open(f)".encode('latin-1'))
+    assert prefilter.could_match(b"# coding: nonsense\n'\xe9'; print(x)")
+
+@pytest.mark.parametrize('prefilter', [True, False])
+def test_scan_prefilter_errors(scan_tree, prefilter):
+    from astcheck.scan import scan
+    # broken.py doesn't contain 'open', so the prefilter skips it unparsed
+    errors = []
+    list(scan([str(scan_tree / 'src')], {'open': ast.Call(func=name_or_attr('open'))},
+              workers=1, prefilter=prefilter,
+              on_error=lambda path, msg: errors.append(path)))
+    assert errors == ([] if prefilter else [str(scan_tree / 'src' / 'pkg' / 'broken.py')])
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_scan_prefilter(scan_tree, workers):
+    from astcheck.scan import scan
+    args = ([str(scan_tree / 'src')], str(scan_tree / 'templates_mod.py'))
+    assert list(scan(*args, workers=workers)) == list(scan(*args, workers=workers, prefilter=False))
+
+def test_scan_pipeline_lazy(scan_tree):
+    from astcheck.scan import _scan_files, _as_ruleset, ScanResult
+    rules = _as_ruleset({'open': ast.Call(func=name_or_attr('open'))})
+    src = scan_tree / 'src'
+    taken = []
+
+    def paths():
+        for name in ['a.py', 'missing.py', 'pkg/broken.py']:
+            taken.append(name)
+            yield str(src / name)
+
+    scanned = _scan_files(paths(), rules)
+    assert next(scanned) == (str(src / 'a.py'), [ScanResult(str(src / 'a.py'), 'open', 1, 4)], None)
+    assert taken == ['a.py']
+    path, results, error = next(scanned)
+    assert results == [] and error.startswith('FileNotFoundError')
+    assert next(scanned)[2].startswith('SyntaxError')
+
+def test_bounded_map():
+    from concurrent.futures import ThreadPoolExecutor
+    from astcheck.scan import _bounded_map
+    taken = []
+
+    def items():
+        for i in range(100):
+            taken.append(i)
+            yield i
+
+    with ThreadPoolExecutor(2) as executor:
+        results = _bounded_map(executor, lambda x: x * 2, items(), 4)
+        assert [next(results) for _ in range(3)] == [0, 2, 4]
+        assert len(taken) <= 7
+        assert list(results) == [i * 2 for i in range(3, 100)]
+
+@pytest.mark.parametrize('processes', [False, True])
+def test_aiter_matches(scan_tree, processes):
+    import asyncio
+    from astcheck.scan import aiter_matches, ScanResult
+    templates = str(scan_tree / 'templates_mod.py')
+
+    async def sources():
+        yield 'a.py', "f = open('x')\n"
+        yield 'broken.py', b"open(\n"
+        await asyncio.sleep(0.01)
+        yield 'b.py', b"for a in b:\n    pass\nelse:\n    open(a)\n"
+
+    async def collect():
+        errors = []
+        results = [r async for r in aiter_matches(
+            sources(), templates, workers=2, processes=processes,
+            on_error=lambda path, msg: errors.append(path))]
+        return results, errors
+
+    results, errors = asyncio.run(collect())
+    assert sorted(results) == [
+        ScanResult('a.py', 'open', 1, 4),
+        ScanResult('b.py', 'for-else', 1, 0),
+        ScanResult('b.py', 'open', 4, 4),
+    ]
+    assert errors == ['broken.py']
+
+def test_aiter_matches_too_deep():
+    import asyncio
+    from astcheck.scan import aiter_matches
+    sources = [('deep.py', "open(" + "+".join(["a"] * 100000) + ")\n"),
+               ('ok.py', "open(a)\n")]
+
+    async def collect():
+        errors = []
+        results = [r async for r in aiter_matches(
+            sources, {'open': ast.Call(func=name_or_attr('open'))}, workers=1,
+            on_error=lambda path, msg: errors.append(path))]
+        return results, errors
+
+    results, errors = asyncio.run(collect())
+    assert [r.path for r in results] == ['ok.py']
+    assert errors == ['deep.py']
+
+# Stopping early must shut the worker pool down cleanly
+@pytest.mark.filterwarnings('error::pytest.PytestUnhandledThreadExceptionWarning')
+@pytest.mark.parametrize('processes', [False, True])
+def test_aiter_matches_backpressure(processes):
+    import asyncio
+    from astcheck.scan import aiter_matches
+    taken = []
+
+    def sources():
+        for i in range(100):
+            taken.append(i)
+            yield 'f%d.py' % i, "open(x)\n"
+
+    async def first():
+        matches = aiter_matches(sources(), {'open': ast.Call(func=name_or_attr('open'))},
+                                workers=1, max_pending=3, processes=processes)
+        async for result in matches:
+            await matches.aclose()
+            return result
+
+    assert asyncio.run(first()).rule_id == 'open'
+    assert len(taken) <= 3
+
+def test_required_node_types():
+    assert astcheck.required_node_types(for_else_template) == {ast.For}
+    assert astcheck.required_node_types(template4) == \
+        {ast.Expression, ast.BinOp, ast.Mult, ast.Add, ast.Constant}
+    assert astcheck.required_node_types(
+        ast.Module(body=listmiddle() + [astcheck.single_assign(value=ast.Call())])
+    ) == {ast.Module, ast.Call}
+
+    present = astcheck.node_types_present(search_sample)
+    assert {ast.Module, ast.With, ast.Call, ast.stmt, ast.expr, ast.AST} <= present
+    assert ast.For not in present
+    assert astcheck.TreeIndex(search_sample).node_types == present
+
+def test_node_type_fingerprint_search():
+    index = astcheck.TreeIndex(search_sample)
+    # Name(id='h') alone matches, but the tree has no For loop
+    template = ast.Name(id='h')
+    with_for = ast.Module(body=listmiddle() + [ast.For()])
+    assert astcheck.find_all(index, template)
+    assert astcheck.find_all(index, with_for) == []
+
+    rules = astcheck.RuleSet({'for': ast.For(body=[ast.Pass()]),
+                              'h': template, 'mod': with_for})
+    assert [r for r, node, path in rules.iter_matches(index)] == ['h', 'h']
+    assert list(rules.iter_matches(index)) == list(rules.iter_matches(search_sample))
+
+contains_sample = ast.parse("""
+def f():
+    a = 1
+    fh = open(a)
+    log(a)
+    fh.read()
+    return fh
+""").body[0]
+
+def test_listcontains():
+    opens = astcheck.single_assign(value=ast.Call(func=ast.Name(id='open')))
+    reads = ast.Expr(value=ast.Call(func=ast.Attribute(attr='read')))
+    returns = ast.Return()
+
+    for make in [lambda t: t, astcheck.compile]:
+        check = lambda template: make(ast.FunctionDef(body=template))
+        assert_ast_like(contains_sample, check(astcheck.listcontains([reads, returns])))
+        assert is_ast_like(contains_sample, check(astcheck.listcontains([opens])))
+        assert not is_ast_like(contains_sample, check(astcheck.listcontains([opens, reads])))
+        assert is_ast_like(contains_sample, check(astcheck.listcontains([opens, reads], gaps=True)))
+        assert not is_ast_like(contains_sample, check(astcheck.listcontains([reads, opens], gaps=True)))
+
+        with pytest.raises(astcheck.ASTMismatch) as raised:
+            assert_ast_like(contains_sample, check(astcheck.listcontains([opens, reads])))
+        assert raised.value.path == ['tree', 'body']
+        assert "run of 2 matching" in str(raised.value)
+
+def test_listcontains_empty():
+    for gaps in [False, True]:
+        template = ast.FunctionDef(body=astcheck.listcontains([], gaps=gaps))
+        for code in ["def f(): pass", "def f():\n    a = 1\n    return a"]:
+            func = ast.parse(code).body[0]
+            assert is_ast_like(func, template)
+            assert astcheck.compile(template).is_ast_like(func)
+            assert_ast_like(func, template)
+        assert not is_ast_like(ast.Pass(), astcheck.listcontains([], gaps=gaps))
+
+def test_listcontains_checker_path():
+    paths = []
+    def record(node, path):
+        paths.append(list(path))
+        if not isinstance(node, ast.Return):
+            raise astcheck.ASTNodeTypeMismatch(path, node, 'Return')
+    for make in [lambda t: t, astcheck.compile]:
+        del paths[:]
+        assert is_ast_like(contains_sample, make(ast.FunctionDef(
+            body=astcheck.listcontains([ast.Expr(), record]))))
+        assert paths[-1] == ['tree', 'body', 4]
+
+def _contains_reference(sample, items, gaps):
+    import itertools
+    n, k = len(sample), len(items)
+    if gaps:
+        positions = itertools.combinations(range(n), k)
+    else:
+        positions = (range(s, s + k) for s in range(n - k + 1))
+    return any(all(is_ast_like(sample[j], item) for j, item in zip(pos, items))
+               for pos in positions)
+
+def test_listcontains_search_random():
+    import random
+    rng = random.Random(42)
+    def node():
+        return rng.choice([ast.Pass(), ast.Break(), ast.Expr(value=ast.Name(id=rng.choice('ab')))])
+    def item():
+        return rng.choice([ast.Pass(), ast.Expr(), ast.Expr(value=ast.Name(id='a')),
+                           astcheck.must_exist, ast.stmt()])
+
+    for _ in range(300):
+        sample = [node() for _ in range(rng.randrange(8))]
+        items = [item() for _ in range(rng.randrange(1, 4))]
+        for gaps in (False, True):
+            template = astcheck.listcontains(items, gaps=gaps)
+            expected = _contains_reference(sample, items, gaps)
+            assert is_ast_like(sample, template) == expected
+            assert astcheck.compile(template).is_ast_like(sample) == expected
+
+capture_sample = ast.parse("""
+x = x + 1
+y = x + 1
+fh.read()
+""")
+
+def test_capture():
+    template = ast.Expr(value=ast.Call(
+        func=ast.Attribute(value=astcheck.capture('obj'), attr='read')))
+    bindings = astcheck.match_ast(capture_sample.body[2], template)
+    assert bindings == {'obj': capture_sample.body[2].value.func.value}
+    assert astcheck.compile(template).match(capture_sample.body[2]) == bindings
+    assert astcheck.match_ast(capture_sample.body[0], template) is None
+    assert astcheck.match_ast(capture_sample.body[2], ast.Expr()) == {}
+
+    # capture with a template
+    template = astcheck.single_assign(
+        target=astcheck.capture('target', ast.Name(id='y')))
+    assert astcheck.match_ast(capture_sample.body[1], template) == \
+        {'target': capture_sample.body[1].targets[0]}
+    assert astcheck.match_ast(capture_sample.body[0], template) is None
+
+def test_backref():
+    increment = astcheck.single_assign(target=astcheck.capture('var'),
+                                       value=ast.BinOp(left=astcheck.backref('var')))
+    for make in [lambda t: t, astcheck.compile]:
+        template = make(increment)
+        assert_ast_like(capture_sample.body[0], template)
+        assert is_ast_like(capture_sample.body[0], template)
+        assert not is_ast_like(capture_sample.body[1], template)
+        with pytest.raises(astcheck.ASTMismatch) as raised:
+            assert_ast_like(capture_sample.body[1], template)
+        assert raised.value.path == ['tree', 'value', 'left']
+        assert "same as captured 'var'" in str(raised.value)
+
+    # Captures don't leak from one match to the next
+    assert not is_ast_like(capture_sample.body[0], ast.Assign(value=astcheck.backref('var')))
+
+    # Capturing the same name twice also requires the same structure
+    twice = ast.Assign(targets=[astcheck.capture('v')],
+                       value=ast.BinOp(left=astcheck.capture('v')))
+    assert is_ast_like(capture_sample.body[0], twice)
+    assert not is_ast_like(capture_sample.body[1], twice)
+
+def test_capture_search():
+    template = astcheck.single_assign(target=astcheck.capture('var'),
+                                      value=ast.BinOp(left=astcheck.backref('var')))
+    assert astcheck.find_all(capture_sample, template) == [capture_sample.body[0]]
+
+def test_capture_listcontains_rollback():
+    sample = ast.parse("a = 1\nb = 2\nb = 3").body
+    # The first attempt captures 'a' and fails; it mustn't stop 'b' matching
+    template = astcheck.listcontains([
+        ast.Assign(targets=[astcheck.capture('t')]),
+        ast.Assign(targets=[astcheck.backref('t')]),
+    ])
+    assert astcheck.match_ast(sample, template) == {'t': sample[1].targets[0]}
+    assert astcheck.compile(template).match(sample) == {'t': sample[1].targets[0]}
+
+def test_structure_key():
+    a, b = ast.parse("f(x, 1.0)\nf(x,  1.0)").body
+    assert astcheck._structure_key(a) == astcheck._structure_key(b)
+    for other in ["f(x, -0.0)", "f(x, True)", "f(x, 1)", "g(x, 1.0)", "f(x)"]:
+        assert astcheck._structure_key(a) != astcheck._structure_key(ast.parse(other).body[0])
+
+def test_structure_table():
+    table = astcheck.StructureTable()
+    a, b = ast.parse("f(x, 1.0)\nf(x,  1.0)").body
+    assert table.fingerprint(a) == table.fingerprint(b)
+    for other in ["f(x, -0.0)", "f(x, True)", "f(x, 1)", "g(x, 1.0)", "f(x)"]:
+        assert table.fingerprint(a) != table.fingerprint(ast.parse(other).body[0])
+    assert table.size(table.fingerprint(a)) == 5  # Expr, Call, 2 Names, Constant
+
+    # Contexts are ignored
+    store, load = ast.parse("x = x").body[0].targets[0], ast.parse("x").body[0].value
+    assert table.fingerprint(store) == table.fingerprint(load)
+
+    tree = ast.parse("a = f(x)\nif a:\n    b = f(x)\n    c = f(y)\n")
+    index = astcheck.TreeIndex(tree)
+    found = index.same_structure(ast.parse("f(x)", mode='eval').body)
+    assert [node.lineno for node in found] == [1, 3]
+    assert index.same_structure(ast.parse("f(z)", mode='eval').body) == []
+
+def test_find_duplicates():
+    repeated = "def {}(a):\n    if a is None:\n        a = []\n    return sorted(a)\n"
+    trees = {
+        'a.py': ast.parse(repeated.format('f') + "x = sorted(a)\n"),
+        'b.py': ast.parse("class C:\n    " + repeated.format('g').replace('\n', '\n    ')),
+    }
+    def summary(groups):
+        return [[(label, type(node).__name__) for label, node in group] for group in groups]
+
+    # The function names differ, so the largest duplicates are statements in
+    # its body. Their parts aren't reported separately.
+    assert summary(astcheck.find_duplicates(trees, min_nodes=4)) == [
+        [('a.py', 'If'), ('b.py', 'If')],
+        [('a.py', 'Return'), ('b.py', 'Return')],
+    ]
+    # ...unless they also occur elsewhere
+    assert summary(astcheck.find_duplicates(trees, min_nodes=3))[-1] == \
+        [('a.py', 'Call'), ('a.py', 'Call'), ('b.py', 'Call')]
+    assert astcheck.find_duplicates(trees, min_nodes=20) == []
+
+def test_profiler():
+    from astcheck.instrument import Profiler
+    def is_open(node, path):
+        if node != 'open':
+            raise astcheck.ASTMismatch(path, node, 'open')
+
+    profiler = Profiler()
+    seen = []
+    profiler.add_hook(lambda label, sample, matched, depth, secs:
+                      seen.append((label, type(sample).__name__, matched, depth)))
+    rules = profiler.ruleset({'open-call': ast.Call(func=ast.Name(id=is_open))})
+    tree = ast.parse("open(f)\nprint(x)\ny = 1")
+    assert [m[0] for m in rules.iter_matches(tree)] == ['open-call']
+
+    stats = profiler.stats['open-call']
+    assert (stats.calls, stats.hits, stats.misses) == (2, 1, 1)
+    # print(x) fails at tree.func.id, 2 steps down
+    assert stats.mismatch_depths == {2: 1}
+    checker = stats.checkers[is_open.__qualname__]
+    assert (checker.calls, checker.failures) == (2, 1)
+    assert ('open-call', 'Call', False, 2) in seen
+    assert 'open-call' in profiler.report()
+
+    with pytest.raises(astcheck.ASTMismatch):
+        rules.rules[0][1].assert_ast_like(tree.body[1].value)
+    assert stats.misses == 2
+
+    profiler.reset()
+    assert stats.calls == 0 and stats.checkers[is_open.__qualname__].calls == 0
+
+def test_profiler_listcontains_depth():
+    from astcheck.instrument import Profiler
+    profiler = Profiler()
+    item = ast.Expr(value=ast.Call(func=ast.Name(id='open')))
+    sample = ast.parse("print(x)")
+    assert not profiler.compile(ast.Module(body=[item]), label='list').is_ast_like(sample)
+    assert not profiler.compile(ast.Module(body=astcheck.listcontains([item])),
+                                label='listcontains').is_ast_like(sample)
+    # Both fail at the Name node tree.body[0].value.func, 4 steps down
+    assert profiler.stats['list'].mismatch_depths == {4: 1}
+    assert profiler.stats['listcontains'].mismatch_depths == {4: 1}
+
+def test_profiler_pickle():
+    import pickle
+    from astcheck.instrument import InstrumentedTemplate, Profiler
+    profiler = Profiler()
+    rules = profiler.ruleset({'open-call': ast.Call(func=ast.Name(id='open'))})
+    unpickled = pickle.loads(pickle.dumps(rules))
+    template = unpickled.rules[0][1]
+    assert isinstance(template, InstrumentedTemplate)
+    assert template.label == 'open-call'
+
+    assert [m[0] for m in unpickled.iter_matches(ast.parse("open(f)\nprint(x)"))] == ['open-call']
+    assert template.profiler.stats['open-call'].calls == 2
+    assert profiler.stats['open-call'].calls == 0  # The copy has its own statistics
+
+incremental_source = """\
+import os
+
+@decorator
+def f(path):
+    return open(path)
+
+x = 1; y = open('a')
+
+class C:
+    def g(self):
+        pass
+"""
+
+@pytest.mark.parametrize('old, new', [
+    ("return open(path)", "return open(path, 'rb')"),
+    ("        pass\n", "        pass\n    h = open\n"),
+    ("    return open(path)\n", "    return open(path)\nelse_ = 2\n"),
+    ("y = open('a')", "y = close('a')"),
+    ("@decorator\n", "@decorator\n@other\n"),
+    ("import os\n", "import os\nimport sys\n\n"),
+    ("\nclass C", "\nif 1:\n    pass\nelse:\n    open()\nclass C"),
+    ("x = 1; ", ""),
+])
+def test_incremental_session(old, new):
+    from astcheck.incremental import Session
+    rules = astcheck.RuleSet({
+        'open-call': ast.Call(func=ast.Name(id='open')),
+        'func': ast.FunctionDef(),
+    })
+    def key(matches):
+        return [(rule_id, ast.dump(node, include_attributes=True), path)
+                for rule_id, node, path in matches]
+
+    session = Session(rules)
+    assert key(session.update(incremental_source)) == \
+        key(rules.iter_matches(ast.parse(incremental_source)))
+    assert session.last_rechecked == 5
+
+    edited = incremental_source.replace(old, new)
+    assert key(session.update(edited)) == key(rules.iter_matches(ast.parse(edited)))
+    assert ast.dump(session.tree, include_attributes=True) == \
+        ast.dump(ast.parse(edited), include_attributes=True)
+    assert session.last_rechecked < len(session.tree.body)
+
+    with pytest.raises(SyntaxError):
+        session.update(edited + "(")
+    assert key(session.update(edited)) == key(rules.iter_matches(ast.parse(edited)))
+
+def test_incremental_edit():
+    from astcheck.incremental import Session
+    rules = astcheck.RuleSet({
+        'open-call': ast.Call(func=ast.Name(id='open')),
+        'func': ast.FunctionDef(),
+    })
+    def key(matches):
+        return [(rule_id, ast.dump(node, include_attributes=True), path)
+                for rule_id, node, path in matches]
+
+    session = Session(rules)
+    session.update(incremental_source)
+    lines = incremental_source.splitlines(keepends=True)
+    # Several edits in a row, checking the matches but not the whole tree
+    for start, stop, text in [
+            (0, 0, "import sys\n\n"),          # Insert at the top
+            (6, 7, "    return open(path, 'rb')\n"),
+            (8, 9, "x = 1\ny = open('a')\nz = 2\n"),
+            (15, 15, "    h = open\n"),           # Add to the end of a class
+            (3, 4, ""),                          # Delete a line
+            (1, 1, "pass"),                      # Joined to the next line
+            (0, 1, "f(import_=open())\n"),
+    ]:
+        lines[start:stop] = [text]
+        source = ''.join(lines)
+        lines = source.splitlines(keepends=True)
+        assert key(session.edit(start, stop, text)) == \
+            key(rules.iter_matches(ast.parse(source)))
+    assert ast.dump(session.tree, include_attributes=True) == \
+        ast.dump(ast.parse(source), include_attributes=True)
+    assert session.last_rechecked < len(session.tree.body)
+
+    with pytest.raises(SyntaxError):
+        session.edit(0, 0, "(\n")
+    assert key(session.edit(0, 0, "")) == key(rules.iter_matches(ast.parse(source)))
+    with pytest.raises(IndexError):
+        session.edit(0, 100, "")
+
+pattern_sample = ast.parse("""\
+def read(path, mode='r'):
+    fh = open(path, mode)
+    data = fh.read()
+    return data
+
+x = x + 1
+""")
+
+def test_pattern():
+    func, incr = pattern_sample.body
+    open_call = func.body[0].value
+    assert astcheck.match("open(__)", open_call) is None
+    assert astcheck.match("open(__, __)", open_call) == {}
+    assert astcheck.match("open(__path, ___)", open_call) == {'path': open_call.args[0]}
+    assert astcheck.match("__v = __v + 1", incr) == {'v': incr.targets[0]}
+    assert astcheck.match("__v = __v + 2", incr) is None
+
+    # List wildcards at the ends, and around items
+    assert astcheck.match("def read(___):\n    ___\n    return data", func) == {}
+    assert astcheck.match("""
+        def __(___):
+            ___
+            __f = open(___)
+            ___
+        """, func) == {'f': func.body[0].targets[0]}
+    assert is_ast_like(func, astcheck.pattern(
+        "def __(___):\n ___\n fh = __\n ___\n return __\n ___"))
+    assert not is_ast_like(func, astcheck.pattern("def __(___):\n ___\n return __\n ___\n fh = __\n ___"))
+    with pytest.raises(ValueError):
+        astcheck.pattern("f(a, ___, b, c, ___, d)")
+    with pytest.raises(ValueError):
+        astcheck.pattern("___")
+
+    # Dunder names are literal
+    assert astcheck.match("__init__", ast.parse("__init__", mode='eval').body) == {}
+    assert astcheck.match("__init__", ast.parse("other", mode='eval').body) is None
+
+    assert astcheck.find_all(pattern_sample, astcheck.pattern("__.read()")) == \
+        [func.body[1].value]
+    assert astcheck.compile_pattern("open(__)") is astcheck.compile_pattern("open(__)")
+
+def test_pattern_arguments():
+    func = pattern_sample.body[0]
+    assert astcheck.match("def read(path, ___):\n    ___", func) == {}
+    assert astcheck.match("def read(___, mode=__m):\n    ___", func) == {'m': func.args.defaults[0]}
+    assert astcheck.match("def read(path):\n    ___", func) is None
+    assert astcheck.match("def read(___, *args):\n    ___", func) is None
+
+def test_find_mismatches():
+    sample = ast.parse("""\
+def f(a, b):
+    x = a + 1
+    y = b
+    return x
+""")
+    template = ast.Module(body=[ast.FunctionDef(
+        name='g',
+        args=ast.arguments(args=[ast.arg(arg='a'), ast.arg(arg='c')]),
+        body=[
+            ast.Assign(value=ast.BinOp(left=ast.Name(id='b'), op=ast.Sub())),
+            ast.Assign(value=ast.Call(func=ast.Name(id='h'))),  # Wrong type
+            ast.Return(value=astcheck.must_not_exist),
+        ])])
+    mismatches = astcheck.find_mismatches(sample, template)
+    assert [(m.kind, m.path) for m in mismatches] == [
+        (astcheck.ASTPlainObjMismatch, ['tree', 'body', 0, 'name']),
+        (astcheck.ASTPlainObjMismatch, ['tree', 'body', 0, 'args', 'args', 1, 'arg']),
+        (astcheck.ASTPlainObjMismatch, ['tree', 'body', 0, 'body', 0, 'value', 'left', 'id']),
+        (astcheck.ASTNodeTypeMismatch, ['tree', 'body', 0, 'body', 0, 'value', 'op']),
+        (astcheck.ASTNodeTypeMismatch, ['tree', 'body', 0, 'body', 1, 'value']),
+        (astcheck.ASTMismatch, ['tree', 'body', 0, 'body', 2, 'value']),
+    ]
+    assert len(astcheck.find_mismatches(sample, template, limit=2)) == 2
+    assert [str(m) for m in astcheck.compile(template).find_mismatches(sample, limit=3)] == \
+        [str(m) for m in mismatches[:3]]
+
+    # A list of the wrong length is one mismatch
+    template.body[0].body.append(ast.Pass())
+    assert [m.kind for m in astcheck.find_mismatches(sample, template)][-1:] == \
+        [astcheck.ASTNodeListMismatch]
+    assert astcheck.find_mismatches(sample.body[0], astcheck.pattern("def f(___):\n ___")) == []
+
+    # Items at either end of a listmiddle are checked
+    body_template = ast.FunctionDef(
+        body=[ast.Assign()] + astcheck.listmiddle() + [ast.Return(value=ast.Name(id='z'))])
+    assert [m.path for m in astcheck.find_mismatches(sample.body[0], body_template)] == \
+        [['tree', 'body', -1, 'value', 'id']]
+
+def test_mismatch_record():
+    sample = ast.parse("x = a + b\ny = c")
+    template = ast.Module(body=[
+        ast.Assign(value=ast.BinOp(op=ast.Sub(), right=ast.Name(id='d'))),
+        ast.Assign(value=ast.Attribute()),
+    ])
+    op, name, value = astcheck.find_mismatches(sample, template)
+    assert (op.lineno, op.col_offset) == (1, 4)     # From the BinOp
+    assert (name.lineno, name.col_offset) == (1, 8)
+    assert (value.lineno, value.col_offset) == (2, 4)
+    assert str(value) == "At tree.body[1].value, found Name node instead of Attribute"
+    assert str(name) == "At tree.body[0].value.right.id, found 'b' instead of 'd'"
+    assert name.path == ['tree', 'body', 0, 'value', 'right', 'id']
+
+    # Records don't keep any part of the sample alive
+    import gc
+    for record in [op, name, value]:
+        assert not any(isinstance(obj, (ast.AST, Exception)) for obj in
+                       gc.get_referents(record) + gc.get_referents(record.got))
+
+    with pytest.raises(astcheck.ASTMismatch) as excinfo:
+        astcheck.assert_ast_like(sample, template)
+    record = astcheck.MismatchRecord.from_exception(excinfo.value)
+    assert str(record) == str(excinfo.value)
+    assert record.kind is astcheck.ASTNodeTypeMismatch
+
+def _binop_chain(n, last='b'):
+    node = ast.Name(id='a', ctx=ast.Load())
+    for _ in range(n):
+        node = ast.BinOp(left=node, op=ast.Add(), right=ast.Name(id='b', ctx=ast.Load()))
+    node.right.id = last
+    return ast.Expression(body=node)
+
+def test_deep_trees():
+    depth = 5 * sys.getrecursionlimit()
+    sample, template = _binop_chain(depth), _binop_chain(depth)
+    assert_ast_like(sample, template)
+    assert is_ast_like(sample, template)
+    assert astcheck.compile(template).is_ast_like(sample)
+    assert astcheck.find_mismatches(sample, template) == []
+    assert astcheck.required_names(template) == {'a', 'b'}
+
+    different = _binop_chain(depth, last='c')
+    with pytest.raises(astcheck.ASTPlainObjMismatch) as excinfo:
+        assert_ast_like(sample, different)
+    assert excinfo.value.path == ['tree', 'body', 'right', 'id']
+    assert not astcheck.compile(different).is_ast_like(sample)
+    assert [m.path for m in astcheck.find_mismatches(sample, different)] == \
+        [['tree', 'body', 'right', 'id']]
+
+    pair = ast.Tuple(elts=[sample.body, _binop_chain(depth).body])
+    assert is_ast_like(pair, ast.Tuple(elts=[astcheck.capture('x'), astcheck.backref('x')]))
+    assert len(astcheck.find_all(pair, ast.Name(id='a'))) == 2
+
+def test_first_mismatch_in_order():
+    # The first difference in the order fields are listed is raised, as if
+    # matching recursed into each field in turn
+    sample = ast.parse("f(a, b).x + g", mode='eval')
+    cases = [
+        (ast.BinOp(left=ast.Attribute(value=ast.Call(func=ast.Name(id='h')), attr='y'),
+                   right=ast.Name(id='k')),
+         astcheck.ASTPlainObjMismatch, ['tree', 'body', 'left', 'value', 'func', 'id']),
+        (ast.BinOp(left=ast.Attribute(value=ast.Call(args=[ast.Name()]), attr='y')),
+         astcheck.ASTNodeListMismatch, ['tree', 'body', 'left', 'value', 'args']),
+        (ast.BinOp(left=ast.Attribute(attr='y'), right=ast.Constant()),
+         astcheck.ASTPlainObjMismatch, ['tree', 'body', 'left', 'attr']),
+        (ast.BinOp(op=ast.Sub(), right=ast.Name(id='k')),
+         astcheck.ASTNodeTypeMismatch, ['tree', 'body', 'op']),
+    ]
+    for template, kind, path in cases:
+        with pytest.raises(kind) as excinfo:
+            assert_ast_like(sample, ast.Expression(body=template))
+        assert excinfo.value.path == path
+        assert astcheck.find_mismatches(sample, ast.Expression(body=template))[0].path == path
+
+def test_any_of():
+    template = astcheck.any_of(
+        ast.Call(func=ast.Name(id='open')),
+        astcheck.single_assign(value=ast.Call(func=ast.Name(id='open'))),
+        ast.Expr(value=ast.Call(func=name_or_attr('open'))),
+    )
+    tree = ast.parse("open(a)\nf = open(b)\nx = 1\nio.open(c)\n")
+    assert [type(n).__name__ for n in astcheck.find_all(tree, template)] == \
+        ['Expr', 'Call', 'Assign', 'Call', 'Expr']
+    assert astcheck.required_names(template) == {'open'}
+    assert astcheck.required_node_types(template) == {ast.Call}
+    assert template._candidates(ast.Assign) == (1,)
+    assert template._candidates(ast.Name) == ()
+
+    # Only one alternative could match an Assign, so its mismatch is reported
+    with pytest.raises(astcheck.ASTMismatch) as excinfo:
+        assert_ast_like(tree.body[2], template)
+    assert excinfo.value.path == ['tree', 'value']
+    with pytest.raises(astcheck.ASTNodeTypeMismatch):
+        assert_ast_like(ast.Pass(), template)
+
+    # Captures from an alternative which didn't match are discarded
+    template = astcheck.any_of(
+        ast.BinOp(left=astcheck.capture('x'), right=ast.Constant(value=1)),
+        ast.BinOp(right=astcheck.capture('y')),
+    )
+    sample = ast.parse("a + 2", mode='eval').body
+    assert list(astcheck.match_ast(sample, template)) == ['y']
+    assert list(astcheck.compile(template).match(sample)) == ['y']
+
+def test_not():
+    template = ast.Call(func=ast.Name(id='open'), args=astcheck.listmiddle(
+        [astcheck.not_(ast.Constant())]))
+    assert not is_ast_like(ast.parse("open('a.txt')", mode='eval').body, template)
+    assert is_ast_like(ast.parse("open(path)", mode='eval').body, template)
+    assert astcheck.compile(template).is_ast_like(ast.parse("open(path)", mode='eval').body)
+    assert astcheck.match_ast(ast.Name(id='a'), astcheck.not_(astcheck.capture(
+        'x', ast.Constant()))) == {}
+
+def test_value_predicates():
+    assert is_ast_like(ast.Constant(value=5), ast.Constant(value=astcheck.compare('<=', 5)))
+    assert not is_ast_like(ast.Constant(value=True), ast.Constant(value=astcheck.compare('<', 7)))
+    assert is_ast_like(ast.Constant(value=True), ast.Constant(value=astcheck.compare('==', True)))
+    assert not is_ast_like(ast.Constant(value='a'), ast.Constant(value=astcheck.compare('<', 7)))
+    with pytest.raises(ValueError):
+        astcheck.compare('<>', 1)
+
+    func = ast.parse("def test_x(): pass").body[0]
+    assert is_ast_like(func, ast.FunctionDef(name=astcheck.matches_regex(r'test_\w+')))
+    assert not is_ast_like(func, ast.FunctionDef(name=astcheck.matches_regex(r'test')))
+    assert not is_ast_like(ast.Global(names=['a']), ast.Global(names=astcheck.one_of('a')))
+
+    with pytest.raises(astcheck.ASTMismatch) as excinfo:
+        assert_ast_like(func, ast.FunctionDef(name=astcheck.one_of('f', 'g')))
+    assert excinfo.value.path == ['tree', 'name']
+    assert "one of 'f', 'g'" in str(excinfo.value)
+
+    template = ast.Call(func=name_or_attr(astcheck.one_of('open', 'file')))
+    assert astcheck.required_names(template) == set()
+    assert len(astcheck.find_all(ast.parse("open(a); io.file(b); close(c)"), template)) == 2
+
+    # Templates are pickled to send them to worker processes
+    import pickle
+    copy = pickle.loads(pickle.dumps(astcheck.compile(ast.Call(
+        func=ast.Name(id=astcheck.one_of('open', 'file')),
+        args=[ast.Constant(value=astcheck.compare('<', 7)),
+              ast.Name(id=astcheck.matches_regex('[a-z]+'))]))))
+    assert copy.is_ast_like(ast.parse("open(3, path)", mode='eval').body)
+    assert not copy.is_ast_like(ast.parse("open(8, path)", mode='eval').body)
+    assert not copy.is_ast_like(ast.parse("open(3, Path)", mode='eval').body)
+
+    copy = pickle.loads(pickle.dumps(name_or_attr(astcheck.one_of('open', 'file'))))
+    assert is_ast_like(ast.parse("io.file", mode='eval').body, copy)
+    assert not is_ast_like(ast.parse("close", mode='eval').body, copy)
+
+def test_template_cache():
+    from astcheck.pytest_plugin import TemplateCache
+    cache = TemplateCache()
+    def make(name):
+        return ast.Call(func=ast.Name(id=name))
+    sample = ast.parse("f(x)", mode='eval').body
+    assert cache.compile(make('f')) is cache.compile(make('f'))
+    assert cache.compile(make('f')) is not cache.compile(make('g'))
+    assert cache.compile(ast.Constant(value=1)) is not cache.compile(ast.Constant(value=True))
+    assert cache.build(make, 'f') is cache.build(make, 'f')
+    assert cache.is_ast_like(sample, "f(__)")
+    with pytest.raises(astcheck.ASTPlainObjMismatch):
+        cache.assert_ast_like(sample, make('g'))
+    # Helpers are compared by identity
+    assert cache.compile(ast.Call(func=name_or_attr('f'))) is not \
+        cache.compile(ast.Call(func=name_or_attr('f')))
+    assert (cache.hits, cache.misses) == (4, 8)
+
+plugin_test_code = """
+import ast, astcheck, pytest
+
+@pytest.mark.parametrize('name', ['f', 'g'])
+def test_call(ast_templates, name):
+    template = ast_templates.build(lambda: ast.Call(func=ast.Name(id='f')))
+    sample = ast.parse(name + '(x)', mode='eval').body
+    ast_templates.assert_ast_like(sample, template)
+
+def test_plain():
+    astcheck.assert_ast_like(ast.parse('x = os.open(p)').body[0],
+                             ast.Assign(value=ast.Call(func=ast.Name(id='open'))))
+
+def test_no_ast():
+    pass
+"""
+
+@pytest.fixture
+def plugin_pytester(pytester, monkeypatch):
+    monkeypatch.setenv('PYTEST_DISABLE_PLUGIN_AUTOLOAD', '1')
+    # This test module already imported the plugin, so pytest can't rewrite it
+    pytester.makeini("[pytest]\nfilterwarnings = ignore::pytest.PytestAssertRewriteWarning\n")
+    pytester.makepyfile(test_plugin_use=plugin_test_code)
+    return pytester
+
+def test_pytest_plugin_failures(plugin_pytester):
+    result = plugin_pytester.runpytest_inprocess('-p', 'astcheck.pytest_plugin')
+    result.assert_outcomes(passed=2, failed=2)
+    if hasattr(ast, 'unparse'):
+        found, expected = "os.open", "open"
+    else:  # Python 3.8 shows nodes as a dump
+        found, expected = "Attribute(*", "Name(*"
+    result.stdout.fnmatch_lines([
+        "*- AST mismatch -*",
+        "Path:     tree.value.func",
+        "Found:    Attribute node at line 1, column 4: " + found,
+        "Expected: Name node: " + expected,
+    ])
+    # astcheck's own code is left out of the traceback
+    assert 'def assert_ast_like' not in result.stdout.str()
+
+def test_pytest_plugin_durations(plugin_pytester):
+    result = plugin_pytester.runpytest_inprocess('-p', 'astcheck.pytest_plugin',
+                                                 '--astcheck-durations=2')
+    result.stdout.fnmatch_lines([
+        "*= slowest 2 astcheck assertion tests =*",
+        "*s       1 assertion(s), slowest *s  test_plugin_use.py::*",
+        "*s       1 assertion(s), slowest *s  test_plugin_use.py::*",
+    ])
+    assert 'test_no_ast' not in result.stdout.str().split('slowest 2')[1]
+